@@ -1,4 +1,4 @@
-from typing import Any, Dict, Sequence, Union
+from typing import Any, Dict, Optional, Sequence, Union
 import logging
 
 import numpy as np
@@ -18,7 +18,7 @@ def prepare_attack_experiment(data_dir: str, dataset: str, attack: str, attack_p
                               seed: int, artifact_dir: str, pert_adj_storage_type: str, pert_attr_storage_type: str,
                               model_label: str, model_storage_type: str, device: Union[str, int],
                               surrogate_model_label: str, data_device: Union[str, int], debug_level: str,
-                              ex: Experiment):
+                              ex: Experiment, memmap_dir: Optional[str] = None):
 
     if debug_level is not None and isinstance(debug_level, str):
         logger = logging.getLogger()
@@ -53,7 +53,8 @@ def prepare_attack_experiment(data_dir: str, dataset: str, attack: str, attack_p
     np.random.seed(seed)
 
     graph = prep_graph(dataset, data_device, dataset_root=data_dir, make_undirected=make_undirected,
-                       binary_attr=binary_attr, return_original_split=dataset.startswith('ogbn'))
+                       binary_attr=binary_attr, return_original_split=dataset.startswith('ogbn'),
+                       memmap_dir=memmap_dir)
 
     attr, adj, labels = graph[:3]
     if graph[3] is None:
@@ -95,7 +96,7 @@ def prepare_attack_experiment(data_dir: str, dataset: str, attack: str, attack_p
 
 
 def run_global_attack(epsilon, m, storage, pert_adj_storage_type, pert_attr_storage_type,
-                      pert_params, adversary, model_label):
+                      pert_params, adversary, model_label, checkpoint_step=None, resume=False):
     n_perturbations = int(round(epsilon * m))
 
     pert_adj = storage.load_artifact(pert_adj_storage_type, {**pert_params, **{'epsilon': epsilon}})
@@ -107,12 +108,47 @@ def run_global_attack(epsilon, m, storage, pert_adj_storage_type, pert_attr_stor
         adversary.set_pertubations(pert_adj, pert_attr)
     else:
         logging.info(f"No cached perturbations found for model '{model_label}' and eps {epsilon}. Execute attack...")
-        adversary.attack(n_perturbations)
+
+        # Periodically save the state of long running attacks (only supported by PRBCD and GreedyRBCD)
+        if (checkpoint_step is not None or resume) and not adversary.SUPPORTS_CHECKPOINTS:
+            logging.warning(f'{type(adversary).__name__} does not support checkpoints (ignoring checkpoint_step '
+                            'and resume)')
+            checkpoint_step, resume = None, False
+        checkpoint_storage_type = f'{pert_adj_storage_type}_checkpoint'
+        checkpoint_params = {**pert_params, **{'epsilon': epsilon}}
+        attack_kwargs = {}
+        if checkpoint_step is not None:
+            attack_kwargs['checkpoint_step'] = checkpoint_step
+            attack_kwargs['save_checkpoint'] = lambda checkpoint: storage.save_artifact(
+                checkpoint_storage_type, checkpoint_params, checkpoint)
+        if resume:
+            checkpoint = storage.load_artifact(checkpoint_storage_type, checkpoint_params)
+            if checkpoint is not None:
+                logging.info(f"Found checkpoint for model '{model_label}' and eps {epsilon}")
+                attack_kwargs['checkpoint'] = checkpoint
+
+        adversary.attack(n_perturbations, **attack_kwargs)
         pert_adj, pert_attr = adversary.get_pertubations()
 
         if n_perturbations > 0:
             storage.save_artifact(pert_adj_storage_type, {**pert_params, **{'epsilon': epsilon}}, pert_adj)
             storage.save_artifact(pert_attr_storage_type, {**pert_params, **{'epsilon': epsilon}}, pert_attr)
+        if checkpoint_step is not None:
+            storage.remove_artifact(checkpoint_storage_type, checkpoint_params)
+
+
+def get_adjusted_params(adversary, *models) -> Dict[str, Any]:
+    """Parameters adjusted as the attack (see `PRBCD.max_oom_backoffs`) or the (e.g. PPRGo) models ran out of memory.
+    The adjustments of the models are nested under `attacked_model` and `model`.
+    """
+    adjusted_params = dict(getattr(adversary, 'adjusted_params', {}))
+    attacked_model = getattr(adversary, 'attacked_model', None)
+    if getattr(attacked_model, 'adjusted_params', None):
+        adjusted_params['attacked_model'] = dict(attacked_model.adjusted_params)
+    for model in models:
+        if model is not attacked_model and getattr(model, 'adjusted_params', None):
+            adjusted_params['model'] = dict(model.adjusted_params)
+    return adjusted_params
 
 
 def sample_attack_nodes(logits: torch.Tensor, labels: torch.Tensor, nodes_idx,
@@ -1,13 +1,13 @@
 
 import logging
-from typing import Any, Dict, Sequence, Union
+from typing import Any, Dict, Optional, Sequence, Union
 
 from sacred import Experiment
 
 import torch
 
 from rgnn_at_scale.attacks import Attack, create_attack
-from experiments.common import prepare_attack_experiment, run_global_attack
+from experiments.common import get_adjusted_params, prepare_attack_experiment, run_global_attack
 
 try:
     import seml
@@ -55,6 +55,9 @@ def config():
     model_storage_type = 'pretrained'
     pert_adj_storage_type = 'evasion_global_adj'
     pert_attr_storage_type = 'evasion_global_attr'
+    checkpoint_step = None
+    resume = False
+    memmap_dir = None
 
     debug_level = "info"
 
@@ -63,7 +66,8 @@ def config():
 def run(data_dir: str, dataset: str, attack: str, attack_params: Dict[str, Any], epsilons: Sequence[float],
         binary_attr: bool, make_undirected: bool, seed: int, artifact_dir: str, pert_adj_storage_type: str,
         pert_attr_storage_type: str, model_label: str, model_storage_type: str, device: Union[str, int],
-        data_device: Union[str, int], debug_level: str):
+        data_device: Union[str, int], debug_level: str, checkpoint_step: Optional[int], resume: bool,
+        memmap_dir: Optional[str]):
     """
     Instantiates a sacred experiment executing a global direct attack run for a given model configuration.
     Caches the perturbed adjacency to storage and evaluates the models perturbed accuracy. 
@@ -109,6 +113,13 @@ def run(data_dir: str, dataset: str, attack: str, attack_params: Dict[str, Any],
         The name of the storage (TinyDB) table name the perturbed adjacency matrix is stored to
     pert_attr_storage_type: str
         The name of the storage (TinyDB) table name the perturbed attribute matrix is stored to
+    checkpoint_step: int, optional
+        Saves the state of the attack every `checkpoint_step` epochs/steps (only PRBCD and GreedyRBCD)
+    resume: bool
+        If True, the attack is resumed from its last checkpoint (if any)
+    memmap_dir: str, optional
+        If given, the adjacency matrix is stored in memory-mapped files in this directory and streamed by the attack
+        and the models (only PRBCD and GCN, see `rgnn_at_scale.helper.memmap_csr.MemmapCSR`)
 
     Returns
     -------
@@ -125,7 +136,7 @@ def run(data_dir: str, dataset: str, attack: str, attack_params: Dict[str, Any],
     ) = prepare_attack_experiment(
         data_dir, dataset, attack, attack_params, epsilons, binary_attr, make_undirected,  seed, artifact_dir,
         pert_adj_storage_type, pert_attr_storage_type, model_label, model_storage_type, device, surrogate_model_label,
-        data_device, debug_level, ex
+        data_device, debug_level, ex, memmap_dir=memmap_dir
     )
 
     if model_label is not None and model_label:
@@ -142,7 +153,7 @@ def run(data_dir: str, dataset: str, attack: str, attack_params: Dict[str, Any],
 
         for epsilon in epsilons:
             run_global_attack(epsilon, m, storage, pert_adj_storage_type, pert_attr_storage_type,
-                              pert_params, adversary, model_label)
+                              pert_params, adversary, model_label, checkpoint_step, resume)
 
             adj_adversary = adversary.adj_adversary
             attr_adversary = adversary.attr_adversary
@@ -153,7 +164,9 @@ def run(data_dir: str, dataset: str, attack: str, attack_params: Dict[str, Any],
             results.append({
                 'label': model_label,
                 'epsilon': epsilon,
-                'accuracy': accuracy
+                'accuracy': accuracy,
+                # Parameters adjusted as the attack or the model ran out of memory (see `PRBCD.max_oom_backoffs`)
+                'adjusted_attack_params': get_adjusted_params(adversary, model)
             })
 
             if torch.cuda.is_available():
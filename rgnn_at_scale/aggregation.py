@@ -1,10 +1,13 @@
 """The (robust) aggregations of our paper.
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import math
 import os
 import socket
+import threading
 from typing import Callable, Optional, Tuple
 
 import numba
@@ -18,29 +21,83 @@ import torch_sparse
 
 from rgnn_at_scale.helper.utils import sparse_tensor_to_tuple, tuple_to_sparse_tensor
 
-try:
+_custom_cuda_kernels = None
+_has_loaded_custom_cuda_kernels = False
+
+
+def _get_custom_cuda_kernels():
+    """Loads the custom CUDA kernels on first use (JIT compiling them if they are not installed) and caches them.
+
+    Returns
+    -------
+    module
+        The kernels or None if they are not available (see `_custom_kernel` for the CPU fallbacks).
+    """
+    global _custom_cuda_kernels, _has_loaded_custom_cuda_kernels
+    if _has_loaded_custom_cuda_kernels:
+        return _custom_cuda_kernels
+    _has_loaded_custom_cuda_kernels = True
+
     try:
-        import kernels as custom_cuda_kernels
-        if not hasattr(custom_cuda_kernels, 'topk'):
-            raise ImportError()
-    except ImportError:
-        cache_dir = os.path.join('.', 'extension', socket.gethostname(), torch.__version__)
-        os.makedirs(cache_dir, exist_ok=True)
-        custom_cuda_kernels = load(name="kernels",
-                                   sources=["kernels/csrc/custom.cpp", "kernels/csrc/custom_kernel.cu"],
-                                   extra_cuda_cflags=['-lcusparse', '-l', 'cusparse'],
-                                   build_directory=cache_dir)
-except:  # noqa: E722
-    logging.warn('Cuda kernels could not loaded -> no CUDA support!')
+        try:
+            import kernels as custom_cuda_kernels
+            if not hasattr(custom_cuda_kernels, 'topk'):
+                raise ImportError()
+        except ImportError:
+            cache_dir = os.path.join('.', 'extension', socket.gethostname(), torch.__version__)
+            os.makedirs(cache_dir, exist_ok=True)
+            custom_cuda_kernels = load(name="kernels",
+                                       sources=["kernels/csrc/custom.cpp", "kernels/csrc/custom_kernel.cu"],
+                                       extra_cuda_cflags=['-lcusparse', '-l', 'cusparse'],
+                                       build_directory=cache_dir)
+        _custom_cuda_kernels = custom_cuda_kernels
+    except:  # noqa: E722
+        logging.warning('Cuda kernels could not loaded -> falling back to the CPU implementations!')
+    return _custom_cuda_kernels
+
+
+def _custom_kernel(name: str) -> Callable:
+    """The custom CUDA kernel `name` or its CPU fallback (see `CUSTOM_KERNEL_CPU_FALLBACKS`) if the kernels are not
+    available. Both have the same signature.
+    """
+    custom_cuda_kernels = _get_custom_cuda_kernels()
+    if custom_cuda_kernels is not None:
+        return getattr(custom_cuda_kernels, name)
+    return CUSTOM_KERNEL_CPU_FALLBACKS[name]
+
+
+# Serializes the calls of parallel Numba kernels if the threading layer is not threadsafe (see `_run_parallel_kernel`)
+_PARALLEL_KERNEL_LOCK = threading.Lock()
+
+
+def _run_parallel_kernel(kernel: Callable, *args):
+    """Calls a `numba.njit(parallel=True)` kernel. Numba's workqueue threading layer (the fallback if neither TBB nor
+    OpenMP is available) aborts the process if such kernels run concurrently, e.g. in the thread pool of `Chunker`.
+    Thus, the calls are serialized unless a threadsafe layer is in use.
+    """
+    try:
+        is_threadsafe = numba.threading_layer() in ('tbb', 'omp')
+    except ValueError:
+        # The threading layer is only chosen on the first call of a parallel kernel
+        is_threadsafe = False
+    if is_threadsafe:
+        return kernel(*args)
+    with _PARALLEL_KERNEL_LOCK:
+        return kernel(*args)
 
 
 class Chunker(object):
+    """Executes a function chunk-wise over the rows (e.g. of an adjacency matrix) and concatenates the results. If
+    `requires_grad` each chunk is checkpointed. Otherwise, with `n_threads > 1` the (independent) chunks are executed
+    on a thread pool and written into a preallocated output tensor.
+    """
 
-    def __init__(self, n: int, n_chunks: int, requires_grad: bool, do_synchronize: bool = False):
+    def __init__(self, n: int, n_chunks: int, requires_grad: bool, do_synchronize: bool = False, n_threads: int = 1):
         self.n = n
         self.n_chunks = n_chunks
         self.requires_grad = requires_grad
         self.do_synchronize = do_synchronize
+        self.n_threads = n_threads
         self.chunk_size = int(math.ceil(n / n_chunks))
         self.lower = [chunk * self.chunk_size for chunk in range(self.n_chunks)]
         self.upper = [(chunk + 1) * self.chunk_size for chunk in range(self.n_chunks)]
@@ -49,6 +106,9 @@ class Chunker(object):
     def chunk(self,
               get_run: Callable[[int, int], Callable],
               *input_tensors: Tuple[torch.Tensor, ...]) -> torch.Tensor:
+        if not self.requires_grad and self.n_threads > 1:
+            return self._chunk_threaded(get_run, *input_tensors)
+
         result = []
         for lower, upper in zip(self.lower, self.upper):
             if self.requires_grad:
@@ -61,22 +121,48 @@ class Chunker(object):
         result = torch.cat(result)
         return result
 
+    def _chunk_threaded(self,
+                        get_run: Callable[[int, int], Callable],
+                        *input_tensors: Tuple[torch.Tensor, ...]) -> torch.Tensor:
+        chunks = [(lower, upper) for lower, upper in zip(self.lower, self.upper) if lower < upper]
+
+        # The first chunk determines the shape of the output
+        first_result = get_run(*chunks[0])(*input_tensors)
+        result = first_result.new_empty((self.n, *first_result.shape[1:]))
+        result[chunks[0][0]:chunks[0][1]] = first_result
+        del first_result
+
+        # Grad mode is thread local
+        is_grad_enabled = torch.is_grad_enabled()
+
+        def run_chunk(lower: int, upper: int):
+            with torch.set_grad_enabled(is_grad_enabled):
+                result[lower:upper] = get_run(lower, upper)(*input_tensors)
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            # Consume the iterator to propagate exceptions
+            list(executor.map(lambda chunk: run_chunk(*chunk), chunks[1:]))
+
+        return result
+
 
 def chunked_message_and_aggregate(
     adj_t: torch_sparse.SparseTensor,
     x: torch.Tensor,
     n_chunks: int = 8,
     aggregation_function: Optional[Callable[[torch_sparse.SparseTensor, torch.Tensor], torch.Tensor]] = None,
+    n_threads: int = 1,
     **kwargs
 ) -> torch.Tensor:
     if aggregation_function is None:
         def aggregation_function(adj: torch_sparse.SparseTensor, x: torch.Tensor) -> torch.Tensor:
             return torch_sparse.matmul(adj, x, reduce='sum')
 
-        if not adj_t.coo()[-1].requires_grad:
+        if not adj_t.coo()[-1].requires_grad and n_threads <= 1:
             return aggregation_function(adj_t, x)
 
     edge_weight, *rest = sparse_tensor_to_tuple(adj_t)
+    requires_grad = torch.is_grad_enabled() and (edge_weight.requires_grad or x.requires_grad)
 
     def row_chunked_matmul(lower: int, upper: int):
 
@@ -85,7 +171,7 @@ def chunked_message_and_aggregate(
             return aggregation_function(adj[lower:upper, :], x)
         return row_chunked_matmul_run
 
-    chunker = Chunker(x.size(0), n_chunks, True)
+    chunker = Chunker(x.size(0), n_chunks, requires_grad, n_threads=n_threads)
     new_embeddings = chunker.chunk(
         lambda lower, upper: row_chunked_matmul(lower, upper),
         edge_weight, x
@@ -94,85 +180,237 @@ def chunked_message_and_aggregate(
     return new_embeddings
 
 
-@numba.jit(nopython=True)
-def _select_k_idx_cpu(row_idx: np.ndarray,
-                      col_idx: np.ndarray,
-                      values: np.ndarray,
-                      k_per_row: np.ndarray,
-                      n: int,
-                      method: str = 'top'):
-    new_idx = []
-    valiue_idx = []
-    unroll_idx = []
-
-    sort_idx = row_idx.argsort()
-    row_idx = row_idx[sort_idx]
-    col_idx = col_idx[sort_idx]
-
-    row_idx_start = 0
-    row_idx_end = 0
-    for i in range(n):
-        k_of_row = k_per_row[i]
-        while row_idx_end < len(row_idx) and row_idx[row_idx_end] < i + 1:
-            row_idx_end += 1
-        if k_of_row > 0:
-            if method == 'top':
-                curr_idx = (-values[row_idx_start:row_idx_end]).argsort()[:k_of_row]
-            else:
-                curr_idx = np.random.choice(row_idx_end - row_idx_start, k_of_row, replace=False)
-            new_idx.append(np.stack((
-                i * np.ones_like(curr_idx),
-                col_idx[row_idx_start + curr_idx]
-            )))
-            valiue_idx.append(row_idx_start + curr_idx)
-            unroll_idx.append(np.arange(len(curr_idx)))
-        row_idx_start = row_idx_end
+class _EdgeRestrictedMatmul(torch.autograd.Function):
+    """`A @ x` where the gradient w.r.t. the values of `A` is only calculated at the positions of `edge_pos` (see
+    `edge_restricted_matmul`).
+    """
+
+    @staticmethod
+    def forward(ctx, value: torch.Tensor, x: torch.Tensor, A: torch_sparse.SparseTensor,
+                edge_pos: torch.Tensor, max_elements_per_block: int) -> torch.Tensor:
+        ctx.A = A
+        ctx.max_elements_per_block = max_elements_per_block
+        ctx.save_for_backward(x, edge_pos)
+        return torch_sparse.matmul(A, x, reduce='sum')
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:
+        x, edge_pos = ctx.saved_tensors
+        A = ctx.A
+        grad_value = grad_x = None
+        if ctx.needs_input_grad[0]:
+            row, col = A.storage.row(), A.storage.col()
+            grad_value = torch.zeros(A.nnz(), dtype=grad_output.dtype, device=grad_output.device)
+            # The value gradient is the dot product of the upstream gradient (row) and the source features (col)
+            block_size = max(ctx.max_elements_per_block // max(x.size(1), 1), 1)
+            for lower in range(0, edge_pos.size(0), block_size):
+                block_edge_pos = edge_pos[lower:lower + block_size]
+                grad_value[block_edge_pos] = (grad_output[row[block_edge_pos]] * x[col[block_edge_pos]]).sum(-1)
+        if ctx.needs_input_grad[1]:
+            grad_x = torch_sparse.matmul(A.t(), grad_output, reduce='sum')
+        return grad_value, grad_x, None, None, None
+
+
+def edge_restricted_matmul(A: torch_sparse.SparseTensor, x: torch.Tensor, node_mask: torch.Tensor,
+                           max_elements_per_block: int = 2 ** 24) -> torch.Tensor:
+    """Sparse matrix multiplication `A @ x` where the gradient w.r.t. the values of `A` is only calculated for the
+    entries in the rows or columns of the nodes in `node_mask` (and is zero otherwise). Hence, the backward pass scales
+    with the number of these entries instead of the number of edges. E.g., for a block of edges (and their incident
+    nodes) this is sufficient for the exact gradient towards the block's weights through the GCN normalization.
+
+    Parameters
+    ----------
+    A : torch_sparse.SparseTensor
+        Sparse [n, n] tensor of the weighted/normalized adjacency matrix.
+    x : torch.Tensor
+        Dense [n, d] tensor containing the node attributes/embeddings.
+    node_mask : torch.Tensor
+        Boolean mask [n] of the nodes.
+    max_elements_per_block : int, optional
+        Maximum number of elements (entries times d) that are processed at once in the backward pass,
+        by default 2 ** 24.
+
+    Returns
+    -------
+    torch.Tensor
+        The new embeddings [n, d].
+    """
+    value = A.storage.value()
+    edge_pos = (node_mask[A.storage.row()] | node_mask[A.storage.col()]).nonzero().flatten()
+    return _EdgeRestrictedMatmul.apply(value, x, A.set_value(value.detach(), layout='coo'), edge_pos,
+                                       max_elements_per_block)
+
+
+@numba.njit(parallel=True, cache=True)
+def _select_top_k_idx_cpu(rowptr: np.ndarray, values: np.ndarray, k: int) -> np.ndarray:
+    """Positions (w.r.t. `values`) of the top `k` entries per row in descending order (`-1` for missing entries).
+    """
+    n = rowptr.shape[0] - 1
+    top_k_pos = -np.ones((n, k), dtype=np.int64)
+    for row in numba.prange(n):
+        start, end = rowptr[row], rowptr[row + 1]
+        n_neighbors = end - start
+        if n_neighbors == 0:
+            continue
+        neg_row_values = -values[start:end]
+        if n_neighbors > k:
+            # Partition for the k-th largest value and only sort the selected k elements
+            threshold = np.partition(neg_row_values, k - 1)[k - 1]
+            candidates = np.empty(k, dtype=np.int64)
+            n_candidates = 0
+            for i in range(n_neighbors):
+                if neg_row_values[i] < threshold:
+                    candidates[n_candidates] = i
+                    n_candidates += 1
+            for i in range(n_neighbors):
+                if n_candidates == k:
+                    break
+                if neg_row_values[i] == threshold:
+                    candidates[n_candidates] = i
+                    n_candidates += 1
+        else:
+            candidates = np.arange(n_neighbors)
+        order = np.argsort(neg_row_values[candidates], kind='mergesort')
+        for i in range(candidates.shape[0]):
+            top_k_pos[row, i] = start + candidates[order[i]]
+    return top_k_pos
+
+
+def _sparse_top_k_csr(rowptr: torch.Tensor, col_idx: torch.Tensor, values: torch.Tensor,
+                      k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Top `k` values per row of a CSR matrix on the cpu (parallel over the rows).
+
+    Parameters
+    ----------
+    rowptr : torch.Tensor
+        Row pointer of the CSR matrix with n + 1 entries.
+    col_idx : torch.Tensor
+        Column indices of the CSR matrix.
+    values : torch.Tensor
+        Values of the CSR matrix (gradients are retained).
+    k : int
+        Number of elements to select per row.
+
+    Returns
+    -------
+    Tuple[torch.Tensor, torch.Tensor]
+        Dense [n, k] tensor with the top k values (zero for missing entries) and dense [n, k] tensor of the
+        respective column indices (`-1` for missing entries).
+    """
+    n = rowptr.size(0) - 1
+    if values.size(0) == 0:
+        return (torch.zeros((n, k), dtype=values.dtype, device=values.device),
+                -torch.ones((n, k), dtype=torch.long, device=values.device))
+
+    top_k_pos = _run_parallel_kernel(_select_top_k_idx_cpu, rowptr.cpu().numpy(), values.cpu().detach().numpy(), k)
+    top_k_pos = torch.from_numpy(top_k_pos).to(values.device)
+
+    is_missing_mask = top_k_pos == -1
+    top_k_pos[is_missing_mask] = 0
+    top_k_values = values[top_k_pos].masked_fill(is_missing_mask, 0)
+    top_k_idx = col_idx[top_k_pos].masked_fill(is_missing_mask, -1)
+    return top_k_values, top_k_idx
 
-    return new_idx, valiue_idx, unroll_idx
+
+def _sparse_top_k_coo(A_indices: torch.Tensor, A_values: torch.Tensor, n: int,
+                      k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Top `k` values per row of a COO matrix (via `_sparse_top_k_csr`). Same signature as the CUDA kernel `topk`.
+    """
+    # Bring the COO matrix into CSR format
+    n_cols = int(A_indices[1].max()) + 1 if A_indices.size(1) > 0 else 1
+    sort_idx = torch.argsort(A_indices[0] * n_cols + A_indices[1])
+    rowptr = torch.zeros(n + 1, dtype=torch.long, device=A_indices.device)
+    rowptr[1:] = torch.bincount(A_indices[0], minlength=n).cumsum(0)
+
+    return _sparse_top_k_csr(rowptr, A_indices[1, sort_idx], A_values[sort_idx], k)
 
 
 def _sparse_top_k(A_indices: torch.Tensor, A_values: torch.Tensor, n: int, k: int, return_sparse: bool = True):
 
     if A_indices.is_cuda:
-        topk_values, topk_idx = custom_cuda_kernels.topk(A_indices, A_values, n, k)
-        if not return_sparse:
-            return topk_values, topk_idx.long()
+        topk_values, topk_idx = _custom_kernel('topk')(A_indices, A_values, n, k)
+        topk_idx = topk_idx.long()
+    else:
+        topk_values, topk_idx = _sparse_top_k_coo(A_indices, A_values, n, k)
 
+    if return_sparse:
         mask = topk_idx != -1
         row_idx = torch.arange(n, device=A_indices.device).view(-1, 1).expand(n, k)
-        return torch.sparse.FloatTensor(torch.stack((row_idx[mask], topk_idx[mask].long())), topk_values[mask])
+        return torch.sparse.FloatTensor(torch.stack((row_idx[mask], topk_idx[mask])), topk_values[mask])
+    return topk_values, topk_idx
 
-    n_edges_per_row = torch_scatter.scatter_sum(
-        torch.ones_like(A_values),
-        A_indices[0],
-        dim=0
-    )
-    k_per_row = torch.clamp(
-        n_edges_per_row,
-        max=k
-    ).long()
-
-    new_idx, value_idx, unroll_idx = _select_k_idx_cpu(
-        A_indices[0].cpu().detach().numpy(),
-        A_indices[1].cpu().detach().numpy(),
-        A_values.cpu().detach().numpy(),
-        k_per_row.cpu().detach().numpy(),
-        n,
-        method='top'
-    )
 
-    new_idx = torch.from_numpy(np.hstack(new_idx)).to(A_indices.device)
-    value_idx = torch.from_numpy(np.hstack(value_idx)).to(A_indices.device)
+def _sparse_top_k_neighborhood(A: torch_sparse.SparseTensor, k: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Top `k` neighborhood and row sums of the sparse [batch_size, n] adjacency matrix `A`.
+    """
+    batch_size = A.size(0)
+    A_rows, A_cols, A_values = A.coo()
 
-    if return_sparse:
-        return torch.sparse.FloatTensor(new_idx, A_values[value_idx])
+    # Custom CUDA extension / Numba JIT code for the top k values of the sparse adjacency matrix
+    if A_values.is_cuda:
+        A_indices = torch.stack([A_rows, A_cols], dim=0)
+        top_k_weights, top_k_idx = _sparse_top_k(A_indices, A_values, batch_size, k=k, return_sparse=False)
+        del A_indices
     else:
-        unroll_idx = np.hstack(unroll_idx)
-        values = torch.zeros((n, k), device=A_indices.device)
-        indices = -torch.ones((n, k), device=A_indices.device, dtype=torch.long)
-        values[new_idx[0], unroll_idx] = A_values[value_idx]
-        indices[new_idx[0], unroll_idx] = new_idx[1]
-        return values, indices
+        top_k_weights, top_k_idx = _sparse_top_k_csr(A.storage.rowptr(), A_cols, A_values, k=k)
+
+    a_row_sum = torch_scatter.scatter_sum(A_values, A_rows, dim=-1, dim_size=batch_size)
+    return top_k_weights, top_k_idx, a_row_sum
+
+
+class TopKNeighborhoodCache(object):
+    """Memoizes the top `k` neighborhood (weights, indices and row sums) of sparse adjacency matrices such that
+    repeated aggregations over the same adjacency (multiple layers, epochs or chunks) skip the top `k` selection.
+
+    An entry is identified by the memory location and the version counter of the column index and value tensors.
+    Thus, in-place modifications of the adjacency also invalidate the entry. Since the cache holds references to
+    the tensors of the cached adjacency matrices, the memory location cannot be reused while an entry is alive.
+    Adjacency matrices with values requiring a gradient are not cached (the cached weights would be part of a stale
+    computation graph).
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Maximum number of cached adjacency matrices (least recently used entries are evicted), by default 1.
+    """
+
+    def __init__(self, max_size: int = 1):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _key(A: torch_sparse.SparseTensor, k: int) -> Tuple:
+        col, value = A.storage.col(), A.storage.value()
+        return (
+            col.data_ptr(), col.size(0), col._version,
+            value.data_ptr(), value.size(0), value._version,
+            A.sizes()[0], A.sizes()[1], k
+        )
+
+    def get(self, A: torch_sparse.SparseTensor, k: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns the top `k` weights, the top `k` indices and the row sums of `A` (see
+        `soft_weighted_medoid_k_neighborhood`). On a cache miss they are calculated and stored.
+        """
+        value = A.storage.value()
+        if value is None or (value.requires_grad and torch.is_grad_enabled()):
+            return _sparse_top_k_neighborhood(A, k)
+
+        key = TopKNeighborhoodCache._key(A, k)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key][1]
+
+        top_k_neighborhood = _sparse_top_k_neighborhood(A, k)
+        # Keep a reference of the adjacency tensors such that the memory locations cannot be reused
+        self._entries[key] = ((A.storage.col(), value), top_k_neighborhood)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return top_k_neighborhood
+
+    def invalidate(self):
+        """Removes all entries.
+        """
+        self._entries.clear()
 
 
 def partial_distance_matrix(x: torch.Tensor, partial_idx: torch.Tensor) -> torch.Tensor:
@@ -226,6 +464,94 @@ def partial_distance_matrix(x: torch.Tensor, partial_idx: torch.Tensor) -> torch
     return out.view(batch_size, k, k)
 
 
+def _partial_distances(x: torch.Tensor, partial_idx: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Pairwise distances among the `k` (valid) indices of each row in `partial_idx` ([block_size, k, k]) as well as the
+    gathered attributes ([block_size, k, d]) and the mask of valid indices ([block_size, k]).
+    """
+    is_valid_mask = partial_idx != -1
+    x_partial = x[partial_idx.clamp(min=0)]
+    distances = torch.cdist(x_partial, x_partial, compute_mode='donot_use_mm_for_euclid_dist')
+    distances = distances * (is_valid_mask[:, :, None] & is_valid_mask[:, None, :])
+    return distances, x_partial, is_valid_mask
+
+
+class _PartialWeightedDistances(torch.autograd.Function):
+    """Weighted sums of the distances among the top k neighbors (see `partial_weighted_distances`). Only the inputs are
+    saved for the backward pass and the distances are recomputed block by block.
+    """
+
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, partial_idx: torch.Tensor, partial_weights: torch.Tensor,
+                block_size: int) -> torch.Tensor:
+        ctx.save_for_backward(x, partial_idx, partial_weights)
+        ctx.block_size = block_size
+
+        out = torch.empty_like(partial_weights)
+        for lower in range(0, partial_idx.size(0), block_size):
+            upper = lower + block_size
+            distances, _, _ = _partial_distances(x, partial_idx[lower:upper])
+            out[lower:upper] = (partial_weights[lower:upper, None, :] * distances).sum(-1)
+        return out
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad_out: torch.Tensor) -> Tuple[Optional[torch.Tensor], None, Optional[torch.Tensor], None]:
+        x, partial_idx, partial_weights = ctx.saved_tensors
+        grad_x = torch.zeros_like(x) if ctx.needs_input_grad[0] else None
+        grad_weights = torch.empty_like(partial_weights) if ctx.needs_input_grad[2] else None
+
+        for lower in range(0, partial_idx.size(0), ctx.block_size):
+            upper = lower + ctx.block_size
+            distances, x_partial, is_valid_mask = _partial_distances(x, partial_idx[lower:upper])
+            grad_block = grad_out[lower:upper]
+
+            if grad_weights is not None:
+                grad_weights[lower:upper] = (grad_block[:, :, None] * distances).sum(1)
+
+            if grad_x is not None:
+                # d out_p / d x_q for the pair (p, q) is proportional to (x_p - x_q) / ||x_p - x_q||
+                weights_block = partial_weights[lower:upper]
+                coefficients = (grad_block[:, :, None] * weights_block[:, None, :]
+                                + grad_block[:, None, :] * weights_block[:, :, None])
+                coefficients = torch.where(distances > 0, coefficients / distances, torch.zeros_like(distances))
+                grad_x_partial = coefficients.sum(-1, keepdim=True) * x_partial - coefficients @ x_partial
+                grad_x.index_add_(0, partial_idx[lower:upper][is_valid_mask], grad_x_partial[is_valid_mask])
+
+        return grad_x, None, grad_weights, None
+
+
+def partial_weighted_distances(x: torch.Tensor, partial_idx: torch.Tensor, partial_weights: torch.Tensor,
+                               block_size: Optional[int] = None, max_elements_per_block: int = 2 ** 24
+                               ) -> torch.Tensor:
+    """Calculates for each row and each of its `k` elements the weighted sum of distances to the other `k` elements of
+    the row. In contrast to combining `partial_distance_matrix` with a weighted sum, the [batch_size, k, k] distances
+    are never materialized at once and the backward pass recomputes the distances (block by block).
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Dense [n, d] tensor with attributes to calculate the distance between.
+    partial_idx : torch.Tensor
+        Dense [batch_size, k] tensor where `-1` stands for no index.
+    partial_weights : torch.Tensor
+        Dense [batch_size, k] tensor with the weights of the elements (zero for `-1` indices).
+    block_size : int, optional
+        Number of rows processed at once, by default None (determined via `max_elements_per_block`).
+    max_elements_per_block : int, optional
+        Upper bound on the number of elements of the intermediate tensors for each block, by default 2 ** 24.
+
+    Returns
+    -------
+    torch.Tensor
+        [batch_size, k] weighted distance sums.
+    """
+    _, d = x.shape
+    _, k = partial_idx.shape
+    if block_size is None:
+        block_size = max(1, max_elements_per_block // (k * max(k, d)))
+    return _PartialWeightedDistances.apply(x, partial_idx, partial_weights, block_size)
+
+
 def soft_weighted_medoid_k_neighborhood(
     A: torch_sparse.SparseTensor,
     x: torch.Tensor,
@@ -233,6 +559,8 @@ def soft_weighted_medoid_k_neighborhood(
     temperature: float = 1.0,
     with_weight_correction: bool = True,
     threshold_for_dense_if_cpu: int = 5_000,
+    memory_budget_dense_if_cpu: int = 2 ** 28,
+    top_k_cache: Optional[TopKNeighborhoodCache] = None,
     **kwargs
 ) -> torch.Tensor:
     """Soft Weighted Medoid in the top `k` neighborhood (see Eq. 6 and Eq. 7 in our paper). This function can be used
@@ -254,6 +582,10 @@ def soft_weighted_medoid_k_neighborhood(
         For enabling an alternative normalisazion (see above), by default True.
     threshold_for_dense_if_cpu : int, optional
         On cpu, for runtime reasons, we use a dense implementation if feasible, by default 5_000.
+    memory_budget_dense_if_cpu : int, optional
+        Memory budget in bytes that determines the block size of the dense implementation, by default 2 ** 28.
+    top_k_cache : TopKNeighborhoodCache, optional
+        If passed, the top `k` neighborhood of `A` is memoized in this cache, by default None.
 
     Returns
     -------
@@ -266,24 +598,18 @@ def soft_weighted_medoid_k_neighborhood(
     assert n == A.size(1), \
         "Size missmatch of adjacency matrix (batch_size, n) and attribute/embedding matrix x (n,d)"
     if k > n:
-        if with_weight_correction:
-            raise NotImplementedError('`k` less than `n` and `with_weight_correction` is not implemented.')
-        return soft_weighted_medoid(A.to_torch_sparse_coo_tensor(), x, temperature=temperature)
+        return soft_weighted_medoid(A, x, temperature=temperature, with_weight_correction=with_weight_correction)
     if not x.is_cuda and n < threshold_for_dense_if_cpu:
-        return dense_cpu_soft_weighted_medoid_k_neighborhood(A, x, k, temperature, with_weight_correction)
-
-    A_rows, A_cols, A_values = A.coo()
-    A_indices = torch.stack([A_rows, A_cols], dim=0)
-    del A_rows, A_cols
+        return blocked_dense_cpu_soft_weighted_medoid_k_neighborhood(A, x, k, temperature, with_weight_correction,
+                                                                     max_memory_bytes=memory_budget_dense_if_cpu)
 
-    # Custom CUDA extension / Numba JIT code for the top k values of the sparse adjacency matrix
-    top_k_weights, top_k_idx = _sparse_top_k(A_indices, A_values, batch_size, k=k, return_sparse=False)
-
-    # Partial distance matrix calculation
-    distances_top_k = partial_distance_matrix(x, top_k_idx)
+    if top_k_cache is None:
+        top_k_weights, top_k_idx, a_row_sum = _sparse_top_k_neighborhood(A, k)
+    else:
+        top_k_weights, top_k_idx, a_row_sum = top_k_cache.get(A, k)
 
-    # Multiply distances with weights
-    distances_top_k = (top_k_weights[:, None, :].expand(batch_size, k, k) * distances_top_k).sum(-1)
+    # Partial distance matrix calculation (multiplied with the weights)
+    distances_top_k = partial_weighted_distances(x, top_k_idx, top_k_weights)
     distances_top_k[top_k_idx == -1] = torch.finfo(distances_top_k.dtype).max
     distances_top_k[~torch.isfinite(distances_top_k)] = torch.finfo(distances_top_k.dtype).max
 
@@ -307,7 +633,6 @@ def soft_weighted_medoid_k_neighborhood(
     reliable_adj_values = reliable_adj_values[top_k_mask.view(batch_size, k)]
 
     # Normalization and calculation of new embeddings
-    a_row_sum = torch_scatter.scatter_sum(A_values, A_indices[0], dim=-1, dim_size=batch_size)
     new_embeddings = a_row_sum.view(-1, 1) * torch_sparse.spmm(reliable_adj_index,
                                                                reliable_adj_values, batch_size, n, x)
     return new_embeddings
@@ -364,37 +689,259 @@ def dense_cpu_soft_weighted_medoid_k_neighborhood(
     return row_sum * (topk_weights @ x)
 
 
-def weighted_dimwise_median(A: torch.sparse.FloatTensor, x: torch.Tensor, **kwargs) -> torch.Tensor:
+def blocked_dense_cpu_soft_weighted_medoid_k_neighborhood(
+    A: torch_sparse.SparseTensor,
+    x: torch.Tensor,
+    k: int = 32,
+    temperature: float = 1.0,
+    with_weight_correction: bool = False,
+    max_memory_bytes: int = 2 ** 28,
+    **kwargs
+) -> torch.Tensor:
+    """Row-blocked dense cpu implementation (for details see `soft_weighted_medoid_k_neighborhood`). In contrast to
+    `dense_cpu_soft_weighted_medoid_k_neighborhood`, only the distances among the top `k` neighbors of the rows in the
+    current block are calculated (via batched matrix multiplications) and the dense adjacency matrix is never
+    materialized as a whole.
+
+    Parameters
+    ----------
+    max_memory_bytes : int, optional
+        Approximate memory budget for the intermediate tensors of one block of rows, by default 2 ** 28.
+    """
+    batch_size = A.size(0)
+    n, d = x.size()
+    bytes_per_row = x.element_size() * (n + 3 * k * k + 2 * k * d)
+    block_size = max(1, max_memory_bytes // bytes_per_row)
+
+    x_norm = (x ** 2).sum(1)
+    # For "save" sqrt (see `_distance_matrix`)
+    eps = 1e2 * torch.finfo(x.dtype).eps
+
+    new_embeddings = [x.new_zeros((0, d))]
+    for lower in range(0, batch_size, block_size):
+        upper = min(lower + block_size, batch_size)
+        A_dense = A[lower:upper].to_dense()
+
+        topk_a, topk_a_idx = torch.topk(A_dense, k=k, dim=1)
+        x_k = x[topk_a_idx]
+        x_k_norm = x_norm[topk_a_idx]
+        squared = x_k_norm[:, :, None] + x_k_norm[:, None, :] - 2 * (x_k @ x_k.transpose(1, 2))
+        l2 = torch.sqrt(torch.abs(squared) + eps)
+        distances_k = (topk_a[:, None, :] * l2).sum(-1)
+
+        # when all values of a row are 0 (nodes without any outgoing edges)
+        # then we get NaN results from the softmax which propagate to the embedding
+        distances_k[topk_a == 0] = torch.finfo(distances_k.dtype).max
+        distances_k[~torch.isfinite(distances_k)] = torch.finfo(distances_k.dtype).max
+
+        topk_weights = F.softmax(- distances_k / temperature, dim=-1)
+        if with_weight_correction:
+            topk_weights = topk_weights * topk_a
+            topk_weights = topk_weights / topk_weights.sum(-1)[:, None]
+
+        # For nodes with no outgoing edges we have NaN values that need to be corrected (see dense implementation)
+        row_sum = A_dense.sum(-1)[:, None]
+        topk_weights = torch.where(row_sum == 0, torch.zeros_like(topk_weights), topk_weights)
+
+        new_embeddings.append(row_sum * (topk_weights[:, None, :] @ x_k).squeeze(1))
+
+    return torch.cat(new_embeddings)
+
+
+def _to_sparse_tensor(A: torch.Tensor) -> torch_sparse.SparseTensor:
+    """Converts a dense or sparse (COO) adjacency matrix into a `torch_sparse.SparseTensor`.
+    """
+    if isinstance(A, torch_sparse.SparseTensor):
+        return A
+    if A.is_sparse:
+        return torch_sparse.SparseTensor.from_torch_sparse_coo_tensor(A.coalesce())
+    return torch_sparse.SparseTensor.from_dense(A)
+
+
+@numba.njit(parallel=True, cache=True)
+def _dimmedian_idx_cpu(rowptr: np.ndarray, col_idx: np.ndarray, values: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """Per row and dimension, the index of the weighted median among the neighbors (same semantics as the CUDA
+    kernel `dimmedian_idx`). The neighbors are sorted by their value in the respective dimension and the first
+    element whose cumulative weight reaches half of the row's weight sum is selected.
+    """
+    n_rows = rowptr.shape[0] - 1
+    d = x.shape[1]
+    median_idx = np.zeros((n_rows, d), dtype=np.int64)
+    for row in numba.prange(n_rows):
+        start, end = rowptr[row], rowptr[row + 1]
+        if start == end:
+            continue
+        neighbors = col_idx[start:end]
+        weights = values[start:end]
+        half_weight_sum = weights.sum() / 2
+        neighbor_x = np.empty(end - start, dtype=x.dtype)
+        for dim in range(d):
+            for i in range(end - start):
+                neighbor_x[i] = x[neighbors[i], dim]
+            order = np.argsort(neighbor_x, kind='mergesort')
+            cum_weight = 0.
+            for i in order:
+                cum_weight += weights[i]
+                if cum_weight >= half_weight_sum:
+                    median_idx[row, dim] = neighbors[i]
+                    break
+    return median_idx
+
+
+def _subsample_high_degree_rows(A: torch_sparse.SparseTensor, degree_threshold: int,
+                                eps: float = 1e-2, delta: float = 1e-2) -> torch_sparse.SparseTensor:
+    """Replaces the neighborhood of each row with more than `degree_threshold` entries by
+    s = ceil(ln(2 / delta) / (2 * eps^2)) neighbors that are sampled (with replacement) proportionally to their weight.
+    Each sample has unit weight. By Hoeffding's inequality the weighted rank of the sample median (per dimension) lies
+    within [1/2 - eps, 1/2 + eps] of the original weighted distribution with a probability of at least 1 - delta.
+
+    Parameters
+    ----------
+    A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix (with non-negative weights).
+    degree_threshold : int
+        Rows with more entries are subsampled (rows with at most s entries are never subsampled).
+    eps : float, optional
+        Bound on the rank error of the median, by default 1e-2.
+    delta : float, optional
+        Probability that the rank error exceeds `eps`, by default 1e-2.
+
+    Returns
+    -------
+    torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor with at most max(degree_threshold, s) entries per row.
+    """
+    n_samples = math.ceil(math.log(2 / delta) / (2 * eps ** 2))
+    rowptr, col, value = _csr_with_values(A)
+    deg = rowptr[1:] - rowptr[:-1]
+    is_hub = deg > max(degree_threshold, n_samples)
+    if not is_hub.any():
+        return A
+
+    hub_idx = is_hub.nonzero().flatten()
+    # Inverse transform sampling with the cumulative weights (each row covers an interval)
+    cum_value = torch.cat([value.new_zeros(1, dtype=torch.double), torch.cumsum(value.double(), 0)])
+    lower, upper = cum_value[rowptr[hub_idx]], cum_value[rowptr[hub_idx + 1]]
+    sampled_value = (lower[:, None]
+                     + torch.rand(hub_idx.size(0), n_samples, dtype=torch.double, device=value.device)
+                     * (upper - lower)[:, None])
+    position = torch.searchsorted(cum_value[1:], sampled_value, right=True)
+    lower_idx, upper_idx = rowptr[hub_idx].unsqueeze(-1), rowptr[hub_idx + 1].unsqueeze(-1)
+    position = torch.min(torch.max(position, lower_idx), upper_idx - 1).flatten()
+
+    row = A.storage.row()
+    is_kept = ~is_hub[row]
+    return torch_sparse.SparseTensor(
+        row=torch.cat([row[is_kept], hub_idx.repeat_interleave(n_samples)]),
+        col=torch.cat([col[is_kept], col[position]]),
+        value=torch.cat([value[is_kept], torch.ones_like(position, dtype=value.dtype)]),
+        sparse_sizes=A.sparse_sizes()
+    )
+
+
+def dimmedian_idx(x: torch.Tensor, A: torch_sparse.SparseTensor, approx_degree_threshold: Optional[int] = None,
+                  approx_eps: float = 1e-2, approx_delta: float = 1e-2) -> torch.Tensor:
+    """Index of the weighted dimension-wise median for each row of the adjacency matrix. On GPU this uses the custom
+    CUDA kernel and otherwise a parallel Numba implementation working on the CSR representation in
+    O(nnz * d * log(deg)).
+
+    Parameters
+    ----------
+    x : torch.Tensor
+        Dense [n, d] tensor containing the node attributes/embeddings.
+    A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix.
+    approx_degree_threshold : int, optional
+        If set, the median of rows with more entries is approximated via weighted sampling (see
+        `_subsample_high_degree_rows`) which bounds the cost per row, by default None.
+    approx_eps : float, optional
+        Bound on the rank error of the approximate median, by default 1e-2.
+    approx_delta : float, optional
+        Probability that the rank error of the approximate median exceeds `approx_eps`, by default 1e-2.
+
+    Returns
+    -------
+    torch.Tensor
+        Dense [batch_size, d] tensor with the (row) indices of x that are the median for each row and dimension.
+    """
+    if approx_degree_threshold is not None:
+        A = _subsample_high_degree_rows(A, approx_degree_threshold, approx_eps, approx_delta)
+
+    batch_size = A.size(0)
+    if x.is_cuda:
+        row_index, col_index, edge_weights = A.coo()
+        edge_index = torch.stack([row_index, col_index], dim=0)
+        return _custom_kernel('dimmedian_idx')(x, edge_index, edge_weights, A.nnz(), batch_size)
+
+    return _dimmedian_idx_csr(x, *A.csr())
+
+
+def _dimmedian_idx_csr(x: torch.Tensor, rowptr: torch.Tensor, col_index: torch.Tensor,
+                       edge_weights: Optional[torch.Tensor]) -> torch.Tensor:
+    """Index of the weighted dimension-wise median for each row of a CSR matrix (via `_dimmedian_idx_cpu`).
+    """
+    if edge_weights is None:
+        edge_weights = torch.ones_like(col_index, dtype=x.dtype)
+    median_idx = _run_parallel_kernel(_dimmedian_idx_cpu, rowptr.cpu().numpy(), col_index.cpu().numpy(),
+                                      edge_weights.detach().cpu().numpy(), x.detach().cpu().contiguous().numpy())
+    return torch.from_numpy(median_idx).to(x.device)
+
+
+def _dimmedian_idx_coo(x: torch.Tensor, edge_index: torch.Tensor, edge_weights: torch.Tensor, nnz: int,
+                       batch_size: int) -> torch.Tensor:
+    """Index of the weighted dimension-wise median for each row of a COO matrix. Same signature as the CUDA kernel
+    `dimmedian_idx`.
+    """
+    A = torch_sparse.SparseTensor(row=edge_index[0], col=edge_index[1], value=edge_weights,
+                                  sparse_sizes=(batch_size, x.size(0)))
+    return _dimmedian_idx_csr(x, *A.csr())
+
+
+# CPU implementations that are used if the custom CUDA kernels are not available
+CUSTOM_KERNEL_CPU_FALLBACKS = {
+    'topk': _sparse_top_k_coo,
+    'dimmedian_idx': _dimmedian_idx_coo
+}
+
+
+def weighted_dimwise_median(A: torch.sparse.FloatTensor, x: torch.Tensor, approx_degree_threshold: Optional[int] = None,
+                            approx_eps: float = 1e-2, approx_delta: float = 1e-2, **kwargs) -> torch.Tensor:
     """A weighted dimension-wise Median aggregation.
 
     Parameters
     ----------
     A : torch.sparse.FloatTensor
-        Sparse [n, n] tensor of the weighted/normalized adjacency matrix
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix (a dense tensor or
+        `torch_sparse.SparseTensor` is also accepted).
     x : torch.Tensor
         Dense [n, d] tensor containing the node attributes/embeddings
+    approx_degree_threshold : int, optional
+        If set, the median of rows with more entries is approximated (see `dimmedian_idx`), by default None.
+    approx_eps : float, optional
+        Bound on the rank error of the approximate median, by default 1e-2.
+    approx_delta : float, optional
+        Probability that the rank error of the approximate median exceeds `approx_eps`, by default 1e-2.
 
     Returns
     -------
     torch.Tensor
-        The new embeddings [n, d]
+        The new embeddings [batch_size, d]
     """
-    if not A.is_cuda:
-        return weighted_dimwise_median_cpu(A, x, **kwargs)
-
-    assert A.is_sparse
-    N, D = x.shape
+    A = _to_sparse_tensor(A)
+    batch_size = A.size(0)
+    _, D = x.shape
 
-    median_idx = custom_cuda_kernels.dimmedian_idx(x, A.indices(), A.values(), A._nnz(), N)
-    col_idx = torch.arange(D, device=A.device).view(1, -1).expand(N, D)
+    with torch.no_grad():
+        median_idx = dimmedian_idx(x, A, approx_degree_threshold, approx_eps, approx_delta)
+    col_idx = torch.arange(D, device=x.device).view(1, -1).expand(batch_size, D)
     x_selected = x[median_idx, col_idx]
 
-    a_row_sum = torch_scatter.scatter_sum(A._values(), A._indices()[0], dim=-1).view(-1, 1).expand(N, D)
+    a_row_sum = A.sum(1).view(-1, 1).expand(batch_size, D)
     return a_row_sum * x_selected
 
 
 def weighted_dimwise_median_cpu(A: torch.sparse.FloatTensor, x: torch.Tensor, **kwargs) -> torch.Tensor:
-    """A weighted dimension-wise Median aggregation (cpu implementation).
+    """A weighted dimension-wise Median aggregation (dense cpu implementation, only feasible for small graphs).
 
     Parameters
     ----------
@@ -449,105 +996,207 @@ def _distance_matrix(x: torch.Tensor, eps_factor=1e2) -> torch.Tensor:
     return torch.sqrt(torch.abs(squared) + eps)
 
 
-def weighted_medoid(A: torch.sparse.FloatTensor, x: torch.Tensor, **kwargs) -> torch.Tensor:
-    """A weighted Medoid aggregation.
+def _csr_with_values(A: torch_sparse.SparseTensor,
+                     dtype: torch.dtype = torch.float) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """CSR representation of `A` (unit values if `A` has no values).
+    """
+    rowptr, col, value = A.csr()
+    if value is None:
+        value = torch.ones_like(col, dtype=dtype)
+    return rowptr, col, value
+
+
+def _neighborhood_distance_sums(rowptr: torch.Tensor, col: torch.Tensor, value: torch.Tensor, x: torch.Tensor,
+                                max_elements_per_block: int = 2 ** 24, eps_factor=1e2) -> torch.Tensor:
+    """For each entry (i, j) of the sparse CSR matrix A, calculates the weighted sum of distances to the other neighbors
+    of row i: sum_l A_il * ||x_j - x_l||. Only the sum(deg^2) distances within the neighborhoods are calculated. The
+    rows are processed in blocks (with checkpointing if a gradient is required) to bound the memory footprint.
 
     Parameters
     ----------
-    A : torch.sparse.FloatTensor
-        Sparse [n, n] tensor of the weighted/normalized adjacency matrix.
+    rowptr : torch.Tensor
+        Row pointer of the CSR matrix with batch_size + 1 entries.
+    col : torch.Tensor
+        Column indices of the CSR matrix.
+    value : torch.Tensor
+        Values of the CSR matrix.
+    x : torch.Tensor
+        Dense [n, d] tensor containing the node attributes/embeddings.
+    max_elements_per_block : int, optional
+        Upper bound on the number of elements of the intermediate tensors for each block, by default 2 ** 24.
+    eps_factor : [type], optional
+        Factor to be multiplied by `torch.finfo(x.dtype).eps` for "safe" sqrt, by default 1e2.
+
+    Returns
+    -------
+    torch.Tensor
+        The weighted distance sums for each entry of the CSR matrix.
+    """
+    n_rows = rowptr.size(0) - 1
+    _, d = x.shape
+    deg = rowptr[1:] - rowptr[:-1]
+    cum_pairs = torch.cumsum(deg ** 2, 0).cpu()
+    max_pairs_per_block = max(1, max_elements_per_block // d)
+    requires_grad = torch.is_grad_enabled() and (x.requires_grad or value.requires_grad)
+
+    x_norm = (x ** 2).sum(1)
+    # For "save" sqrt (see `_distance_matrix`)
+    eps = eps_factor * torch.finfo(x.dtype).eps
+
+    def get_run(lower: int, upper: int) -> Callable:
+        def run(value: torch.Tensor, x: torch.Tensor, x_norm: torch.Tensor) -> torch.Tensor:
+            block_deg = deg[lower:upper]
+            # Enumerate all pairs (j, l) of neighbors of the rows in the block
+            edge_idx = torch.arange(rowptr[lower], rowptr[upper], device=col.device)
+            edge_deg = block_deg.repeat_interleave(block_deg)
+            edge_row_start = rowptr[lower:upper].repeat_interleave(block_deg)
+            pair_edge = edge_idx.repeat_interleave(edge_deg)
+            pair_offset = (torch.arange(pair_edge.size(0), device=col.device)
+                           - (torch.cumsum(edge_deg, 0) - edge_deg).repeat_interleave(edge_deg))
+            pair_partner = edge_row_start.repeat_interleave(edge_deg) + pair_offset
+
+            candidate_idx, neighbor_idx = col[pair_edge], col[pair_partner]
+            squared = (x_norm[candidate_idx] + x_norm[neighbor_idx]
+                       - 2 * (x[candidate_idx] * x[neighbor_idx]).sum(-1))
+            distances = torch.sqrt(torch.abs(squared) + eps)
+            return torch_scatter.scatter_add(value[pair_partner] * distances, pair_edge - edge_idx[:1],
+                                             dim=0, dim_size=edge_idx.size(0))
+        return run
+
+    distance_sums = [x.new_zeros(0)]
+    lower = 0
+    while lower < n_rows:
+        processed_pairs = cum_pairs[lower - 1] if lower > 0 else 0
+        upper = int(torch.searchsorted(cum_pairs, processed_pairs + max_pairs_per_block, right=True))
+        upper = min(max(upper, lower + 1), n_rows)
+        if requires_grad:
+            distance_sums.append(checkpoint(get_run(lower, upper), value, x, x_norm))
+        else:
+            distance_sums.append(get_run(lower, upper)(value, x, x_norm))
+        lower = upper
+    return torch.cat(distance_sums)
+
+
+def _sparse_weighted_medoid_idx(A: torch_sparse.SparseTensor, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Column index of the weighted Medoid for each row of `A` and the mask of rows with at least one neighbor.
+    """
+    batch_size = A.size(0)
+    rowptr, col, value = _csr_with_values(A, x.dtype)
+    if col.size(0) == 0:
+        return torch.zeros(batch_size, dtype=torch.long, device=x.device), torch.zeros(batch_size, dtype=torch.bool,
+                                                                                       device=x.device)
+
+    distance_sums = _neighborhood_distance_sums(rowptr, col, value, x)
+    _, argmin = torch_scatter.scatter_min(distance_sums, A.storage.row(), dim=0, dim_size=batch_size)
+    # `scatter_min` returns an out of range index for rows without any entry
+    has_neighbors = argmin < col.size(0)
+    return col[argmin.clamp(max=col.size(0) - 1)], has_neighbors
+
+
+def weighted_medoid(A: torch_sparse.SparseTensor, x: torch.Tensor, **kwargs) -> torch.Tensor:
+    """A weighted Medoid aggregation. Distances are only calculated within the neighborhood of each row, i.e. the
+    memory requirements scale with sum(deg^2).
+
+    Parameters
+    ----------
+    A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix (dense or `torch.sparse` tensors are
+        also accepted).
     x : torch.Tensor
         Dense [n, d] tensor containing the node attributes/embeddings.
 
     Returns
     -------
     torch.Tensor
-        The new embeddings [n, d].
+        The new embeddings [batch_size, d].
     """
-    N, D = x.shape
-    l2 = _distance_matrix(x)
-    A_cpu_dense = A.cpu()
-    l2_cpu = l2.cpu()
-    if A.is_sparse:
-        A_cpu_dense = A_cpu_dense.to_dense()
-    distances = A_cpu_dense[:, None, :].expand(N, N, N) * l2_cpu
-    distances[A_cpu_dense == 0] = torch.finfo(distances.dtype).max
-    distances = distances.sum(-1).to(x.device)
-    distances[~torch.isfinite(distances)] = torch.finfo(distances.dtype).max
-    row_sum = A_cpu_dense.sum(-1)[:, None].to(x.device)
-    return row_sum * x[distances.argmin(-1)]
+    A = _to_sparse_tensor(A)
+    medoid_idx, has_neighbors = _sparse_weighted_medoid_idx(A, x)
+    row_sum = A.sum(1) * has_neighbors
+    return row_sum[:, None] * x[medoid_idx]
 
 
-def weighted_medoid_k_neighborhood(A: torch.sparse.FloatTensor, x: torch.Tensor, k: int = 32, **kwargs) -> torch.Tensor:
-    """A weighted Medoid aggregation.
+def weighted_medoid_k_neighborhood(A: torch_sparse.SparseTensor, x: torch.Tensor, k: int = 32,
+                                   top_k_cache: Optional[TopKNeighborhoodCache] = None, **kwargs) -> torch.Tensor:
+    """A weighted Medoid aggregation in the top `k` neighborhood.
 
     Parameters
     ----------
-    A : torch.sparse.FloatTensor
-        Sparse [n, n] tensor of the weighted/normalized adjacency matrix.
+    A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix (dense or `torch.sparse` tensors are
+        also accepted).
     x : torch.Tensor
         Dense [n, d] tensor containing the node attributes/embeddings.
+    k : int, optional
+        Neighborhood size for selecting the top k elements, by default 32.
+    top_k_cache : TopKNeighborhoodCache, optional
+        If passed, the top `k` neighborhood of `A` is memoized in this cache, by default None.
 
     Returns
     -------
     torch.Tensor
-        The new embeddings [n, d].
+        The new embeddings [batch_size, d].
     """
-    N, D = x.shape
-    if k > N:
+    A = _to_sparse_tensor(A)
+    batch_size, n = A.sizes()
+    if k > n:
         return weighted_medoid(A, x)
-    l2 = _distance_matrix(x)
-    if A.is_sparse:
-        A_dense = A.to_dense()
+
+    if top_k_cache is None:
+        top_k_weights, top_k_idx, row_sum = _sparse_top_k_neighborhood(A, k)
     else:
-        A_dense = A
-    topk_a, topk_a_idx = torch.topk(A_dense, k=k, dim=1)
-    topk_l2_idx = topk_a_idx[:, None, :].expand(N, k, k)
-    distances_k = (
-        topk_a[:, None, :].expand(N, k, k)
-        * l2[topk_l2_idx, topk_l2_idx.transpose(1, 2)]
-    ).sum(-1)
-    distances_k[topk_a == 0] = torch.finfo(distances_k.dtype).max
-    distances_k[~torch.isfinite(distances_k)] = torch.finfo(distances_k.dtype).max
-    row_sum = A_dense.sum(-1)[:, None]
-    return row_sum * x[topk_a_idx[torch.arange(N), distances_k.argmin(-1)]]
+        top_k_weights, top_k_idx, row_sum = top_k_cache.get(A, k)
+    top_k_mask = top_k_idx != -1
+    top_k_row = torch.arange(batch_size, device=x.device)[:, None].expand(batch_size, k)
+    A_top_k = torch_sparse.SparseTensor(row=top_k_row[top_k_mask], col=top_k_idx[top_k_mask],
+                                        value=top_k_weights[top_k_mask], sparse_sizes=(batch_size, n))
+
+    medoid_idx, has_neighbors = _sparse_weighted_medoid_idx(A_top_k, x)
+    return (row_sum * has_neighbors)[:, None] * x[medoid_idx]
 
 
 def soft_weighted_medoid(
-    A: torch.sparse.FloatTensor,
+    A: torch_sparse.SparseTensor,
     x: torch.Tensor,
     temperature: float = 1.0,
+    with_weight_correction: bool = False,
     **kwargs
 ) -> torch.Tensor:
-    """A weighted Medoid aggregation.
+    """A Soft Weighted Medoid aggregation (see `soft_weighted_medoid_k_neighborhood`) over the whole neighborhood.
+    Distances are only calculated within the neighborhood of each row, i.e. the memory requirements scale with
+    sum(deg^2).
 
     Parameters
     ----------
-    A : torch.sparse.FloatTensor
-        Sparse [n, n] tensor of the weighted/normalized adjacency matrix.
+    A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix (dense or `torch.sparse` tensors are
+        also accepted).
     x : torch.Tensor
         Dense [n, d] tensor containing the node attributes/embeddings.
     temperature : float, optional
         Temperature for the argmin approximation by softmax, by default 1.0
+    with_weight_correction : bool, optional
+        For enabling an alternative normalisazion (see `soft_weighted_medoid_k_neighborhood`), by default False.
 
     Returns
     -------
     torch.Tensor
-        The new embeddings [n, d].
+        The new embeddings [batch_size, d].
     """
-    batch_size = A.size(0)
-    N, D = x.shape
-    l2 = _distance_matrix(x)
-    A_cpu_dense = A.cpu()
-    l2_cpu = l2.cpu()
-    if A.is_sparse:
-        A_cpu_dense = A_cpu_dense.to_dense()
-    distances = A_cpu_dense[:, None, :].expand(batch_size, N, N) * l2_cpu
-    distances[A_cpu_dense == 0] = torch.finfo(distances.dtype).max
-    distances = distances.sum(-1).to(x.device)
-    distances[~torch.isfinite(distances)] = torch.finfo(distances.dtype).max
-    row_sum = A_cpu_dense.sum(-1)[:, None].to(x.device)
-    return row_sum * (F.softmax(-distances / temperature, dim=-1) @ x)
+    A = _to_sparse_tensor(A)
+    batch_size, n = A.sizes()
+    rowptr, col, value = _csr_with_values(A, x.dtype)
+    row = A.storage.row()
+
+    distance_sums = _neighborhood_distance_sums(rowptr, col, value, x)
+    soft_weights = torch_scatter.composite.scatter_softmax(-distance_sums / temperature, row, dim=-1,
+                                                           dim_size=batch_size)
+    if with_weight_correction:
+        soft_weights = soft_weights * value
+        soft_weights = soft_weights / torch_scatter.scatter_add(soft_weights, row, dim=-1, dim_size=batch_size)[row]
+
+    row_sum = torch_scatter.scatter_add(value, row, dim=-1, dim_size=batch_size)
+    return row_sum[:, None] * torch_sparse.spmm(torch.stack([row, col]), soft_weights, batch_size, n, x)
 
 
 def soft_median(
@@ -556,6 +1205,9 @@ def soft_median(
     p=2,
     temperature=1.0,
     eps=1e-12,
+    approx_degree_threshold: Optional[int] = None,
+    approx_eps: float = 1e-2,
+    approx_delta: float = 1e-2,
     **kwargs
 ) -> torch.Tensor:
     """Soft Weighted Median.
@@ -572,6 +1224,12 @@ def soft_median(
         Controlling the steepness of the softmax, by default 1.0.
     eps : float, optional
         Precision for softmax calculation.
+    approx_degree_threshold : int, optional
+        If set, the median of rows with more entries is approximated (see `dimmedian_idx`), by default None.
+    approx_eps : float, optional
+        Bound on the rank error of the approximate median, by default 1e-2.
+    approx_delta : float, optional
+        Probability that the rank error of the approximate median exceeds `approx_eps`, by default 1e-2.
 
     Returns
     -------
@@ -587,7 +1245,7 @@ def soft_median(
     weight_sums = torch_scatter.scatter_add(edge_weights, row_index)
 
     with torch.no_grad():
-        median_idx = custom_cuda_kernels.dimmedian_idx(x, edge_index, edge_weights, A.nnz(), batch_size)
+        median_idx = dimmedian_idx(x, A, approx_degree_threshold, approx_eps, approx_delta)
         median_col_idx = torch.arange(d, device=x.device).view(1, -1).expand(batch_size, d)
     x_median = x[median_idx, median_col_idx]
 
@@ -603,6 +1261,131 @@ def soft_median(
     return new_embeddings
 
 
+def changed_rows(A: torch_sparse.SparseTensor, x: torch.Tensor,
+                 previous_A: torch_sparse.SparseTensor, previous_x: torch.Tensor) -> torch.Tensor:
+    """Determines the rows of a (row-wise) robust aggregation that change from (`previous_A`, `previous_x`) to
+    (`A`, `x`). These are the rows of the adjacency matrix that changed and the rows with a neighbor whose embedding
+    changed. All robust aggregations in `ROBUST_MEANS` only depend on these quantities.
+
+    Parameters
+    ----------
+    A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix.
+    x : torch.Tensor
+        Dense [n, d] tensor containing the node attributes/embeddings.
+    previous_A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the previous adjacency matrix.
+    previous_x : torch.Tensor
+        Dense [n, d] tensor containing the previous node attributes/embeddings.
+
+    Returns
+    -------
+    torch.Tensor
+        Boolean mask [batch_size] of the changed rows.
+    """
+    batch_size = A.size(0)
+    rowptr, col, value = _csr_with_values(A, x.dtype)
+    previous_rowptr, previous_col, previous_value = _csr_with_values(previous_A, x.dtype)
+
+    # Rows with a different number of entries changed for sure
+    deg, previous_deg = rowptr[1:] - rowptr[:-1], previous_rowptr[1:] - previous_rowptr[:-1]
+    is_changed = deg != previous_deg
+
+    # Compare the remaining rows entry by entry
+    n_compared = deg.masked_fill(is_changed, 0)
+    offsets = (torch.arange(int(n_compared.sum()), device=col.device)
+               - (torch.cumsum(n_compared, 0) - n_compared).repeat_interleave(n_compared))
+    position = rowptr[:-1].repeat_interleave(n_compared) + offsets
+    previous_position = previous_rowptr[:-1].repeat_interleave(n_compared) + offsets
+    is_entry_changed = ((col[position] != previous_col[previous_position])
+                        | (value[position] != previous_value[previous_position]))
+    row = torch.arange(batch_size, device=col.device).repeat_interleave(n_compared)
+    is_changed[row[is_entry_changed]] = True
+
+    # Rows with a changed neighbor
+    is_x_changed = (x != previous_x).any(-1)
+    is_changed[A.storage.row()[is_x_changed[col]]] = True
+
+    return is_changed
+
+
+def neighborhood_rows(A: torch_sparse.SparseTensor, node_idx: torch.Tensor, hops: int = 1,
+                      is_symmetric: bool = False) -> torch.Tensor:
+    """Determines the rows of a (row-wise) robust aggregation that change if only the entries of the adjacency matrix
+    incident to `node_idx` change (e.g. the endpoints of a block of edges, including the changed normalization). These
+    are `node_idx` and the rows within `hops` hops, where a layer at depth `hops` also accounts for the embeddings that
+    changed in the previous layers. In contrast to `changed_rows`, neither the entries nor the embeddings are compared.
+
+    Parameters
+    ----------
+    A : torch_sparse.SparseTensor
+        Sparse [n, n] tensor of the weighted/normalized adjacency matrix.
+    node_idx : torch.Tensor
+        Indices of the nodes with changed incident entries.
+    hops : int, optional
+        Number of hops, by default 1.
+    is_symmetric : bool, optional
+        If true the sparsity pattern of `A` is symmetric and the neighbors are gathered from the rows of the current
+        hop instead of scanning all entries, by default False.
+
+    Returns
+    -------
+    torch.Tensor
+        Boolean mask [n] of the changed rows.
+    """
+    is_changed = torch.zeros(A.size(0), dtype=torch.bool, device=node_idx.device)
+    is_changed[node_idx] = True
+    frontier = node_idx
+    for _ in range(hops):
+        if frontier.size(0) == 0:
+            break
+        if is_symmetric:
+            neighbors = A.index_select(0, frontier).storage.col()
+        else:
+            is_frontier = torch.zeros_like(is_changed)
+            is_frontier[frontier] = True
+            neighbors = A.storage.row()[is_frontier[A.storage.col()]]
+        frontier = neighbors[~is_changed[neighbors]].unique()
+        is_changed[frontier] = True
+    return is_changed
+
+
+def incremental_aggregation(
+    A: torch_sparse.SparseTensor,
+    x: torch.Tensor,
+    previous_embeddings: torch.Tensor,
+    changed_rows: torch.Tensor,
+    aggregation_function: Callable[..., torch.Tensor] = soft_median,
+    **kwargs
+) -> torch.Tensor:
+    """Recalculates a (row-wise) robust aggregation only for the `changed_rows` (see `changed_rows` or
+    `neighborhood_rows`) and reuses the previous embeddings for all other rows.
+
+    Parameters
+    ----------
+    A : torch_sparse.SparseTensor
+        Sparse [batch_size, n] tensor of the weighted/normalized adjacency matrix.
+    x : torch.Tensor
+        Dense [n, d] tensor containing the node attributes/embeddings.
+    previous_embeddings : torch.Tensor
+        The result of the aggregation [batch_size, d] prior to the change.
+    changed_rows : torch.Tensor
+        Boolean mask [batch_size] of the rows to be recalculated.
+    aggregation_function : Callable[..., torch.Tensor], optional
+        The aggregation of `ROBUST_MEANS`, by default `soft_median`.
+
+    Returns
+    -------
+    torch.Tensor
+        The new embeddings [batch_size, d].
+    """
+    row_idx = changed_rows.nonzero().flatten()
+    new_embeddings = previous_embeddings.clone()
+    if row_idx.size(0) > 0:
+        new_embeddings[row_idx] = aggregation_function(A.index_select(0, row_idx), x, **kwargs)
+    return new_embeddings
+
+
 ROBUST_MEANS = {
     'dimmedian': weighted_dimwise_median,
     'medoid': weighted_medoid,
@@ -1,20 +1,32 @@
+import importlib
 from typing import Union
 
-from .dice import DICE
-from .fgsm import FGSM
-from .greedy_rbcd import GreedyRBCD
-from .local_prbcd import LocalPRBCD
-from .local_dice import LocalDICE
-from .local_prbcd_batched import LocalBatchedPRBCD
-from .pgd import PGD
-from .prbcd import PRBCD
-from .nettack import Nettack
 from .base_attack import Attack
-from .sga import SGA
 
-ATTACK_TYPE = Union[SGA, DICE, FGSM, GreedyRBCD, LocalPRBCD, PGD, PRBCD, Nettack, LocalBatchedPRBCD, LocalDICE]
-SPARSE_ATTACKS = [GreedyRBCD.__name__, PRBCD.__name__, DICE.__name__]
-LOCAL_ATTACKS = [SGA.__name__, LocalPRBCD.__name__, Nettack.__name__, LocalBatchedPRBCD.__name__, LocalDICE.__name__]
+# The attacks are imported on first access (e.g. such that not every job pays for importing Nettack)
+_ATTACK_MODULES = {
+    'SGA': 'sga',
+    'DICE': 'dice',
+    'FGSM': 'fgsm',
+    'GreedyRBCD': 'greedy_rbcd',
+    'LocalPRBCD': 'local_prbcd',
+    'PGD': 'pgd',
+    'PRBCD': 'prbcd',
+    'DistributedPRBCD': 'distributed_prbcd',
+    'Nettack': 'nettack',
+    'LocalBatchedPRBCD': 'local_prbcd_batched',
+    'LocalDICE': 'local_dice',
+}
+SPARSE_ATTACKS = ['GreedyRBCD', 'PRBCD', 'DistributedPRBCD', 'DICE']
+LOCAL_ATTACKS = ['SGA', 'LocalPRBCD', 'Nettack', 'LocalBatchedPRBCD', 'LocalDICE']
+
+
+def __getattr__(name: str):
+    if name in _ATTACK_MODULES:
+        return getattr(importlib.import_module(f'.{_ATTACK_MODULES[name]}', __name__), name)
+    if name == 'ATTACK_TYPE':
+        return Union[tuple(__getattr__(attack) for attack in _ATTACK_MODULES)]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def create_attack(attack: str, *args, **kwargs) -> Attack:
@@ -32,11 +44,10 @@ def create_attack(attack: str, *args, **kwargs) -> Attack:
     Union[FGSM, GreedyRBCD, PRBCD]
         The created instance
     """
-    if not any([attack.lower() == attack_model.__name__.lower() for attack_model in ATTACK_TYPE.__args__]):
-        raise ValueError(f'The attack {attack} is not in {ATTACK_TYPE.__args__}')
+    if not any([attack.lower() == attack_model.lower() for attack_model in _ATTACK_MODULES]):
+        raise ValueError(f'The attack {attack} is not in {list(_ATTACK_MODULES)}')
 
-    return globals()[attack](*args, **kwargs)
+    return __getattr__(attack)(*args, **kwargs)
 
 
-__all__ = [FGSM, GreedyRBCD, LocalPRBCD, LocalBatchedPRBCD, LocalDICE,
-           PRBCD, create_attack, ATTACK_TYPE, SPARSE_ATTACKS, Nettack, SGA]
+__all__ = ['Attack', 'create_attack', 'ATTACK_TYPE', 'SPARSE_ATTACKS', 'LOCAL_ATTACKS'] + list(_ATTACK_MODULES)
@@ -13,6 +13,7 @@ from torch.nn import functional as F
 
 from torch_sparse import SparseTensor
 from rgnn_at_scale.models import MODEL_TYPE, DenseGCN, GCN, RGNN, BATCHED_PPR_MODELS
+from rgnn_at_scale.helper.memmap_csr import MemmapCSR
 from rgnn_at_scale.helper.utils import accuracy
 
 patch_typeguard()
@@ -58,8 +59,11 @@ class Attack(ABC):
             - NCE: Negative Cross Entropy
     """
 
+    # Whether `_attack` accepts `checkpoint_step`, `save_checkpoint` and `checkpoint` (see `PRBCD._attack`)
+    SUPPORTS_CHECKPOINTS = False
+
     def __init__(self,
-                 adj: Union[SparseTensor, TensorType["n_nodes", "n_nodes"]],
+                 adj: Union[SparseTensor, TensorType["n_nodes", "n_nodes"], MemmapCSR],
                  attr: TensorType["n_nodes", "n_features"],
                  labels: TensorType["n_nodes"],
                  idx_attack: np.ndarray,
@@ -127,6 +131,22 @@ class Attack(ABC):
             self.attr_adversary = self.attr
             self.adj_adversary = self.adj
 
+    def _do_evaluate(self, epoch: int) -> bool:
+        """Whether an iterative attack is monitored (also for early stopping) in this epoch (always for the last
+        epoch). Requires the attributes `epochs`, `eval_step` and `eval_from_epoch` (e.g. see `PRBCD`).
+        """
+        if epoch == self.epochs - 1:
+            return True
+        return epoch >= self.eval_from_epoch and (epoch - self.eval_from_epoch) % self.eval_step == 0
+
+    def _set_attack_statistics(self, names: List[str], statistics: torch.Tensor, epochs: List[int]):
+        """Transfers the statistics (one row per monitored epoch and one column per name) from the device at once.
+        `attack_statistics` contains the monitored `epochs` next to the values (i.e. all lists have the same length).
+        """
+        self.attack_statistics = dict(epoch=list(epochs))
+        for name, values in zip(names, statistics.cpu().T.tolist()):
+            self.attack_statistics[name] = values
+
     def set_pertubations(self, adj_perturbed: Union[SparseTensor, TensorType["n_nodes", "n_nodes"]],
                          attr_perturbed: TensorType["n_nodes", "n_features"]):
         self.adj_adversary = adj_perturbed.to(self.data_device)
@@ -147,7 +167,7 @@ class Attack(ABC):
     @torch.no_grad()
     def evaluate_global(model,
                         attr: TensorType["n_nodes", "n_features"],
-                        adj: Union[SparseTensor, TensorType["n_nodes", "n_nodes"]],
+                        adj: Union[SparseTensor, TensorType["n_nodes", "n_nodes"], MemmapCSR],
                         labels: TensorType["n_nodes"],
                         eval_idx: Union[List[int], np.ndarray]):
         """
@@ -254,21 +274,56 @@ class Attack(ABC):
         if not inplace:
             values = values.clone()
 
-        if torch.clamp(values, 0, 1).sum() > n_perturbations:
-            left = (values - 1).min()
-            right = values.max()
-            miu = Attack.bisection(values, left, right, n_perturbations)
-            values.data.copy_(torch.clamp(
-                values - miu, min=eps, max=1 - eps
-            ))
-        else:
-            values.data.copy_(torch.clamp(
-                values, min=eps, max=1 - eps
-            ))
+        miu = Attack.projection_shift(values.detach(), n_perturbations)
+        values.data.copy_(torch.clamp(
+            values - miu, min=eps, max=1 - eps
+        ))
         return values
 
+    @staticmethod
+    def projection_shift(values: torch.Tensor, n_perturbations: int) -> torch.Tensor:
+        """Exact shift `miu >= 0` for the projection onto `{0 <= p <= 1, sum(p) <= n_perturbations}`, i.e.
+        `torch.clamp(values - miu, 0, 1).sum() == n_perturbations` (or zero if the budget is not exceeded). In contrast
+        to `bisection`, it is calculated in O(b log b) via sorting the breakpoints of the piecewise linear sum and
+        without synchronizing the device.
+
+        Parameters
+        ----------
+        values : torch.Tensor
+            The values to be projected.
+        n_perturbations : int
+            The budget.
+
+        Returns
+        -------
+        torch.Tensor
+            The shift `miu` (scalar tensor).
+        """
+        if values.numel() == 0:
+            return values.new_zeros(())
+        values_ = values.double().flatten()
+        n_values = values_.size(0)
+
+        # `f(miu) = sum(clamp(values - miu, 0, 1))` is linear between the (sorted) breakpoints `values - 1` and `values`
+        breakpoints, order = torch.sort(torch.cat((values_ - 1, values_)))
+        slope_change = torch.cat((torch.ones_like(values_), -torch.ones_like(values_)))[order]
+        slope = -torch.cumsum(slope_change, 0)[:-1]
+        # At the first breakpoint all summands are one
+        f = n_values + torch.cat((
+            values_.new_zeros(1),
+            torch.cumsum(slope * (breakpoints[1:] - breakpoints[:-1]), 0)
+        ))
+
+        # `f` is non-increasing and the root lies in the segment after the last breakpoint with `f > n_perturbations`
+        segment = ((f > n_perturbations).sum() - 1).clamp(0, max(2 * n_values - 2, 0))
+        miu = breakpoints[segment] + (f[segment] - n_perturbations) / (-slope[segment]).clamp(min=1)
+
+        is_within_budget = torch.clamp(values_, 0, 1).sum() <= n_perturbations
+        return torch.where(is_within_budget, torch.zeros_like(miu), miu).to(values.dtype)
+
     @staticmethod
     def bisection(edge_weights, a, b, n_perturbations, epsilon=1e-5, iter_max=1e5):
+        """Reference implementation for the shift of the projection (see `projection_shift`)."""
         def func(x):
             return torch.clamp(edge_weights - x, 0, 1).sum() - n_perturbations
 
@@ -296,7 +351,7 @@ class SparseAttack(Attack):
     """
 
     def __init__(self,
-                 adj: Union[SparseTensor, TensorType["n_nodes", "n_nodes"], sp.csr_matrix],
+                 adj: Union[SparseTensor, TensorType["n_nodes", "n_nodes"], sp.csr_matrix, MemmapCSR],
                  **kwargs):
 
         if isinstance(adj, torch.Tensor):
@@ -306,9 +361,13 @@ class SparseAttack(Attack):
 
         super().__init__(adj, **kwargs)
 
-        edge_index_rows, edge_index_cols, edge_weight = adj.coo()
-        self.edge_index = torch.stack([edge_index_rows, edge_index_cols], dim=0).to(self.data_device)
-        self.edge_weight = edge_weight.to(self.data_device)
+        # The edges of a memory-mapped (out-of-core) adjacency matrix are never loaded as a whole
+        if isinstance(adj, MemmapCSR):
+            self.edge_index, self.edge_weight = None, None
+        else:
+            edge_index_rows, edge_index_cols, edge_weight = adj.coo()
+            self.edge_index = torch.stack([edge_index_rows, edge_index_cols], dim=0).to(self.data_device)
+            self.edge_weight = edge_weight.to(self.data_device)
         self.n = adj.size(0)
         self.d = self.attr.shape[1]
 
@@ -2,11 +2,10 @@ import random
 
 import numpy as np
 import torch
-from torch_sparse import SparseTensor
 from tqdm import tqdm
 
 from rgnn_at_scale.attacks.base_attack import SparseAttack
-from rgnn_at_scale.helper import utils
+from rgnn_at_scale.helper.undirected_adjacency import UndirectedAdjacency
 
 
 class DICE(SparseAttack):
@@ -26,9 +25,9 @@ class DICE(SparseAttack):
 
         self.edge_weight = self.edge_weight.float()
 
-        # Create Symmetric Adjacency Matrix
-        adj_symmetric_index, adj_symmetric_weights = utils.to_symmetric(self.edge_index, self.edge_weight, self.n)
-        self.adj_dict = self._to_dict(adj_symmetric_index, adj_symmetric_weights)
+        # Upper triangle of the symmetric adjacency matrix (without mirroring and coalescing all edges)
+        adj_triu = UndirectedAdjacency.from_edge_index(self.edge_index, self.edge_weight, self.n)
+        self.adj_dict = self._to_dict(adj_triu.edge_index, adj_triu.edge_weight)
         self.add_ratio = add_ratio
 
     def _is_in_upper_triangle(self, adj_symmetric_index):
@@ -133,11 +132,8 @@ class DICE(SparseAttack):
         edge_index = torch.LongTensor(indices).T.to(self.device)
         edge_attr = torch.FloatTensor(values).to(self.device)
 
-        edge_index, edge_attr = utils.to_symmetric(edge_index, edge_attr, self.n)
-
-        return SparseTensor.from_edge_index(edge_index=edge_index,
-                                            edge_attr=edge_attr,
-                                            sparse_sizes=torch.Size([self.n, self.n]))
+        # The keys are unique and in the upper triangle, i.e. mirroring them suffices
+        return UndirectedAdjacency(edge_index, edge_attr, self.n).to_sparse_tensor()
 
     def _attack(self,
                 n_perturbations: int,
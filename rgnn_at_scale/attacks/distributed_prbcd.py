@@ -0,0 +1,130 @@
+import logging
+from typing import Callable, Tuple
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch_geometric.utils import k_hop_subgraph
+
+from rgnn_at_scale.helper import utils
+from rgnn_at_scale.attacks.prbcd import PRBCD, T
+
+
+class DistributedPRBCD(PRBCD):
+    """Data-parallel PRBCD over `torch.distributed` (e.g. with the gloo backend for multiple CPU processes).
+
+    Every process (rank) holds the graph, the model and the block, but only calculates the loss and its gradient for
+    its share of the attacked nodes `idx_attack`. For local models (see `GCN.receptive_field_hops`), a rank only
+    propagates on the subgraph of the receptive field of its attacked nodes, i.e. the forward and backward passes
+    (and their activations) are split among the ranks. Other models propagate on the whole graph on every rank. The
+    gradients towards the block are summed up (all-reduce) before the update and the projection that are executed
+    redundantly by all ranks. The randomly (re)sampled block as well as the final sample are determined on rank 0 and
+    broadcasted. The gradient of the partitioned loss is exact for losses that average over the attacked nodes (e.g.
+    `CE` or `tanhMargin`), for `MCE` it is an approximation.
+
+    The process group must be initialized before the attack is created (e.g. via
+    `torch.distributed.init_process_group('gloo', ...)`) and all ranks need to call `attack` collectively. Backing
+    off on out of memory errors (see `PRBCD.max_oom_backoffs`) is not supported, since a rank running out of memory
+    would leave the collectives of the other ranks unmatched.
+    """
+
+    def __init__(self, **kwargs):
+        assert dist.is_available() and dist.is_initialized(), \
+            'DistributedPRBCD requires an initialized process group (see `torch.distributed.init_process_group`)'
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+
+        super().__init__(**kwargs)
+
+        if self.max_oom_backoffs > 0:
+            logging.warning('DistributedPRBCD does not back off on out of memory errors (ignoring max_oom_backoffs)')
+            self.max_oom_backoffs = 0
+
+        # Share of the attacked nodes (and of the loss) of this rank
+        self.idx_attack_local = np.array_split(np.asarray(self.idx_attack), self.world_size)[self.rank]
+        self.local_loss_weight = len(self.idx_attack_local) / len(self.idx_attack)
+
+        logging.info(f'Rank {self.rank} of {self.world_size} attacks {len(self.idx_attack_local)} nodes')
+
+    def _attack(self, n_perturbations, save_checkpoint=None, **kwargs):
+        # Only rank 0 persists the (identical) state
+        if self.rank != 0:
+            save_checkpoint = None
+        return super()._attack(n_perturbations, save_checkpoint=save_checkpoint, **kwargs)
+
+    def _with_oom_backoff(self, step: Callable[[], T], n_perturbations: int) -> T:
+        # The ranks would need to agree on the backoff and on the collectives that are matched after a failed step
+        return step()
+
+    def _get_loss_and_gradient(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        logits, local_idx = self._get_local_logits()
+        loss = self.local_loss_weight * self.calculate_loss(logits[local_idx], self.labels[self.idx_attack_local])
+        gradient = utils.grad_with_checkpoint(loss, self.perturbed_edge_weight)[0]
+
+        loss = loss.detach()
+        dist.all_reduce(loss)
+        dist.all_reduce(gradient)
+        return loss, gradient
+
+    def _get_local_logits(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Logits that include the ones of this rank's attacked nodes and the positions of these nodes in the logits.
+        """
+        hops = None
+        if hasattr(self.attacked_model, 'receptive_field_hops') and not self.is_out_of_core:
+            hops = self.attacked_model.receptive_field_hops()
+        if hops is None:
+            return self._get_modified_logits(), torch.as_tensor(self.idx_attack_local)
+
+        edge_index, edge_weight, is_normalized = self._get_modified_graph()
+        subset, edge_index, local_idx, edge_mask = DistributedPRBCD.receptive_field(
+            torch.as_tensor(self.idx_attack_local, device=edge_index.device), hops, edge_index, self.n)
+        logits = self._get_graph_logits(self.attr[subset.to(self.attr.device)], edge_index, edge_weight[edge_mask],
+                                        is_normalized)
+        return logits, local_idx
+
+    @staticmethod
+    def receptive_field(node_idx: torch.Tensor, hops: int, edge_index: torch.Tensor,
+                        n: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Subgraph of the nodes within `hops` hops of `node_idx` (also along edges with zero weight, since their
+        gradient might not vanish).
+
+        Returns
+        -------
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
+            The nodes of the subgraph, its (relabeled) edges, the positions of `node_idx` in the subgraph and the mask
+            of the edges that are contained in the subgraph.
+        """
+        return k_hop_subgraph(node_idx, hops, edge_index, relabel_nodes=True, num_nodes=n)
+
+    def sample_random_block(self, n_perturbations: int = 0):
+        super().sample_random_block(n_perturbations)
+        self._broadcast_block()
+
+    def resample_random_block(self, n_perturbations: int):
+        super().resample_random_block(n_perturbations)
+        self._broadcast_block()
+
+    @torch.no_grad()
+    def sample_final_edges(self, n_perturbations: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.rank == 0:
+            super().sample_final_edges(n_perturbations)
+        else:
+            self.perturbed_edge_weight = torch.empty_like(self.perturbed_edge_weight).detach()
+        dist.broadcast(self.perturbed_edge_weight, src=0)
+        return self._get_final_edges(n_perturbations)
+
+    def _broadcast_block(self):
+        """Replaces the search space and the block's weights with the ones of rank 0.
+        """
+        size = torch.tensor(self.current_search_space.size(0), device=self.device)
+        dist.broadcast(size, src=0)
+        size = int(size)
+        requires_grad = self.perturbed_edge_weight.requires_grad
+
+        if self.rank != 0:
+            self.current_search_space = self.current_search_space.new_empty(size)
+            self.modified_edge_index = self.modified_edge_index.new_empty((2, size))
+            self.perturbed_edge_weight = self.perturbed_edge_weight.new_empty(size)
+        for value in [self.current_search_space, self.modified_edge_index, self.perturbed_edge_weight.detach()]:
+            dist.broadcast(value, src=0)
+        self.perturbed_edge_weight.requires_grad = requires_grad
@@ -1,9 +1,13 @@
+import logging
+from typing import Any, Callable, Dict, Optional
+
 from tqdm import tqdm
 import torch
 import torch_sparse
 from torch_sparse import SparseTensor
 
 from rgnn_at_scale.helper import utils
+from rgnn_at_scale.helper.undirected_adjacency import UndirectedAdjacency
 from rgnn_at_scale.attacks.prbcd import PRBCD
 
 
@@ -13,45 +17,66 @@ class GreedyRBCD(PRBCD):
 
     def __init__(self, epochs: int = 500, **kwargs):
         super().__init__(**kwargs)
+        if self.is_out_of_core:
+            raise NotImplementedError('GreedyRBCD does not support a memory-mapped adjacency matrix (use PRBCD)')
 
         rows, cols, self.edge_weight = self.adj.coo()
         self.edge_index = torch.stack([rows, cols], dim=0)
+        if self.with_undirected_adjacency:
+            is_triu = rows <= cols
+            self.edge_index, self.edge_weight = self.edge_index[:, is_triu], self.edge_weight[is_triu]
 
-        self.edge_index = self.edge_index.to(self.data_device)
+        self.edge_index = self._compact(self.edge_index.to(self.data_device))
         self.edge_weight = self.edge_weight.float().to(self.data_device)
         self.attr = self.attr.to(self.data_device)
         self.epochs = epochs
 
         self.n_perturbations = 0
 
+    def _compact(self, edge_index: torch.Tensor) -> torch.Tensor:
+        return utils.compact_index(edge_index, self.n - 1) if self.compact_indices else edge_index
+
     def _greedy_update(self, step_size: int, gradient: torch.Tensor):
         _, topk_edge_index = torch.topk(gradient, step_size)
 
-        add_edge_index = self.modified_edge_index[:, topk_edge_index]
+        add_edge_index = self.modified_edge_index[:, topk_edge_index].long()
         add_edge_weight = torch.ones_like(add_edge_index[0], dtype=torch.float32)
 
-        if self.make_undirected:
+        if self.make_undirected and not self.with_undirected_adjacency:
             add_edge_index, add_edge_weight = utils.to_symmetric(add_edge_index, add_edge_weight, self.n)
-        add_edge_index = torch.cat((self.edge_index, add_edge_index.to(self.data_device)), dim=-1)
+        add_edge_index = torch.cat((self.edge_index.long(), add_edge_index.to(self.data_device)), dim=-1)
         add_edge_weight = torch.cat((self.edge_weight, add_edge_weight.to(self.data_device)))
         edge_index, edge_weight = torch_sparse.coalesce(
             add_edge_index, add_edge_weight, m=self.n, n=self.n, op='sum'
         )
 
         is_one_mask = torch.isclose(edge_weight, torch.tensor(1.))
-        self.edge_index = edge_index[:, is_one_mask]
+        self.edge_index = self._compact(edge_index[:, is_one_mask])
         self.edge_weight = edge_weight[is_one_mask]
         # self.edge_weight = torch.ones_like(self.edge_weight)
         assert self.edge_index.size(1) == self.edge_weight.size(0)
 
-    def _attack(self, n_perturbations: int):
+    def _attack(self, n_perturbations: int, checkpoint_step: Optional[int] = None,
+                save_checkpoint: Optional[Callable[[Dict[str, Any]], None]] = None,
+                checkpoint: Optional[Dict[str, Any]] = None, **kwargs):
         """Perform attack
 
         Parameters
         ----------
         n_perturbations : int
             Number of edges to be perturbed (assuming an undirected graph)
+        checkpoint_step : int, optional
+            Every `checkpoint_step` steps the state of the attack is passed to `save_checkpoint`, by default None.
+        save_checkpoint : Callable[[Dict[str, Any]], None], optional
+            Persists a checkpoint (e.g. via `Storage.save_artifact`), by default None.
+        checkpoint : Dict[str, Any], optional
+            Resumes the attack from this checkpoint (same results as without interruption), by default None.
         """
+        start_step = 0
+        if checkpoint is not None:
+            start_step = self._load_checkpoint(checkpoint)
+            logging.info(f'Resuming the attack from step {start_step}')
+
         assert n_perturbations > self.n_perturbations, (
             f'Number of perturbations must be bigger as this attack is greedy (current {n_perturbations}, '
             f'previous {self.n_perturbations})'
@@ -60,7 +85,7 @@ class GreedyRBCD(PRBCD):
         self.n_perturbations += n_perturbations
 
         # To assert the number of perturbations later on
-        clean_edges = self.edge_index.shape[1]
+        clean_edges = self.edge_index.shape[1] if checkpoint is None else checkpoint['clean_edges']
 
         # Determine the number of edges to be flipped in each attach step / epoch
         step_size = n_perturbations // self.epochs
@@ -71,22 +96,18 @@ class GreedyRBCD(PRBCD):
         else:
             steps = [1] * n_perturbations
 
-        for step_size in tqdm(steps):
+        for step in tqdm(range(start_step, len(steps))):
+            step_size = steps[step]
             # Sample initial search space (Algorithm 2, line 3-4)
             self.sample_random_block(step_size)
-            # Retreive sparse perturbed adjacency matrix `A \oplus p_{t-1}` (Algorithm 2, line 7)
-            edge_index, edge_weight = self.get_modified_adj()
 
             if torch.cuda.is_available() and self.do_synchronize:
                 torch.cuda.empty_cache()
                 torch.cuda.synchronize()
 
-            # Calculate logits for each node (Algorithm 2, line 7)
-            logits = self._get_logits(self.attr, edge_index, edge_weight)
-            # Calculate loss combining all each node (Algorithm 2, line 8)
-            loss = self.calculate_loss(logits[self.idx_attack], self.labels[self.idx_attack])
-            # Retreive gradient towards the current block (Algorithm 2, line 8)
-            gradient = utils.grad_with_checkpoint(loss, self.perturbed_edge_weight)[0]
+            # Logits on the sparse perturbed adjacency matrix `A \oplus p_{t-1}` as well as the loss and its gradient
+            # towards the current block (Algorithm 2, line 7-8)
+            loss, gradient = self._with_oom_backoff(self._get_loss_and_gradient, step_size)
 
             if torch.cuda.is_available() and self.do_synchronize:
                 torch.cuda.empty_cache()
@@ -96,18 +117,49 @@ class GreedyRBCD(PRBCD):
                 # Greedy update of edges (Algorithm 2, line 8)
                 self._greedy_update(step_size, gradient)
 
-            del logits
             del loss
             del gradient
 
+            if save_checkpoint is not None and checkpoint_step and (step + 1) % checkpoint_step == 0:
+                save_checkpoint(self._get_checkpoint(step + 1, self.n_perturbations - n_perturbations, clean_edges))
+
         allowed_perturbations = 2 * n_perturbations if self.make_undirected else n_perturbations
+        if self.with_undirected_adjacency:
+            # Every edge is only contained once
+            allowed_perturbations = n_perturbations
         edges_after_attack = self.edge_index.shape[1]
         assert (edges_after_attack >= clean_edges - allowed_perturbations
                 and edges_after_attack <= clean_edges + allowed_perturbations), \
             f'{edges_after_attack} out of range with {clean_edges} clean edges and {n_perturbations} pertutbations'
 
-        self.adj_adversary = SparseTensor.from_edge_index(
-            self.edge_index, self.edge_weight, (self.n, self.n)
-        ).coalesce().detach()
+        if self.with_undirected_adjacency:
+            self.adj_adversary = UndirectedAdjacency(self.edge_index, self.edge_weight, self.n).to_sparse_tensor()
+        else:
+            self.adj_adversary = SparseTensor.from_edge_index(self.edge_index.long(), self.edge_weight,
+                                                              (self.n, self.n))
+        self.adj_adversary = self.adj_adversary.coalesce().detach()
 
         self.attr_adversary = self.attr
+
+    def _get_checkpoint(self, step: int, n_previous_perturbations: int, clean_edges: int) -> Dict[str, Any]:
+        """State of the attack (on the cpu) such that it can be resumed from `step` (see `_load_checkpoint`).
+        """
+        return dict(
+            step=step,
+            n_perturbations=n_previous_perturbations,
+            clean_edges=clean_edges,
+            edge_index=self.edge_index.cpu(),
+            edge_weight=self.edge_weight.cpu(),
+            rng_state=utils.get_rng_state(),
+            **self._get_adjusted_params_checkpoint()
+        )
+
+    def _load_checkpoint(self, checkpoint: Dict[str, Any]) -> int:
+        """Restores the state of the attack (see `_get_checkpoint`) and returns the step to resume from.
+        """
+        self.n_perturbations = checkpoint['n_perturbations']
+        self.edge_index = checkpoint['edge_index'].to(self.data_device)
+        self.edge_weight = checkpoint['edge_weight'].to(self.data_device)
+        utils.set_rng_state(checkpoint['rng_state'])
+        self._load_adjusted_params_checkpoint(checkpoint)
+        return checkpoint['step']
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from typing import Tuple
 
 import math
 import logging
@@ -13,12 +13,15 @@ from torch_sparse import SparseTensor
 from tqdm import tqdm
 
 from rgnn_at_scale.models import MODEL_TYPE, BATCHED_PPR_MODELS
-from rgnn_at_scale.helper.utils import grad_with_checkpoint, to_symmetric
+from rgnn_at_scale.helper.utils import grad_with_checkpoint
 from rgnn_at_scale.attacks.base_attack import Attack, SparseLocalAttack
 
 
 class LocalPRBCD(SparseLocalAttack):
 
+    STATISTICS = ['loss', 'perturbation_mass', 'logit_target', 'logit_best_non_target', 'confidence_target',
+                  'confidence_non_target', 'margin']
+
     @typechecked
     def __init__(self,
                  loss_type: str = 'Margin',  # 'CW', 'LeakyCW'  # 'CE', 'MCE', 'Margin'
@@ -31,6 +34,8 @@ class LocalPRBCD(SparseLocalAttack):
                  do_synchronize: bool = False,
                  eps: float = 1e-14,
                  final_samples: int = 20,
+                 eval_step: int = 1,
+                 eval_from_epoch: int = 0,
                  **kwargs):
 
         super().__init__(**kwargs)
@@ -53,6 +58,9 @@ class LocalPRBCD(SparseLocalAttack):
         self.eps = eps
         self.do_synchronize = do_synchronize
         self.final_samples = final_samples
+        # Monitor (and track the best state) every `eval_step` epochs starting from epoch `eval_from_epoch`
+        self.eval_step = eval_step
+        self.eval_from_epoch = eval_from_epoch
 
         self.current_search_space: torch.Tensor = None
         self.modified_edge_weight_diff: torch.Tensor = None
@@ -63,9 +71,10 @@ class LocalPRBCD(SparseLocalAttack):
     def _attack(self, n_perturbations: int, node_idx: int, **kwargs):
 
         self.sample_search_space(node_idx, n_perturbations)
-        best_margin = float('Inf')
-        best_epoch = float('-Inf')
-        self.attack_statistics = defaultdict(list)
+        self._init_best_state()
+        # For collecting attack statistics (kept on the device and transferred once after the attack). The row `epoch`
+        # is only filled if we evaluate the epoch (see `_do_evaluate`)
+        statistics = torch.full((self.epochs, len(LocalPRBCD.STATISTICS)), float('nan'), device=self.device)
 
         with torch.no_grad():
             logits_orig = self.get_surrogate_logits(node_idx).to(self.device)
@@ -105,48 +114,52 @@ class LocalPRBCD(SparseLocalAttack):
                     n_perturbations, self.modified_edge_weight_diff, self.eps
                 )
 
-                perturbed_graph = self.perturb_graph(node_idx)
-                logits = self.get_surrogate_logits(node_idx, perturbed_graph).to(self.device)
-                classification_statistics = LocalPRBCD.classification_statistics(
-                    logits, self.labels[node_idx].to(self.device))
+                do_evaluate = self._do_evaluate(epoch)
+                if do_evaluate:
+                    perturbed_graph = self.perturb_graph(node_idx)
+                    logits = self.get_surrogate_logits(node_idx, perturbed_graph).to(self.device)
+                    statistics[epoch] = self._get_statistics(loss, logits, self.labels[node_idx].to(self.device))
+
+                    # The best state is kept on the device (no transfer if the margin improves)
+                    if self.with_early_stopping:
+                        self._update_best_state(statistics[epoch, LocalPRBCD.STATISTICS.index('margin')], epoch)
+
                 if epoch % self.display_step == 0:
-                    logging.info(f'\nEpoch: {epoch} Loss: {loss.item()} Statstics: {classification_statistics}\n')
+                    # The statistics of the other epochs would be the ones of the last evaluated epoch
+                    message = f'Loss: {loss.item()}'
+                    if do_evaluate:
+                        message += f' Statstics: {dict(zip(LocalPRBCD.STATISTICS[2:], statistics[epoch, 2:].tolist()))}'
+                    logging.info(f'\nEpoch: {epoch} {message}\n')
                     logging.info(f"Gradient mean {gradient.abs().mean().item()} std {gradient.abs().std().item()} "
                                  f"with base learning rate {n_perturbations * self.lr_factor}")
                     if torch.cuda.is_available():
                         logging.info(f'Cuda memory {torch.cuda.memory_allocated() / (1024 ** 3)}')
 
-                if self.with_early_stopping and best_margin > classification_statistics['margin']:
-                    best_margin = classification_statistics['margin']
-                    best_epoch = epoch
-                    best_search_space = self.current_search_space.clone().cpu()
-                    best_edge_weight_diff = self.modified_edge_weight_diff.detach().clone().cpu()
-
-                self._append_attack_statistics(loss.item(), classification_statistics)
-
                 if epoch < self.epochs_resampling - 1:
                     self.resample_search_space(node_idx, n_perturbations, gradient)
                 elif self.with_early_stopping and epoch == self.epochs_resampling - 1:
-                    logging.info(
-                        f'Loading search space of epoch {best_epoch} (margin={best_margin}) for fine tuning\n')
-                    self.current_search_space = best_search_space.clone().to(self.device)
-                    self.modified_edge_weight_diff = best_edge_weight_diff.clone().to(self.device)
+                    self._load_best_state()
 
             del logits
             del loss
             del gradient
 
+        evaluated_epochs = [epoch for epoch in range(self.epochs) if self._do_evaluate(epoch)]
+        self._set_attack_statistics(LocalPRBCD.STATISTICS, statistics[evaluated_epochs], evaluated_epochs)
+
         # For the case that the attack was not successfull
+        best_margin = self._best_state['margin'].item()
         if best_margin > statistics_orig['margin']:
             self.perturbed_edges = torch.tensor([])
             self.adj_adversary = None
             self.attr_adversary = self.attr
+            self._best_state = None
             logging.info(f"Failed to attack node {node_idx} with n_perturbations={n_perturbations}")
             return None
 
         if self.with_early_stopping:
-            self.current_search_space = best_search_space.to(self.device)
-            self.modified_edge_weight_diff = best_edge_weight_diff.to(self.device)
+            self._load_best_state()
+        self._best_state = None
 
         if torch.cuda.is_available() and self.do_synchronize:
             torch.cuda.empty_cache()
@@ -222,22 +235,89 @@ class LocalPRBCD(SparseLocalAttack):
         A_weights[A_weights > 1] = -A_weights[A_weights > 1] + 2
 
         if make_undirected:
-            A_idx, A_weights = to_symmetric(A_idx, A_weights, n, op='max')
+            A_idx, A_weights = LocalPRBCD._mirror_row(A_idx, A_weights, row_idx, n)
 
         return SparseTensor.from_edge_index(A_idx, A_weights, (n, n))
 
+    @staticmethod
+    def _mirror_row(A_idx: torch.Tensor, A_weights: torch.Tensor, row_idx: int,
+                    n: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Symmetrizes a symmetric matrix of which only the row `row_idx` changed. Same as `to_symmetric(A_idx,
+        A_weights, n, op='max')`, but we only combine the row with the respective column (instead of mirroring and
+        coalescing all edges).
+        """
+        is_row = A_idx[0] == row_idx
+        is_col = (A_idx[1] == row_idx) & ~is_row
+
+        row_edge_index, row_weights = torch_sparse.coalesce(
+            torch.cat((A_idx[:, is_row], A_idx[:, is_col].flip(0)), dim=-1),
+            torch.cat((A_weights[is_row], A_weights[is_col])),
+            m=n, n=n, op='max'
+        )
+        is_off_diagonal = row_edge_index[1] != row_idx
+
+        is_unchanged = ~(is_row | is_col)
+        A_idx = torch.cat((A_idx[:, is_unchanged], row_edge_index, row_edge_index[:, is_off_diagonal].flip(0)), dim=-1)
+        A_weights = torch.cat((A_weights[is_unchanged], row_weights, row_weights[is_off_diagonal]))
+        return A_idx, A_weights
+
     def update_edge_weights(self, n_perturbations: int, epoch: int, gradient: torch.Tensor):
         lr_factor = n_perturbations * self.lr_factor
         lr = lr_factor / np.sqrt(max(0, epoch - self.epochs_resampling) + 1)
         self.modified_edge_weight_diff.data.add_(lr * gradient)
 
-    def _append_attack_statistics(self, loss, statistics):
-        self.attack_statistics['loss'].append(loss)
-        self.attack_statistics['perturbation_mass'].append(
-            torch.clamp(self.modified_edge_weight_diff, 0, 1).sum().item()
+    def _get_statistics(self, loss: torch.Tensor, logits: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
+        """Attack statistics (see `STATISTICS`) as tensor without synchronizing the device. Same as
+        `classification_statistics` for the classification statistics.
+        """
+        log_probs = torch.log_softmax(logits[0], dim=-1)
+        logit_target = log_probs[label]
+        logit_best_non_target = log_probs.masked_fill(
+            torch.arange(log_probs.size(0), device=log_probs.device) == label, float('-Inf')).max()
+        confidence_target, confidence_non_target = logit_target.exp(), logit_best_non_target.exp()
+        return torch.stack([
+            loss.detach().float(), torch.clamp(self.modified_edge_weight_diff, 0, 1).sum(), logit_target,
+            logit_best_non_target, confidence_target, confidence_non_target, confidence_target - confidence_non_target
+        ])
+
+    def _init_best_state(self):
+        """Preallocated buffers on the device for the best state (for early stopping, see `PRBCD._init_best_state`).
+        """
+        self._best_state = dict(
+            margin=torch.tensor(float('Inf'), device=self.device),
+            epoch=torch.tensor(-1, device=self.device),
+            size=torch.tensor(0, device=self.device),
+            search_space=torch.zeros(self.block_size, dtype=torch.long, device=self.device),
+            edge_weight_diff=torch.zeros(self.block_size, dtype=torch.float, device=self.device)
         )
-        for key, value in statistics.items():
-            self.attack_statistics[key].append(value)
+
+    def _update_best_state(self, margin: torch.Tensor, epoch: int):
+        """Updates the best state if `margin` improved without synchronizing the device.
+        """
+        best_state = self._best_state
+        is_better = margin < best_state['margin']
+        size = self.current_search_space.size(0)
+
+        best_state['margin'] = torch.where(is_better, margin, best_state['margin'])
+        best_state['epoch'] = torch.where(is_better, torch.full_like(best_state['epoch'], epoch), best_state['epoch'])
+        best_state['size'] = torch.where(is_better, torch.full_like(best_state['size'], size), best_state['size'])
+        for key, value in [('search_space', self.current_search_space),
+                           ('edge_weight_diff', self.modified_edge_weight_diff.detach())]:
+            best_state[key][:size] = torch.where(is_better, value, best_state[key][:size])
+
+    def _load_best_state(self) -> bool:
+        """Restores the best state (if any epoch was monitored).
+        """
+        best_epoch = int(self._best_state['epoch'])
+        if best_epoch < 0:
+            return False
+
+        logging.info(f'Loading search space of epoch {best_epoch} '
+                     f'(margin={self._best_state["margin"].item()}) for fine tuning\n')
+        size = int(self._best_state['size'])
+        self.current_search_space = self._best_state['search_space'][:size].clone()
+        self.modified_edge_weight_diff = self._best_state['edge_weight_diff'][:size].clone()
+        return True
 
     def sample_search_space(self, node_idx: int, n_perturbations: int):
         while True:
@@ -626,7 +626,7 @@ class OriginalNettack:
         self.cooc_constraint = None
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def connected_after(u, v, connected_before, delta):
     if u == v:
         if delta == -1:
@@ -637,7 +637,7 @@ def connected_after(u, v, connected_before, delta):
         return connected_before
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def compute_new_a_hat_uv(edge_ixs, node_nb_ixs, edges_set, twohop_ixs, values_before, degs, potential_edges, u):
     """
     Compute the new values [A_hat_square]_u for every potential edge, where u is the target node. C.f. Theorem 5.1
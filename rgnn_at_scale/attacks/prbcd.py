@@ -1,24 +1,61 @@
 import logging
 
-from collections import defaultdict
 import math
-from typing import Tuple
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar, Union
 
 from tqdm import tqdm
 import numpy as np
 import torch
-import torch_sparse
 from torch_sparse import SparseTensor
 
 # from rgnn_at_scale.models import MODEL_TYPE
 from rgnn_at_scale.helper import utils
+from rgnn_at_scale.helper.memmap_csr import MemmapCSR
+from rgnn_at_scale.helper.undirected_adjacency import UndirectedAdjacency
 from rgnn_at_scale.attacks.base_attack import Attack, SparseAttack
+from rgnn_at_scale.models.gcn import IncrementalNormalization
+
+T = TypeVar('T')
+
+
+class FuseEdges(torch.autograd.Function):
+    """Adds the block's weights to the clean edge weights (at the positions of `utils.sorted_merge_positions`) and
+    flips merged weights `w > 1` to `2 - w` (i.e. removes existing edges). The backward pass is a gather that only
+    requires the block's positions and flipped mask (instead of recomputing the merge, e.g. with checkpointing).
+    """
+
+    @staticmethod
+    def forward(ctx, block_edge_weight: torch.Tensor, edge_weight: torch.Tensor, merged_pos: torch.Tensor,
+                block_merged_pos: torch.Tensor, n_merged: int) -> torch.Tensor:
+        merged_edge_weight = torch.zeros(n_merged, dtype=edge_weight.dtype, device=edge_weight.device)
+        merged_edge_weight[merged_pos] = edge_weight
+        merged_edge_weight.index_add_(0, block_merged_pos, block_edge_weight)
+
+        is_flipped = merged_edge_weight > 1
+        merged_edge_weight[is_flipped] = 2 - merged_edge_weight[is_flipped]
+
+        ctx.save_for_backward(block_merged_pos, is_flipped[block_merged_pos])
+        return merged_edge_weight
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:
+        block_merged_pos, is_block_flipped = ctx.saved_tensors
+        grad_block_edge_weight = grad_output[block_merged_pos]
+        grad_block_edge_weight = torch.where(is_block_flipped, -grad_block_edge_weight, grad_block_edge_weight)
+        return grad_block_edge_weight, None, None, None, None
 
 
 class PRBCD(SparseAttack):
     """Sampled and hence scalable PGD attack for graph data.
     """
 
+    STATISTICS = ['loss', 'accuracy', 'nonzero_weights', 'probability_mass_update', 'probability_mass_projected']
+    SUPPORTS_CHECKPOINTS = True
+    # The gradient is not restricted to the block if its nodes exceed this fraction (see `_get_gradient_node_idx`)
+    MAX_RESTRICTED_NODE_FRACTION = 0.5
+    # Rounds of rejection sampling before the remaining edges of the block are drawn from a bitmap
+    MAX_SAMPLING_ROUNDS = 10
+
     def __init__(self,
                  keep_heuristic: str = 'WeightOnly',
                  lr_factor: float = 100,
@@ -30,6 +67,15 @@ class PRBCD(SparseAttack):
                  do_synchronize: bool = False,
                  eps: float = 1e-7,
                  max_final_samples: int = 20,
+                 with_incremental_monitoring: bool = False,
+                 with_block_restricted_gradient: bool = False,
+                 with_incremental_normalization: bool = False,
+                 eval_step: int = 1,
+                 eval_from_epoch: int = 0,
+                 final_samples_memory_budget: Optional[int] = None,
+                 max_oom_backoffs: int = 0,
+                 compact_indices: bool = False,
+                 with_undirected_adjacency: bool = False,
                  **kwargs):
         super().__init__(**kwargs)
 
@@ -43,69 +89,141 @@ class PRBCD(SparseAttack):
         self.eps = eps
         self.do_synchronize = do_synchronize
         self.max_final_samples = max_final_samples
+        # Only recalculate the rows of robust aggregations that changed in the monitoring pass (see `RGNN`)
+        self.with_incremental_monitoring = with_incremental_monitoring
+        # Only calculate the gradient towards the edge weights incident to the block (see `_get_gradient_node_idx`)
+        self.with_block_restricted_gradient = with_block_restricted_gradient
+        # Only renormalize the edges incident to the block (see `IncrementalNormalization`)
+        self.with_incremental_normalization = with_incremental_normalization
+        # Monitor (and track the best state) every `eval_step` epochs starting from epoch `eval_from_epoch`
+        self.eval_step = eval_step
+        self.eval_from_epoch = eval_from_epoch
+        # Evaluate multiple final samples at once (as block-diagonal copies) within this budget (in bytes)
+        self.final_samples_memory_budget = final_samples_memory_budget
+        # Number of times the chunks are doubled / block is halved if an epoch runs out of memory (see `_backoff`)
+        self.max_oom_backoffs = max_oom_backoffs
+        # The parameters adjusted due to running out of memory
+        self.adjusted_params: Dict[str, Any] = {}
+        # Store the clean and block's edge indices as int32 if the nodes fit. The cached linear indices `row * n + col`
+        # (see `_get_sorted_clean_edges` and `_get_block_indices`) are int32 if `n * n` fits. The merged indices of the
+        # perturbed graph are cast to int64 in each forward pass (as required by `torch_sparse` and `torch_scatter`)
+        self.compact_indices = compact_indices
+        self._lin_idx_dtype = utils.get_index_dtype(self.n ** 2 - 1, compact_indices)
 
         self.current_search_space: torch.Tensor = None
         self.modified_edge_index: torch.Tensor = None
         self.perturbed_edge_weight: torch.Tensor = None
+        self._sorted_clean_edges: Tuple[torch.Tensor, ...] = None
+        self._block_indices: Tuple[torch.Tensor, ...] = None
+        self._incremental_normalization: IncrementalNormalization = None
+        # The clean edges of a memory-mapped adjacency matrix are streamed by the model (see `GCN._forward_streamed`)
+        self.is_out_of_core = isinstance(self.adj, MemmapCSR)
+        self._block_clean_edge_weight: Tuple[torch.Tensor, ...] = None
+        # Only keep the upper triangle of the clean edges and fuse the block without mirroring it. The model obtains
+        # an `UndirectedAdjacency` (e.g. see `GCN._forward_undirected`)
+        self.with_undirected_adjacency = with_undirected_adjacency and not self.is_out_of_core
+        assert not self.with_undirected_adjacency or self.make_undirected, \
+            'An undirected adjacency matrix requires `make_undirected=True`'
+
+        if self.with_undirected_adjacency:
+            is_triu = self.edge_index[0] <= self.edge_index[1]
+            self.edge_index, self.edge_weight = self.edge_index[:, is_triu], self.edge_weight[is_triu]
+        if self.compact_indices and self.edge_index is not None:
+            self.edge_index = utils.compact_index(self.edge_index, self.n - 1)
 
         if self.make_undirected:
             self.n_possible_edges = self.n * (self.n - 1) // 2
         else:
             self.n_possible_edges = self.n ** 2  # We filter self-loops later
 
-        self.lr_factor = lr_factor * max(math.log2(self.n_possible_edges / self.block_size), 1.)
+        # The learning rate factor depends on the block size (which might be adjusted, see `_backoff`)
+        self.base_lr_factor = lr_factor
+        self.lr_factor = self._get_lr_factor()
 
-    def _attack(self, n_perturbations, **kwargs):
+    def _attack(self, n_perturbations, checkpoint_step: Optional[int] = None,
+                save_checkpoint: Optional[Callable[[Dict[str, Any]], None]] = None,
+                checkpoint: Optional[Dict[str, Any]] = None, **kwargs):
         """Perform attack (`n_perturbations` is increasing as it was a greedy attack).
 
         Parameters
         ----------
         n_perturbations : int
             Number of edges to be perturbed (assuming an undirected graph)
+        checkpoint_step : int, optional
+            Every `checkpoint_step` epochs the state of the attack is passed to `save_checkpoint`, by default None.
+        save_checkpoint : Callable[[Dict[str, Any]], None], optional
+            Persists a checkpoint (e.g. via `Storage.save_artifact`), by default None.
+        checkpoint : Dict[str, Any], optional
+            Resumes the attack from this checkpoint (same results as without interruption), by default None.
         """
         assert self.block_size > n_perturbations, \
             f'The search space size ({self.block_size}) must be ' \
             + f'greater than the number of permutations ({n_perturbations})'
 
         # For early stopping (not explicitly covered by pesudo code)
-        best_accuracy = float('Inf')
-        best_epoch = float('-Inf')
+        self._init_best_state()
 
-        # For collecting attack statistics
-        self.attack_statistics = defaultdict(list)
+        # For collecting attack statistics (kept on the device and transferred once after the attack). The first row
+        # is the clean graph and the row `epoch + 1` is only filled if we evaluate the epoch (see `_do_evaluate`)
+        statistics = torch.full((self.epochs + 1, len(PRBCD.STATISTICS)), float('nan'), device=self.device)
 
-        # Sample initial search space (Algorithm 1, line 3-4)
-        self.sample_random_block(n_perturbations)
+        if checkpoint is None:
+            start_epoch = 0
+            # Sample initial search space (Algorithm 1, line 3-4)
+            self.sample_random_block(n_perturbations)
+        else:
+            start_epoch = self._load_checkpoint(checkpoint, statistics)
+            logging.info(f'Resuming the attack from epoch {start_epoch}')
+
+        do_incremental = (self.with_incremental_monitoring
+                          and hasattr(self.attacked_model, 'activate_incremental_aggregation'))
+        if do_incremental:
+            self.attacked_model.activate_incremental_aggregation()
+        # The monitored graphs only differ from the clean graph at the edges incident to the block's endpoints
+        do_set_changed_nodes = do_incremental and hasattr(self.attacked_model, 'set_changed_nodes')
+        do_restrict_gradient = (self.with_block_restricted_gradient
+                                and hasattr(self.attacked_model, 'restrict_edge_weight_gradient'))
+        if (
+            self.with_incremental_normalization
+            and not self.is_out_of_core
+            and not self.with_undirected_adjacency
+            and hasattr(self.attacked_model, 'supports_normalized_input')
+            and self.attacked_model.supports_normalized_input()
+        ):
+            lin_idx, edge_weight = self._get_sorted_clean_edges()
+            self._incremental_normalization = IncrementalNormalization(
+                lin_idx.long(), edge_weight, self.n, self.attacked_model.add_self_loops, self.attacked_model.row_norm,
+                self.make_undirected
+            )
 
         # Accuracy and attack statistics before the attach even started
-        with torch.no_grad():
-            logits = self._get_logits(self.attr, self.edge_index, self.edge_weight)
-            loss = self.calculate_loss(logits[self.idx_attack], self.labels[self.idx_attack])
-            accuracy = utils.accuracy(logits, self.labels, self.idx_attack)
+        if checkpoint is None:
+            with torch.no_grad():
+                if do_set_changed_nodes:
+                    self.attacked_model.set_changed_nodes(torch.zeros(0, dtype=torch.long, device=self.device))
+                logits = self._get_clean_logits()
+                loss = self.calculate_loss(logits[self.idx_attack], self.labels[self.idx_attack])
+                accuracy = utils.accuracy(logits, self.labels, self.idx_attack)
 
-            logging.info(f'\nBefore the attack - Loss: {loss.item()} Accuracy: {100 * accuracy:.3f} %\n')
+                logging.info(f'\nBefore the attack - Loss: {loss.item()} Accuracy: {100 * accuracy:.3f} %\n')
 
-            self._append_attack_statistics(loss.item(), accuracy, 0., 0.)
+                statistics[0] = self._get_statistics(loss, accuracy, 0., 0.)
 
-            del logits, loss
+                del logits, loss
 
         # Loop over the epochs (Algorithm 1, line 5)
-        for epoch in tqdm(range(self.epochs)):
+        for epoch in tqdm(range(start_epoch, self.epochs)):
             self.perturbed_edge_weight.requires_grad = True
 
-            # Retreive sparse perturbed adjacency matrix `A \oplus p_{t-1}` (Algorithm 1, line 6)
-            edge_index, edge_weight = self.get_modified_adj()
+            if do_restrict_gradient:
+                self.attacked_model.restrict_edge_weight_gradient(self._get_gradient_node_idx())
 
             if torch.cuda.is_available() and self.do_synchronize:
                 torch.cuda.empty_cache()
                 torch.cuda.synchronize()
 
-            # Calculate logits for each node (Algorithm 1, line 6)
-            logits = self._get_logits(self.attr, edge_index, edge_weight)
-            # Calculate loss combining all each node (Algorithm 1, line 7)
-            loss = self.calculate_loss(logits[self.idx_attack], self.labels[self.idx_attack])
-            # Retreive gradient towards the current block (Algorithm 1, line 7)
-            gradient = utils.grad_with_checkpoint(loss, self.perturbed_edge_weight)[0]
+            # Loss and gradient towards the current block (Algorithm 1, line 6-7)
+            loss, gradient = self._with_oom_backoff(self._get_loss_and_gradient, n_perturbations)
 
             if torch.cuda.is_available() and self.do_synchronize:
                 torch.cuda.empty_cache()
@@ -113,60 +231,75 @@ class PRBCD(SparseAttack):
 
             with torch.no_grad():
                 # Gradient update step (Algorithm 1, line 7)
-                edge_weight = self.update_edge_weights(n_perturbations, epoch, gradient)[1]
+                self.update_edge_weights(n_perturbations, epoch, gradient)
                 # For monitoring
-                probability_mass_update = self.perturbed_edge_weight.sum().item()
+                probability_mass_update = self.perturbed_edge_weight.sum()
                 # Projection to stay within relaxed `L_0` budget (Algorithm 1, line 8)
                 self.perturbed_edge_weight = Attack.project(
                     n_perturbations, self.perturbed_edge_weight, self.eps)
                 # For monitoring
-                probability_mass_projected = self.perturbed_edge_weight.sum().item()
+                probability_mass_projected = self.perturbed_edge_weight.sum()
 
                 # Calculate accuracy after the current epoch (overhead for monitoring and early stopping)
-                edge_index, edge_weight = self.get_modified_adj()
-                logits = self.attacked_model(data=self.attr.to(self.device), adj=(edge_index, edge_weight))
-                accuracy = utils.accuracy(logits, self.labels, self.idx_attack)
-                del edge_index, edge_weight, logits
+                do_evaluate = self._do_evaluate(epoch)
+                if do_evaluate:
+                    if do_set_changed_nodes:
+                        self.attacked_model.set_changed_nodes(self.modified_edge_index.flatten().unique().long(),
+                                                              self.make_undirected)
+                    logits = self._with_oom_backoff(self._get_modified_logits, n_perturbations)
+                    accuracy = PRBCD._accuracy(logits, self.labels, self.idx_attack)
+                    del logits
+
+                    # Save best epoch for early stopping (not explicitly covered by pesudo code)
+                    if self.with_early_stopping:
+                        self._update_best_state(accuracy, epoch)
+
+                    statistics[epoch + 1] = self._get_statistics(loss, accuracy, probability_mass_update,
+                                                                 probability_mass_projected)
 
                 if epoch % self.display_step == 0:
-                    logging.info(f'\nEpoch: {epoch} Loss: {loss} Accuracy: {100 * accuracy:.3f} %\n')
-
-                # Save best epoch for early stopping (not explicitly covered by pesudo code)
-                if self.with_early_stopping and best_accuracy > accuracy:
-                    best_accuracy = accuracy
-                    best_epoch = epoch
-                    best_search_space = self.current_search_space.clone().cpu()
-                    best_edge_index = self.modified_edge_index.clone().cpu()
-                    best_edge_weight_diff = self.perturbed_edge_weight.detach().clone().cpu()
-
-                self._append_attack_statistics(loss, accuracy, probability_mass_update, probability_mass_projected)
+                    # The accuracy of the other epochs would be the one of the last evaluated epoch
+                    accuracy_message = f' Accuracy: {100 * float(accuracy):.3f} %' if do_evaluate else ''
+                    logging.info(f'\nEpoch: {epoch} Loss: {loss.item()}{accuracy_message}\n')
 
                 # Resampling of search space (Algorithm 1, line 9-14)
                 if epoch < self.epochs_resampling - 1:
                     self.resample_random_block(n_perturbations)
                 elif self.with_early_stopping and epoch == self.epochs_resampling - 1:
                     # Retreive best epoch if early stopping is active (not explicitly covered by pesudo code)
-                    logging.info(
-                        f'Loading search space of epoch {best_epoch} (accuarcy={best_accuracy}) for fine tuning\n')
-                    self.current_search_space = best_search_space.to(self.device)
-                    self.modified_edge_index = best_edge_index.to(self.device)
-                    self.perturbed_edge_weight = best_edge_weight_diff.to(self.device)
-                    self.perturbed_edge_weight.requires_grad = True
+                    if self._load_best_state():
+                        self.perturbed_edge_weight.requires_grad = True
+
+            if save_checkpoint is not None and checkpoint_step and (epoch + 1) % checkpoint_step == 0:
+                save_checkpoint(self._get_checkpoint(epoch + 1, statistics))
+
+        if do_incremental:
+            self.attacked_model.deactivate_incremental_aggregation()
+        if do_restrict_gradient:
+            self.attacked_model.restrict_edge_weight_gradient(None)
+
+        # Epoch -1 denotes the clean graph before the attack
+        evaluated_epochs = [epoch for epoch in range(self.epochs) if self._do_evaluate(epoch)]
+        self._set_attack_statistics(PRBCD.STATISTICS, statistics[[0] + [epoch + 1 for epoch in evaluated_epochs]],
+                                    [-1] + evaluated_epochs)
 
         # Retreive best epoch if early stopping is active (not explicitly covered by pesudo code)
         if self.with_early_stopping:
-            self.current_search_space = best_search_space.to(self.device)
-            self.modified_edge_index = best_edge_index.to(self.device)
-            self.perturbed_edge_weight = best_edge_weight_diff.to(self.device)
+            self._load_best_state()
+        self._best_state = None
 
         # Sample final discrete graph (Algorithm 1, line 16)
-        edge_index = self.sample_final_edges(n_perturbations)[0]
+        edge_index, edge_weight = self.sample_final_edges(n_perturbations)
+        self._incremental_normalization = None
 
-        self.adj_adversary = SparseTensor.from_edge_index(
-            edge_index,
-            torch.ones_like(edge_index[0], dtype=torch.float32),
-            (self.n, self.n)
-        ).coalesce().detach()
+        if self.is_out_of_core:
+            self.adj_adversary = self.adj.perturb(edge_index.cpu(), edge_weight.cpu())
+        else:
+            self.adj_adversary = SparseTensor.from_edge_index(
+                edge_index,
+                torch.ones_like(edge_index[0], dtype=torch.float32),
+                (self.n, self.n)
+            ).coalesce().detach()
         self.attr_adversary = self.attr
 
         # TODO: Don't we want to switch to returning things?
@@ -174,16 +307,158 @@ class PRBCD(SparseAttack):
     def _get_logits(self, attr: torch.Tensor, edge_index: torch.Tensor, edge_weight: torch.Tensor):
         return self.attacked_model(
             data=attr.to(self.device),
-            adj=(edge_index.to(self.device), edge_weight.to(self.device))
+            adj=(edge_index.to(self.device).long(), edge_weight.to(self.device))
         )
 
     @torch.no_grad()
     def sample_final_edges(self, n_perturbations: int) -> Tuple[torch.Tensor, torch.Tensor]:
-        best_accuracy = float('Inf')
         perturbed_edge_weight = self.perturbed_edge_weight.detach()
         # TODO: potentially convert to assert
         perturbed_edge_weight[perturbed_edge_weight <= self.eps] = 0
 
+        samples_per_pass = self._get_final_samples_per_pass()
+        if samples_per_pass > 1:
+            best_edges = self._sample_final_edges_batched(n_perturbations, perturbed_edge_weight, samples_per_pass)
+        else:
+            best_edges = self._sample_final_edges_sequential(n_perturbations, perturbed_edge_weight)
+
+        # Recover best sample
+        self.perturbed_edge_weight = best_edges.to(self.device)
+        return self._get_final_edges(n_perturbations)
+
+    def _get_final_edges(self, n_perturbations: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Edges of the perturbed graph for a discrete (sampled) block. For a memory-mapped adjacency matrix, only the
+        perturbed edges and the differences of their weights are returned (see `MemmapCSR.perturb`).
+        """
+        allowed_perturbations = 2 * n_perturbations if self.make_undirected else n_perturbations
+        if self.is_out_of_core:
+            adj = self._get_out_of_core_adj()
+            is_perturbed = adj.perturbed_edge_weight != 0
+            assert is_perturbed.sum() <= allowed_perturbations, \
+                f'{is_perturbed.sum()} perturbed edges out of range with {n_perturbations} pertutbations'
+            return adj.perturbed_edge_index[:, is_perturbed], adj.perturbed_edge_weight[is_perturbed]
+
+        if self.with_undirected_adjacency:
+            # Every edge is only contained once
+            allowed_perturbations = n_perturbations
+
+        edge_index, edge_weight = self._get_fused_edges()
+        edge_mask = edge_weight == 1
+
+        edges_after_attack = edge_mask.sum()
+        clean_edges = self.edge_index.shape[1]
+        assert (edges_after_attack >= clean_edges - allowed_perturbations
+                and edges_after_attack <= clean_edges + allowed_perturbations), \
+            f'{edges_after_attack} out of range with {clean_edges} clean edges and {n_perturbations} pertutbations'
+        edge_index, edge_weight = edge_index[:, edge_mask], edge_weight[edge_mask]
+        if self.with_undirected_adjacency:
+            return UndirectedAdjacency(edge_index, edge_weight, self.n).to_edge_index()
+        return edge_index, edge_weight
+
+    def _get_loss_and_gradient(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Loss and its gradient towards the current block.
+        """
+        # Calculate logits for each node on the sparse perturbed adjacency matrix `A \oplus p_{t-1}`
+        logits = self._get_modified_logits()
+        # Calculate loss combining all each node
+        loss = self.calculate_loss(logits[self.idx_attack], self.labels[self.idx_attack])
+        # Retreive gradient towards the current block
+        gradient = utils.grad_with_checkpoint(loss, self.perturbed_edge_weight)[0]
+        return loss, gradient
+
+    def _get_gradient_node_idx(self) -> Optional[torch.Tensor]:
+        """Nodes incident to the block that the edge weight gradient is restricted to (see
+        `with_block_restricted_gradient`). If they are a large fraction of all nodes (e.g. a large block on a small
+        graph), the restriction barely saves any work but adds the masking. We then do not restrict the gradient (None).
+        """
+        node_idx = self.modified_edge_index.flatten().unique().long()
+        if node_idx.size(0) > PRBCD.MAX_RESTRICTED_NODE_FRACTION * self.n:
+            return None
+        return node_idx
+
+    def _with_oom_backoff(self, step: Callable[[], T], n_perturbations: int) -> T:
+        """Executes `step` and retries it after backing off (see `_backoff`) if it runs out of memory.
+        """
+        while True:
+            try:
+                return step()
+            except (RuntimeError, MemoryError) as error:
+                n_oom_backoffs = self.adjusted_params.get('n_oom_backoffs', 0)
+                if not utils.is_out_of_memory(error) or n_oom_backoffs >= self.max_oom_backoffs:
+                    raise
+                logging.warning(f'Out of memory ({error})')
+            # The memory of the failed step is only released after leaving the `except` clause
+            utils.free_memory()
+            if not self._backoff(n_perturbations):
+                raise RuntimeError('Out of memory even with the smallest possible block')
+
+    def _backoff(self, n_perturbations: int) -> bool:
+        """Reduces the memory requirements of the attack without losing its state. If the model processes the
+        adjacency in chunks we double their number, otherwise we halve the block (keeping the edges with the largest
+        weights).
+
+        Parameters
+        ----------
+        n_perturbations : int
+            Number of perturbations (the block must remain larger).
+
+        Returns
+        -------
+        bool
+            False if no further backoff is possible.
+        """
+        n_chunks = getattr(self.attacked_model, 'n_chunks', None)
+        if getattr(self.attacked_model, 'do_checkpoint', False) and n_chunks is not None and n_chunks < self.n:
+            self._set_n_chunks(2 * n_chunks)
+            self.adjusted_params['n_chunks'] = 2 * n_chunks
+        else:
+            block_size = self.block_size // 2
+            if block_size <= n_perturbations:
+                return False
+            self.block_size = block_size
+            self.lr_factor = self._get_lr_factor()
+            if self.current_search_space is not None and self.current_search_space.size(0) > block_size:
+                requires_grad = self.perturbed_edge_weight.requires_grad
+                keep_idx = torch.topk(self.perturbed_edge_weight.detach(), block_size).indices.sort().values
+                self.current_search_space = self.current_search_space[keep_idx]
+                self.modified_edge_index = self.modified_edge_index[:, keep_idx]
+                self.perturbed_edge_weight = self.perturbed_edge_weight.detach()[keep_idx]
+                self.perturbed_edge_weight.requires_grad = requires_grad
+            self.adjusted_params['block_size'] = block_size
+
+        self.adjusted_params['n_oom_backoffs'] = self.adjusted_params.get('n_oom_backoffs', 0) + 1
+        logging.warning(f'Retrying with adjusted parameters {self.adjusted_params}')
+        return True
+
+    def _get_lr_factor(self) -> float:
+        """Learning rate factor for the current block size.
+        """
+        return self.base_lr_factor * max(math.log2(self.n_possible_edges / self.block_size), 1.)
+
+    def _set_n_chunks(self, n_chunks: int):
+        """Sets the number of chunks of all modules that process the adjacency matrix in chunks.
+        """
+        for module in self.attacked_model.modules():
+            if hasattr(module, 'n_chunks'):
+                module.n_chunks = n_chunks
+
+    def _get_adjusted_params_checkpoint(self) -> Dict[str, Any]:
+        """The parameters adjusted due to running out of memory (see `_backoff`) for a checkpoint.
+        """
+        return dict(block_size=self.block_size, adjusted_params=dict(self.adjusted_params))
+
+    def _load_adjusted_params_checkpoint(self, checkpoint: Dict[str, Any]):
+        """Restores the parameters adjusted due to running out of memory (see `_get_adjusted_params_checkpoint`).
+        """
+        self.block_size = checkpoint['block_size']
+        self.lr_factor = self._get_lr_factor()
+        self.adjusted_params = dict(checkpoint['adjusted_params'])
+        if 'n_chunks' in self.adjusted_params:
+            self._set_n_chunks(self.adjusted_params['n_chunks'])
+
+    def _sample_final_edges_sequential(self, n_perturbations: int,
+                                       perturbed_edge_weight: torch.Tensor) -> torch.Tensor:
+        best_accuracy = float('Inf')
         for i in range(self.max_final_samples):
             if best_accuracy == float('Inf'):
                 # In first iteration employ top k heuristic instead of sampling
@@ -198,86 +473,209 @@ class PRBCD(SparseAttack):
                 continue
             self.perturbed_edge_weight = sampled_edges
 
-            edge_index, edge_weight = self.get_modified_adj()
-            logits = self._get_logits(self.attr, edge_index, edge_weight)
+            logits = self._get_modified_logits()
             accuracy = utils.accuracy(logits, self.labels, self.idx_attack)
 
             # Save best sample
             if best_accuracy > accuracy:
                 best_accuracy = accuracy
                 best_edges = self.perturbed_edge_weight.clone().cpu()
+        return best_edges
 
-        # Recover best sample
-        self.perturbed_edge_weight.data.copy_(best_edges.to(self.device))
-
-        edge_index, edge_weight = self.get_modified_adj()
-        edge_mask = edge_weight == 1
+    def _sample_final_edges_batched(self, n_perturbations: int, perturbed_edge_weight: torch.Tensor,
+                                    samples_per_pass: int) -> torch.Tensor:
+        """Same as `_sample_final_edges_sequential` but evaluates up to `samples_per_pass` samples in one forward pass
+        (see `_get_batched_accuracy`).
+        """
+        best_accuracy = float('Inf')
+        for offset in range(0, self.max_final_samples, samples_per_pass):
+            n_samples = min(samples_per_pass, self.max_final_samples - offset)
+            sampled_edges = torch.bernoulli(perturbed_edge_weight.repeat(n_samples, 1))
+            if offset == 0:
+                # In first iteration employ top k heuristic instead of sampling
+                sampled_edges[0] = 0
+                sampled_edges[0, torch.topk(perturbed_edge_weight, n_perturbations).indices] = 1
+
+            is_within_budget = sampled_edges.sum(-1) <= n_perturbations
+            sampled_edges = sampled_edges[is_within_budget]
+            if sampled_edges.size(0) < n_samples:
+                logging.info(f'{offset}-th to {offset + n_samples - 1}-th sampling: '
+                             f'{n_samples - sampled_edges.size(0)} with too many samples')
+            if sampled_edges.size(0) == 0:
+                continue
 
-        allowed_perturbations = 2 * n_perturbations if self.make_undirected else n_perturbations
-        edges_after_attack = edge_mask.sum()
-        clean_edges = self.edge_index.shape[1]
-        assert (edges_after_attack >= clean_edges - allowed_perturbations
-                and edges_after_attack <= clean_edges + allowed_perturbations), \
-            f'{edges_after_attack} out of range with {clean_edges} clean edges and {n_perturbations} pertutbations'
-        return edge_index[:, edge_mask], edge_weight[edge_mask]
+            accuracy = self._get_batched_accuracy(sampled_edges)
+            best_sample = accuracy.argmin()
 
-    def get_modified_adj(self):
+            # Save best sample
+            if best_accuracy > accuracy[best_sample].item():
+                best_accuracy = accuracy[best_sample].item()
+                best_edges = sampled_edges[best_sample].clone().cpu()
+        return best_edges
+
+    def _get_batched_accuracy(self, sampled_edges: torch.Tensor) -> torch.Tensor:
+        """Accuracy for each of the sampled blocks (rows of `sampled_edges`) with a single forward pass. For this, the
+        perturbed graphs are stacked as block-diagonal copies (i.e. we assume that the nodes only interact along edges).
+        """
+        n_samples = sampled_edges.size(0)
+        perturbed_edge_weight = self.perturbed_edge_weight
+
+        edge_indices, edge_weights = [], []
+        for i in range(n_samples):
+            self.perturbed_edge_weight = sampled_edges[i]
+            edge_index, edge_weight, is_normalized = self._get_modified_graph()
+            edge_indices.append(edge_index + i * self.n)
+            edge_weights.append(edge_weight)
+        self.perturbed_edge_weight = perturbed_edge_weight
+
+        attr = self.attr.to(self.device).repeat(n_samples, 1)
+        logits = self._get_graph_logits(attr, torch.cat(edge_indices, dim=-1), torch.cat(edge_weights), is_normalized)
+        logits = logits.view(n_samples, self.n, -1)
+        return (logits.argmax(-1)[:, self.idx_attack] == self.labels[self.idx_attack]).float().mean(-1)
+
+    def _get_final_samples_per_pass(self) -> int:
+        """Number of final samples that are evaluated at once given `final_samples_memory_budget`. We estimate the
+        memory per sample with the size of its copy of the features, (perturbed) edges and activations. Only local
+        models (see `GCN.receptive_field_hops`) support the block-diagonal copies of `_get_batched_accuracy`, since
+        e.g. the low-rank SVD or the PPR matrix of the stacked graph differ from the ones of the individual copies.
+        """
+        if self.final_samples_memory_budget is None or self.is_out_of_core:
+            return 1
         if (
-            not self.perturbed_edge_weight.requires_grad
-            or not hasattr(self.attacked_model, 'do_checkpoint')
-            or not self.attacked_model.do_checkpoint
+            not hasattr(self.attacked_model, 'receptive_field_hops')
+            or self.attacked_model.receptive_field_hops() is None
         ):
-            if self.make_undirected:
-                modified_edge_index, modified_edge_weight = utils.to_symmetric(
-                    self.modified_edge_index, self.perturbed_edge_weight, self.n
-                )
-            else:
-                modified_edge_index, modified_edge_weight = self.modified_edge_index, self.perturbed_edge_weight
-            edge_index = torch.cat((self.edge_index.to(self.device), modified_edge_index), dim=-1)
-            edge_weight = torch.cat((self.edge_weight.to(self.device), modified_edge_weight))
-
-            edge_index, edge_weight = torch_sparse.coalesce(edge_index, edge_weight, m=self.n, n=self.n, op='sum')
-        else:
-            # TODO: test with pytorch 1.9.0
-            # Currently (1.6.0) PyTorch does not support return arguments of `checkpoint` that do not require gradient.
-            # For this reason we need this extra code and to execute it twice (due to checkpointing in fact 3 times...)
-            from torch.utils import checkpoint
-
-            def fuse_edges_run(perturbed_edge_weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-                if self.make_undirected:
-                    modified_edge_index, modified_edge_weight = utils.to_symmetric(
-                        self.modified_edge_index, perturbed_edge_weight, self.n
-                    )
-                else:
-                    modified_edge_index, modified_edge_weight = self.modified_edge_index, self.perturbed_edge_weight
-                edge_index = torch.cat((self.edge_index.to(self.device), modified_edge_index), dim=-1)
-                edge_weight = torch.cat((self.edge_weight.to(self.device), modified_edge_weight))
-
-                edge_index, edge_weight = torch_sparse.coalesce(edge_index, edge_weight, m=self.n, n=self.n, op='sum')
-                return edge_index, edge_weight
-
-            # Hack: for very large graphs the block needs to be added on CPU to save memory
-            if len(self.edge_weight) > 100_000_000:
-                device = self.device
-                self.device = 'cpu'
-                self.modified_edge_index = self.modified_edge_index.to(self.device)
-                edge_index, edge_weight = fuse_edges_run(self.perturbed_edge_weight.cpu())
-                self.device = device
-                self.modified_edge_index = self.modified_edge_index.to(self.device)
-                return edge_index.to(self.device), edge_weight.to(self.device)
+            return 1
+        n_edges = self.edge_index.size(1) + (2 if self.make_undirected else 1) * self.block_size
+        n_activations = sum(getattr(self.attacked_model, 'n_filters', [])) + self.attacked_model.n_classes
+        # Features and activations as float and edge indices (two long) as well as weights (float)
+        bytes_per_sample = 4 * self.n * (self.d + n_activations) + 20 * n_edges
+        return int(min(max(self.final_samples_memory_budget // bytes_per_sample, 1), self.max_final_samples))
 
-            with torch.no_grad():
-                edge_index = fuse_edges_run(self.perturbed_edge_weight)[0]
+    def get_modified_adj(self):
+        edge_index, edge_weight = self._get_fused_edges()
+        if self.with_undirected_adjacency:
+            return UndirectedAdjacency(edge_index, edge_weight, self.n).to_edge_index()
+        return edge_index, edge_weight
 
-            edge_weight = checkpoint.checkpoint(
-                lambda *input: fuse_edges_run(*input)[1],
-                self.perturbed_edge_weight
-            )
+    def _get_fused_edges(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Edges and weights of the perturbed graph (only the upper triangle if `with_undirected_adjacency`).
+        """
+        lin_idx, edge_weight = self._fuse_block()[::3]
+        edge_index = torch.stack((lin_idx // self.n, lin_idx % self.n))
+        return edge_index, edge_weight
 
-        # Allow removal of edges
-        edge_weight[edge_weight > 1] = 2 - edge_weight[edge_weight > 1]
+    def _fuse_block(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Merges the block into the clean edges and returns the merged linear indices (as int64), the positions of
+        the clean edges, the positions of the block and the merged edge weights.
+        """
+        modified_edge_weight = self.perturbed_edge_weight
+        block_lin_idx, sort_idx = self._get_block_indices()
+        if sort_idx is not None:
+            modified_edge_weight = modified_edge_weight.repeat(2)[sort_idx]
+
+        lin_idx, edge_weight = self._get_sorted_clean_edges()
+        # The merge is performed on the (possibly compacted) cached indices
+        lin_idx, merged_pos, block_merged_pos = utils.sorted_merge_positions(lin_idx, block_lin_idx)
+        lin_idx = lin_idx.long()
+        # Also allows the removal of edges
+        edge_weight = FuseEdges.apply(modified_edge_weight, edge_weight, merged_pos, block_merged_pos,
+                                      lin_idx.size(0))
+        return lin_idx, merged_pos, block_merged_pos, edge_weight
+
+    def _get_block_indices(self) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """The block's sorted linear indices (int32 if `compact_indices` and `n * n` fits) and the order of the
+        mirrored weights (None if the block is not mirrored, int32 if `compact_indices`). They are only recalculated if
+        the block changes, i.e. a compacted block is cast once per block and not in every forward pass.
+        """
+        if self._block_indices is None or self._block_indices[0] is not self.modified_edge_index:
+            edge_index = self.modified_edge_index.long()
+            lin_idx = edge_index[0] * self.n + edge_index[1]
+            sort_idx = None
+            if self.make_undirected and not self.with_undirected_adjacency:
+                lin_idx = torch.cat((lin_idx, edge_index[1] * self.n + edge_index[0]))
+                lin_idx, sort_idx = torch.sort(lin_idx)
+                sort_idx = sort_idx.to(utils.get_index_dtype(sort_idx.size(0) - 1, self.compact_indices))
+            # Otherwise, the block is already sorted since the (row-major) search space is
+            self._block_indices = (self.modified_edge_index, lin_idx.to(self._lin_idx_dtype), sort_idx)
+        return self._block_indices[1:]
+
+    def _get_modified_logits(self) -> torch.Tensor:
+        """Logits for the perturbed graph (normalized incrementally if `with_incremental_normalization`).
+        """
+        if self.is_out_of_core:
+            return self.attacked_model(data=self.attr.to(self.device), adj=self._get_out_of_core_adj())
+        if self.with_undirected_adjacency:
+            edge_index, edge_weight = self._get_fused_edges()
+            return self.attacked_model(data=self.attr.to(self.device),
+                                       adj=UndirectedAdjacency(edge_index, edge_weight, self.n))
+        edge_index, edge_weight, is_normalized = self._get_modified_graph()
+        return self._get_graph_logits(self.attr, edge_index, edge_weight, is_normalized)
+
+    def _get_clean_logits(self) -> torch.Tensor:
+        if self.is_out_of_core:
+            return self.attacked_model(data=self.attr.to(self.device), adj=self.adj)
+        if self.with_undirected_adjacency:
+            adj = UndirectedAdjacency(self.edge_index.to(self.device), self.edge_weight.to(self.device), self.n)
+            return self.attacked_model(data=self.attr.to(self.device), adj=adj)
+        return self._get_logits(self.attr, self.edge_index, self.edge_weight)
+
+    def _get_out_of_core_adj(self) -> MemmapCSR:
+        """The memory-mapped adjacency matrix perturbed by the block. Same as `FuseEdges`, but we only keep the
+        differences to the clean edge weights (that are looked up once per block) in memory.
+        """
+        if self._block_clean_edge_weight is None or self._block_clean_edge_weight[0] is not self.current_search_space:
+            modified_edge_index = self.modified_edge_index.long()
+            clean_edge_weight = self.adj.lookup(modified_edge_index).to(self.device)
+            self._block_clean_edge_weight = (self.current_search_space, clean_edge_weight, modified_edge_index)
+        clean_edge_weight, modified_edge_index = self._block_clean_edge_weight[1:]
+
+        merged_edge_weight = clean_edge_weight + self.perturbed_edge_weight
+        merged_edge_weight = torch.where(merged_edge_weight > 1, 2 - merged_edge_weight, merged_edge_weight)
+        edge_weight_diff = merged_edge_weight - clean_edge_weight
+        if self.make_undirected:
+            return self.adj.perturb(torch.cat((modified_edge_index, modified_edge_index.flip(0)), dim=-1),
+                                    edge_weight_diff.repeat(2))
+        return self.adj.perturb(modified_edge_index, edge_weight_diff)
 
-        return edge_index, edge_weight
+    def _get_modified_graph(self) -> Tuple[torch.Tensor, torch.Tensor, bool]:
+        """Edges and weights of the perturbed graph as well as whether they are already normalized.
+        """
+        if self._incremental_normalization is None:
+            edge_index, edge_weight = self.get_modified_adj()
+            return edge_index, edge_weight, False
+
+        lin_idx, merged_pos, block_merged_pos, edge_weight = self._fuse_block()
+        edge_index, edge_weight = self._incremental_normalization.normalize(lin_idx, edge_weight, merged_pos,
+                                                                            block_merged_pos)
+        return edge_index, edge_weight, True
+
+    def _get_graph_logits(self, attr: torch.Tensor, edge_index: torch.Tensor, edge_weight: torch.Tensor,
+                          is_normalized: bool) -> torch.Tensor:
+        if not is_normalized:
+            return self._get_logits(attr, edge_index, edge_weight)
+
+        self.attacked_model.use_normalized_input(True)
+        try:
+            return self._get_logits(attr, edge_index, edge_weight)
+        finally:
+            self.attacked_model.use_normalized_input(False)
+
+    def _get_sorted_clean_edges(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Sorted linear indices (int32 if `compact_indices` and `n * n` fits) and weights of the clean edges that are
+        only recalculated if they change.
+        """
+        if (
+            self._sorted_clean_edges is None
+            or self._sorted_clean_edges[0] is not self.edge_index
+            or self._sorted_clean_edges[1] is not self.edge_weight
+        ):
+            edge_index = self.edge_index.to(self.device).long()
+            lin_idx = edge_index[0] * self.n + edge_index[1]
+            lin_idx, sort_idx = torch.sort(lin_idx)
+            edge_weight = self.edge_weight.to(self.device)[sort_idx]
+            self._sorted_clean_edges = (self.edge_index, self.edge_weight, lin_idx.to(self._lin_idx_dtype), edge_weight)
+        return self._sorted_clean_edges[2].to(self.device), self._sorted_clean_edges[3].to(self.device)
 
     def update_edge_weights(self, n_perturbations: int, epoch: int,
                             gradient: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -297,7 +695,7 @@ class PRBCD(SparseAttack):
         Returns
         -------
         Tuple[torch.Tensor, torch.Tensor]
-            Updated edge indices and weights.
+            Updated edge indices and weights (None for a memory-mapped adjacency matrix).
         """
         lr_factor = n_perturbations / self.n / 2 * self.lr_factor
         lr = lr_factor / np.sqrt(max(0, epoch - self.epochs_resampling) + 1)
@@ -306,27 +704,19 @@ class PRBCD(SparseAttack):
         # We require for technical reasons that all edges in the block have at least a small positive value
         self.perturbed_edge_weight.data[self.perturbed_edge_weight < self.eps] = self.eps
 
+        if self.is_out_of_core:
+            return None
         return self.get_modified_adj()
 
     def sample_random_block(self, n_perturbations: int = 0):
-        for _ in range(self.max_final_samples):
-            self.current_search_space = torch.randint(
-                self.n_possible_edges, (self.block_size,), device=self.device)
-            self.current_search_space = torch.unique(self.current_search_space, sorted=True)
-            if self.make_undirected:
-                self.modified_edge_index = PRBCD.linear_to_triu_idx(self.n, self.current_search_space)
-            else:
-                self.modified_edge_index = PRBCD.linear_to_full_idx(self.n, self.current_search_space)
-                is_not_self_loop = self.modified_edge_index[0] != self.modified_edge_index[1]
-                self.current_search_space = self.current_search_space[is_not_self_loop]
-                self.modified_edge_index = self.modified_edge_index[:, is_not_self_loop]
-
-            self.perturbed_edge_weight = torch.full_like(
-                self.current_search_space, self.eps, dtype=torch.float32, requires_grad=True
-            )
-            if self.current_search_space.size(0) >= n_perturbations:
-                return
-        raise RuntimeError('Sampling random block was not successfull. Please decrease `n_perturbations`.')
+        self.current_search_space = self._sample_new_edges(
+            torch.empty(0, dtype=torch.long, device=self.device), self.block_size)
+        self.modified_edge_index = self._lin_idx_to_edge_index(self.current_search_space)
+        self.perturbed_edge_weight = torch.full_like(
+            self.current_search_space, self.eps, dtype=torch.float32, requires_grad=True
+        )
+        if self.current_search_space.size(0) < n_perturbations:
+            raise RuntimeError('Sampling random block was not successfull. Please decrease `n_perturbations`.')
 
     def resample_random_block(self, n_perturbations: int):
         if self.keep_heuristic == 'WeightOnly':
@@ -338,43 +728,99 @@ class PRBCD(SparseAttack):
         else:
             raise NotImplementedError('Only keep_heuristic=`WeightOnly` supported')
 
-        sorted_idx = sorted_idx[idx_keep:]
-        self.current_search_space = self.current_search_space[sorted_idx]
-        self.modified_edge_index = self.modified_edge_index[:, sorted_idx]
-        self.perturbed_edge_weight = self.perturbed_edge_weight[sorted_idx]
+        # Selecting via a mask retains the (sorted) order of the search space
+        keep_mask = torch.zeros_like(self.current_search_space, dtype=torch.bool)
+        keep_mask[sorted_idx[idx_keep:]] = True
+        search_space = self.current_search_space[keep_mask]
+        perturbed_edge_weight_old = self.perturbed_edge_weight.detach()[keep_mask]
+
+        # Only the missing edges are drawn and merged into the sorted search space (instead of sorting the whole block)
+        new_search_space = self._sample_new_edges(search_space, self.block_size - search_space.size(0))
+        self.current_search_space, keep_pos, _ = utils.sorted_merge_positions(search_space, new_search_space)
+        self.modified_edge_index = self._lin_idx_to_edge_index(self.current_search_space)
+        self.perturbed_edge_weight = torch.full_like(self.current_search_space, self.eps, dtype=torch.float32)
+        self.perturbed_edge_weight[keep_pos] = perturbed_edge_weight_old
+
+        if self.current_search_space.size(0) <= n_perturbations:
+            raise RuntimeError('Sampling random block was not successfull. Please decrease `n_perturbations`.')
+
+    def _sample_new_edges(self, search_space: torch.Tensor, n_edges: int) -> torch.Tensor:
+        """Draws `n_edges` distinct edges (linear indices) uniformly at random that are not in the search space (and no
+        self-loops). Duplicates are removed from the new samples and collisions with the search space are detected via
+        binary search. To fill the block in (typically) a single pass, we oversample by the expected fraction of
+        collisions and subsample the surplus afterwards. If the block covers most of the possible edges, we draw from a
+        bitmap of the remaining edges instead. This is equivalent to sampling with replacement and dropping
+        the duplicates, except that the block is filled completely.
 
-        # Sample until enough edges were drawn
-        for i in range(self.max_final_samples):
-            n_edges_resample = self.block_size - self.current_search_space.size(0)
-            lin_index = torch.randint(self.n_possible_edges, (n_edges_resample,), device=self.device)
-
-            self.current_search_space, unique_idx = torch.unique(
-                torch.cat((self.current_search_space, lin_index)),
-                sorted=True,
-                return_inverse=True
-            )
-
-            if self.make_undirected:
-                self.modified_edge_index = PRBCD.linear_to_triu_idx(self.n, self.current_search_space)
-            else:
-                self.modified_edge_index = PRBCD.linear_to_full_idx(self.n, self.current_search_space)
-
-            # Merge existing weights with new edge weights
-            perturbed_edge_weight_old = self.perturbed_edge_weight.clone()
-            self.perturbed_edge_weight = torch.full_like(self.current_search_space, self.eps, dtype=torch.float32)
-            self.perturbed_edge_weight[
-                unique_idx[:perturbed_edge_weight_old.size(0)]
-            ] = perturbed_edge_weight_old
+        Parameters
+        ----------
+        search_space : torch.Tensor
+            Sorted and unique linear indices of the edges that are kept.
+        n_edges : int
+            Number of edges to draw (at most the number of remaining edges).
 
+        Returns
+        -------
+        torch.Tensor
+            Sorted and unique linear indices of the new edges.
+        """
+        n_invalid = 0 if self.make_undirected else self.n
+        n_edges = min(n_edges, self.n_possible_edges - n_invalid - search_space.size(0))
+
+        # If the block covers most possible edges, we sample from a bitmap of the remaining ones (without rejections)
+        if 2 * (n_invalid + search_space.size(0) + n_edges) > self.n_possible_edges:
+            return self._sample_new_edges_from_bitmap(search_space, n_edges)
+
+        new_search_space = search_space.new_empty(0)
+        for _ in range(self.MAX_SAMPLING_ROUNDS):
+            n_missing = n_edges - new_search_space.size(0)
+            if n_missing <= 0:
+                break
+            # Expected fraction of samples that collide with the drawn edges, duplicates or self-loops
+            n_taken = n_invalid + search_space.size(0) + new_search_space.size(0) + n_missing / 2
+            n_samples = math.ceil(n_missing / max(1 - n_taken / self.n_possible_edges, 0.5))
+
+            lin_idx = torch.randint(self.n_possible_edges, (n_samples,), device=search_space.device)
+            lin_idx = torch.sort(lin_idx).values.unique_consecutive()
+            is_new = ~utils.isin_sorted(lin_idx, search_space) & ~utils.isin_sorted(lin_idx, new_search_space)
             if not self.make_undirected:
-                is_not_self_loop = self.modified_edge_index[0] != self.modified_edge_index[1]
-                self.current_search_space = self.current_search_space[is_not_self_loop]
-                self.modified_edge_index = self.modified_edge_index[:, is_not_self_loop]
-                self.perturbed_edge_weight = self.perturbed_edge_weight[is_not_self_loop]
-
-            if self.current_search_space.size(0) > n_perturbations:
-                return
-        raise RuntimeError('Sampling random block was not successfull. Please decrease `n_perturbations`.')
+                is_new &= lin_idx // self.n != lin_idx % self.n
+            lin_idx = lin_idx[is_new]
+            if lin_idx.size(0) > n_missing:
+                lin_idx = lin_idx[torch.randperm(lin_idx.size(0), device=lin_idx.device)[:n_missing].sort().values]
+
+            new_search_space = utils.sorted_merge_positions(new_search_space, lin_idx)[0]
+
+        n_missing = n_edges - new_search_space.size(0)
+        if n_missing > 0:
+            # Very unlikely, but we still fill the block
+            logging.warning(f'Sampled {new_search_space.size(0)} of {n_edges} edges in {self.MAX_SAMPLING_ROUNDS} '
+                            'rounds, sampling the remaining ones from a bitmap')
+            taken = utils.sorted_merge_positions(search_space, new_search_space)[0]
+            lin_idx = self._sample_new_edges_from_bitmap(taken, n_missing)
+            new_search_space = utils.sorted_merge_positions(new_search_space, lin_idx)[0]
+        assert new_search_space.size(0) == n_edges, \
+            f'Sampled {new_search_space.size(0)} instead of {n_edges} edges'
+        return new_search_space
+
+    def _sample_new_edges_from_bitmap(self, search_space: torch.Tensor, n_edges: int) -> torch.Tensor:
+        """Same as `_sample_new_edges` but via a bitmap of all possible edges (i.e. without rejections).
+        """
+        is_available = torch.ones(self.n_possible_edges, dtype=torch.bool, device=search_space.device)
+        is_available[search_space] = False
+        if not self.make_undirected:
+            is_available[torch.arange(self.n, device=search_space.device) * (self.n + 1)] = False
+        lin_idx = is_available.nonzero().squeeze(-1)
+        return lin_idx[torch.randperm(lin_idx.size(0), device=lin_idx.device)[:n_edges].sort().values]
+
+    def _lin_idx_to_edge_index(self, lin_idx: torch.Tensor) -> torch.Tensor:
+        if self.make_undirected:
+            edge_index = PRBCD.linear_to_triu_idx(self.n, lin_idx)
+        else:
+            edge_index = PRBCD.linear_to_full_idx(self.n, lin_idx)
+        if self.compact_indices:
+            edge_index = utils.compact_index(edge_index, self.n - 1)
+        return edge_index
 
     @staticmethod
     def linear_to_triu_idx(n: int, lin_idx: torch.Tensor) -> torch.Tensor:
@@ -397,10 +843,88 @@ class PRBCD(SparseAttack):
         col_idx = lin_idx % n
         return torch.stack((row_idx, col_idx))
 
-    def _append_attack_statistics(self, loss: float, accuracy: float,
-                                  probability_mass_update: float, probability_mass_projected: float):
-        self.attack_statistics['loss'].append(loss)
-        self.attack_statistics['accuracy'].append(accuracy)
-        self.attack_statistics['nonzero_weights'].append((self.perturbed_edge_weight > self.eps).sum().item())
-        self.attack_statistics['probability_mass_update'].append(probability_mass_update)
-        self.attack_statistics['probability_mass_projected'].append(probability_mass_projected)
+    def _get_checkpoint(self, epoch: int, statistics: torch.Tensor) -> Dict[str, Any]:
+        """State of the attack (on the cpu) such that it can be resumed from `epoch` (see `_load_checkpoint`).
+        """
+        return dict(
+            epoch=epoch,
+            current_search_space=self.current_search_space.cpu(),
+            modified_edge_index=self.modified_edge_index.cpu(),
+            perturbed_edge_weight=self.perturbed_edge_weight.detach().cpu(),
+            best_state={key: value.cpu() for key, value in self._best_state.items()},
+            statistics=statistics.cpu(),
+            rng_state=utils.get_rng_state(),
+            **self._get_adjusted_params_checkpoint()
+        )
+
+    def _load_checkpoint(self, checkpoint: Dict[str, Any], statistics: torch.Tensor) -> int:
+        """Restores the state of the attack (see `_get_checkpoint`) and returns the epoch to resume from.
+        """
+        self.current_search_space = checkpoint['current_search_space'].to(self.device)
+        self.modified_edge_index = checkpoint['modified_edge_index'].to(self.device)
+        self.perturbed_edge_weight = checkpoint['perturbed_edge_weight'].to(self.device)
+        self._best_state = {key: value.to(self.device) for key, value in checkpoint['best_state'].items()}
+        statistics.copy_(checkpoint['statistics'])
+        utils.set_rng_state(checkpoint['rng_state'])
+        self._load_adjusted_params_checkpoint(checkpoint)
+        return checkpoint['epoch']
+
+    def _get_statistics(self, loss: torch.Tensor, accuracy: Union[float, torch.Tensor],
+                        probability_mass_update: Union[float, torch.Tensor],
+                        probability_mass_projected: Union[float, torch.Tensor]) -> torch.Tensor:
+        """Attack statistics (see `STATISTICS`) as tensor without synchronizing the device.
+        """
+        return torch.stack([
+            torch.as_tensor(value, dtype=torch.float, device=self.device)
+            for value in [loss.detach(), accuracy, (self.perturbed_edge_weight > self.eps).sum(),
+                          probability_mass_update, probability_mass_projected]
+        ])
+
+    @staticmethod
+    def _accuracy(logits: torch.Tensor, labels: torch.Tensor, idx: np.ndarray) -> torch.Tensor:
+        """Same as `utils.accuracy` but without synchronizing the device.
+        """
+        return (logits.argmax(1)[idx] == labels[idx]).float().mean()
+
+    def _init_best_state(self):
+        """Preallocated buffers on the device for the best state (for early stopping).
+        """
+        self._best_state = dict(
+            accuracy=torch.tensor(float('Inf'), device=self.device),
+            epoch=torch.tensor(-1, device=self.device),
+            size=torch.tensor(0, device=self.device),
+            search_space=torch.zeros(self.block_size, dtype=torch.long, device=self.device),
+            edge_index=torch.zeros((2, self.block_size), device=self.device,
+                                   dtype=utils.get_index_dtype(self.n - 1, self.compact_indices)),
+            edge_weight_diff=torch.zeros(self.block_size, dtype=torch.float, device=self.device)
+        )
+
+    def _update_best_state(self, accuracy: torch.Tensor, epoch: int):
+        """Updates the best state if `accuracy` improved without synchronizing the device.
+        """
+        best_state = self._best_state
+        is_better = accuracy < best_state['accuracy']
+        size = self.current_search_space.size(0)
+
+        best_state['accuracy'] = torch.where(is_better, accuracy, best_state['accuracy'])
+        best_state['epoch'] = torch.where(is_better, torch.full_like(best_state['epoch'], epoch), best_state['epoch'])
+        best_state['size'] = torch.where(is_better, torch.full_like(best_state['size'], size), best_state['size'])
+        for key, value in [('search_space', self.current_search_space),
+                           ('edge_index', self.modified_edge_index),
+                           ('edge_weight_diff', self.perturbed_edge_weight.detach())]:
+            best_state[key][..., :size] = torch.where(is_better, value, best_state[key][..., :size])
+
+    def _load_best_state(self) -> bool:
+        """Restores the best state (if any epoch was monitored).
+        """
+        best_epoch = int(self._best_state['epoch'])
+        if best_epoch < 0:
+            return False
+
+        logging.info(f'Loading search space of epoch {best_epoch} '
+                     f'(accuarcy={self._best_state["accuracy"].item()}) for fine tuning\n')
+        size = int(self._best_state['size'])
+        self.current_search_space = self._best_state['search_space'][:size].clone()
+        self.modified_edge_index = self._best_state['edge_index'][:, :size].clone()
+        self.perturbed_edge_weight = self._best_state['edge_weight_diff'][:size].clone()
+        return True
@@ -1,6 +1,7 @@
 """Utils to retrieve/split/... the data.
 """
 import logging
+import os
 
 from pathlib import Path
 from typing import Any, Dict, Iterable, List, Union, Tuple, Optional
@@ -22,6 +23,7 @@ from torch_sparse import SparseTensor
 
 from rgnn_at_scale.helper import utils
 from rgnn_at_scale.helper import ppr_utils as ppr
+from rgnn_at_scale.helper.memmap_csr import MemmapCSR
 
 
 patch_typeguard()
@@ -592,10 +594,11 @@ def prep_graph(name: str,
                binary_attr: bool = False,
                feat_norm: bool = False,
                dataset_root: str = 'data',
-               return_original_split: bool = False) -> Tuple[TensorType["num_nodes", "num_features"],
-                                                             SparseTensor,
-                                                             TensorType["num_nodes"],
-                                                             Optional[Dict[str, np.ndarray]]]:
+               return_original_split: bool = False,
+               memmap_dir: Optional[str] = None) -> Tuple[TensorType["num_nodes", "num_features"],
+                                                          Union[SparseTensor, MemmapCSR],
+                                                          TensorType["num_nodes"],
+                                                          Optional[Dict[str, np.ndarray]]]:
     """Prepares and normalizes the desired dataset
 
     Parameters
@@ -610,13 +613,19 @@ def prep_graph(name: str,
         Path where to find/store the dataset, by default "datasets"
     return_original_split: bool, optional
         If true (and the split is available for the choice of dataset) additionally the original split is returned.
+    memmap_dir: str, optional
+        If given, the adjacency matrix is stored (once) in memory-mapped files in this directory and returned as
+        `MemmapCSR`, i.e. it is never loaded as a whole by the attacks (e.g. for papers100M), by default None.
 
     Returns
     -------
-    Tuple[torch.Tensor, torch_sparse.SparseTensor, torch.Tensor]
+    Tuple[torch.Tensor, Union[torch_sparse.SparseTensor, MemmapCSR], torch.Tensor]
         dense attribute tensor, sparse adjacency matrix (normalized) and labels tensor.
     """
     split = None
+    memmap_path = None
+    if memmap_dir is not None:
+        memmap_path = os.path.join(memmap_dir, f'{name}_{"undirected" if make_undirected else "directed"}')
 
     logging.debug("Memory Usage before loading the dataset:")
     logging.debug(utils.get_max_memory_bytes() / (1024 ** 3))
@@ -624,29 +633,70 @@ def prep_graph(name: str,
     if name in ['cora_ml', 'citeseer', 'pubmed']:
         attr, adj, labels = prep_cora_citeseer_pubmed(name, dataset_root, device, make_undirected)
     elif name.startswith('ogbn'):
-        pyg_dataset = PygNodePropPredDataset(root=dataset_root, name=name)
+        if memmap_path is not None and MemmapCSR.exists(memmap_path) and _node_data_exists(memmap_path):
+            # We do not even load the PyG dataset since it holds all edges in memory
+            adj = MemmapCSR(memmap_path)
+            attr_matrix, labels, split = _load_node_data(memmap_path)
+        else:
+            attr_matrix, adj, labels, split = _prep_ogbn(name, dataset_root, device, make_undirected, memmap_path)
 
-        data = pyg_dataset[0]
+        attr = torch.from_numpy(attr_matrix).to(device)
 
-        if hasattr(data, '__num_nodes__'):
-            num_nodes = data.__num_nodes__
-        else:
-            num_nodes = data.num_nodes
+        logging.debug("Memory Usage after normalizing graph attributes:")
+        logging.debug(utils.get_max_memory_bytes() / (1024 ** 3))
 
-        if hasattr(pyg_dataset, 'get_idx_split'):
-            split = pyg_dataset.get_idx_split()
-        else:
-            split = dict(
-                train=data.train_mask.nonzero().squeeze(),
-                valid=data.val_mask.nonzero().squeeze(),
-                test=data.test_mask.nonzero().squeeze()
-            )
+        labels = labels.to(device)
+    else:
+        raise NotImplementedError(f"Dataset `with name '{name}' is not supported")
+
+    if memmap_path is not None and not isinstance(adj, MemmapCSR):
+        adj = MemmapCSR(memmap_path) if MemmapCSR.exists(memmap_path) else MemmapCSR.save(adj, memmap_path)
 
-        # converting to numpy arrays, so we don't have to handle different
-        # array types (tensor/numpy/list) later on.
-        # Also we need numpy arrays because Numba cant determine type of torch.Tensor
-        split = {k: v.numpy() for k, v in split.items()}
+    if binary_attr:
+        # NOTE: do not use this for really large datasets.
+        # The mask is a **dense** matrix of the same size as the attribute matrix
+        attr[attr != 0] = 1
+    elif feat_norm:
+        attr = utils.row_norm(attr)
+
+    if return_original_split and split is not None:
+        return attr, adj, labels, split
+
+    return attr, adj, labels, None
+
+
+def _prep_ogbn(name: str, dataset_root: str, device: Union[int, str, torch.device], make_undirected: bool,
+               memmap_path: Optional[str]) -> Tuple[np.ndarray, Union[SparseTensor, MemmapCSR], torch.Tensor,
+                                                    Dict[str, np.ndarray]]:
+    """Loads an OGB dataset. If `memmap_path` is given, the adjacency matrix as well as the node data are stored there
+    such that subsequent runs do not need to load the edges (see `prep_graph`).
+    """
+    pyg_dataset = PygNodePropPredDataset(root=dataset_root, name=name)
 
+    data = pyg_dataset[0]
+
+    if hasattr(data, '__num_nodes__'):
+        num_nodes = data.__num_nodes__
+    else:
+        num_nodes = data.num_nodes
+
+    if hasattr(pyg_dataset, 'get_idx_split'):
+        split = pyg_dataset.get_idx_split()
+    else:
+        split = dict(
+            train=data.train_mask.nonzero().squeeze(),
+            valid=data.val_mask.nonzero().squeeze(),
+            test=data.test_mask.nonzero().squeeze()
+        )
+
+    # converting to numpy arrays, so we don't have to handle different
+    # array types (tensor/numpy/list) later on.
+    # Also we need numpy arrays because Numba cant determine type of torch.Tensor
+    split = {k: v.numpy() for k, v in split.items()}
+
+    if memmap_path is not None and MemmapCSR.exists(memmap_path):
+        adj = MemmapCSR(memmap_path)
+    else:
         edge_index = data.edge_index.cpu()
         if data.edge_attr is None:
             edge_weight = torch.ones(edge_index.size(1))
@@ -671,30 +721,44 @@ def prep_graph(name: str,
         logging.debug("Memory Usage after normalizing the graph")
         logging.debug(utils.get_max_memory_bytes() / (1024 ** 3))
 
-        adj = torch_sparse.SparseTensor.from_scipy(adj).coalesce().to(device)
+        if memmap_path is not None:
+            adj = MemmapCSR.save(adj, memmap_path)
+        else:
+            adj = torch_sparse.SparseTensor.from_scipy(adj).coalesce().to(device)
 
-        attr_matrix = data.x.cpu().numpy()
+    attr_matrix = data.x.cpu().numpy()
+    labels = data.y.squeeze()
+    if memmap_path is not None:
+        _save_node_data(memmap_path, attr_matrix, labels.numpy(), split)
 
-        attr = torch.from_numpy(attr_matrix).to(device)
+    return attr_matrix, adj, labels, split
 
-        logging.debug("Memory Usage after normalizing graph attributes:")
-        logging.debug(utils.get_max_memory_bytes() / (1024 ** 3))
 
-        labels = data.y.squeeze().to(device)
-    else:
-        raise NotImplementedError(f"Dataset `with name '{name}' is not supported")
+NODE_DATA_FILES = ('x.npy', 'y.npy', 'split.npz')
 
-    if binary_attr:
-        # NOTE: do not use this for really large datasets.
-        # The mask is a **dense** matrix of the same size as the attribute matrix
-        attr[attr != 0] = 1
-    elif feat_norm:
-        attr = utils.row_norm(attr)
 
-    if return_original_split and split is not None:
-        return attr, adj, labels, split
+def _node_data_exists(path: str) -> bool:
+    return all(os.path.isfile(os.path.join(path, file)) for file in NODE_DATA_FILES)
 
-    return attr, adj, labels, None
+
+def _save_node_data(path: str, attr_matrix: np.ndarray, labels: np.ndarray, split: Dict[str, np.ndarray]):
+    """Stores the attributes, labels and split next to the memory-mapped adjacency matrix (see `MemmapCSR.save`).
+    """
+    os.makedirs(path, exist_ok=True)
+    # Write to temporary files first such that an interrupted run does not leave corrupted data behind
+    np.save(os.path.join(path, 'tmp_x.npy'), attr_matrix)
+    np.save(os.path.join(path, 'tmp_y.npy'), labels)
+    np.savez(os.path.join(path, 'tmp_split.npz'), **split)
+    for file in NODE_DATA_FILES:
+        os.replace(os.path.join(path, f'tmp_{file}'), os.path.join(path, file))
+
+
+def _load_node_data(path: str) -> Tuple[np.ndarray, torch.Tensor, Dict[str, np.ndarray]]:
+    attr_matrix = np.load(os.path.join(path, 'x.npy'))
+    labels = torch.from_numpy(np.load(os.path.join(path, 'y.npy')))
+    with np.load(os.path.join(path, 'split.npz')) as split:
+        split = dict(split)
+    return attr_matrix, labels, split
 
 
 class RobustPPRDataset(torch.utils.data.Dataset):
@@ -139,6 +139,19 @@ class Storage():
         path = os.path.join(path, f'{artifact_type}_{id}.pt')
         return path
 
+    @staticmethod
+    def _save_atomically(artifact: Dict[str, Any], path: str):
+        """Saves to a temporary file that replaces `path` afterwards, i.e. an interrupted save (e.g. due to preemption)
+        never leaves a corrupted artifact behind.
+        """
+        tmp_path = f'{path}.tmp'
+        try:
+            torch.save(artifact, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
     def save_artifact(self, artifact_type: str, params: Dict[str, Any], artifact: Dict[str, Any]) -> str:
         """Saves an artifact.
 
@@ -169,16 +182,19 @@ class Storage():
         if len(ids) != 1:
             raise RuntimeError(f'The index contains duplicates (artifact_type={artifact_type}, params={params})')
 
+        path = None
         try:
             path = self._build_artifact_path(artifact_type, ids[0])
-            torch.save(artifact, path)
+            Storage._save_atomically(artifact, path)
             return path
-        except:  # noqa: E722
-            Storage.locked_call(
-                lambda: self._remove_meta(artifact_type, params),
-                self._get_lock_path(artifact_type),
-                self.lock_timeout
-            )
+        except Exception:
+            # If we failed to overwrite an artifact, the previous one is still intact (see `_save_atomically`)
+            if path is None or not os.path.exists(path):
+                Storage.locked_call(
+                    lambda: self._remove_meta(artifact_type, params),
+                    self._get_lock_path(artifact_type),
+                    self.lock_timeout
+                )
             raise
 
     def load_artifact(self, artifact_type: str, params: Dict[str, Any],
@@ -221,6 +237,36 @@ class Storage():
         else:
             return torch.load(path)
 
+    def remove_artifact(self, artifact_type: str, params: Dict[str, Any]) -> bool:
+        """Removes an artifact (e.g. a checkpoint that is not needed anymore).
+
+        Parameters
+        ----------
+        artifact_type : str
+            Identifier of artifact type.
+        params : Dict[str, Any]
+            parameters identifying the artifacts provenance.
+
+        Returns
+        -------
+        bool
+            True if an artifact was removed.
+        """
+        def remove() -> List[int]:
+            documents = self._find_meta_by_exact_params(artifact_type, params)
+            return self._remove_meta(artifact_type, doc_ids=[document.doc_id for document in documents])
+
+        ids = Storage.locked_call(
+            remove,
+            self._get_lock_path(artifact_type),
+            self.lock_timeout,
+        )
+        for id in ids:
+            path = self._build_artifact_path(artifact_type, id)
+            if os.path.exists(path):
+                os.remove(path)
+        return len(ids) > 0
+
     def find_artifacts(self, artifact_type: str, match_condition: Dict[str, Any],
                        return_documents_only=False) -> List[Dict[str, Any]]:
         """Find all artifacts matching the defined parameters.
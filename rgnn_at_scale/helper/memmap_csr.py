@@ -0,0 +1,231 @@
+"""Out-of-core adjacency matrices (e.g. for papers100M) whose CSR representation resides in memory-mapped files.
+"""
+import os
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+import numba
+import numpy as np
+import scipy.sparse as sp
+import torch
+from torch_sparse import SparseTensor
+
+from rgnn_at_scale.helper import utils
+
+INDEX_NUMPY_DTYPES = {torch.int32: np.int32, torch.int64: np.int64}
+
+
+@numba.njit(cache=True)
+def _lookup_csr(rowptr: np.ndarray, col: np.ndarray, value: np.ndarray, rows: np.ndarray,
+                cols: np.ndarray) -> np.ndarray:
+    result = np.zeros(len(rows), dtype=value.dtype)
+    for i in range(len(rows)):
+        lower, upper = rowptr[rows[i]], rowptr[rows[i] + 1]
+        pos = lower + np.searchsorted(col[lower:upper], cols[i])
+        if pos < upper and col[pos] == cols[i]:
+            result[i] = value[pos]
+    return result
+
+
+class StreamedMatmul(torch.autograd.Function):
+    """Sparse-dense matrix multiplication `A @ x` where the rows of the (constant) memory-mapped matrix `A` are
+    streamed in chunks. The backward pass (`A^T @ grad`) streams the same chunks. Hence, at no point more than a chunk
+    of the edges resides in (device) memory.
+    """
+
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, adj: 'MemmapCSR', n_chunks: int) -> torch.Tensor:
+        ctx.adj, ctx.n_chunks = adj, n_chunks
+        out = x.new_empty((adj.n, x.size(1)))
+        for lower, upper, chunk in adj.row_chunks(n_chunks, x.device):
+            out[lower:upper] = chunk @ x
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor) -> Tuple[Optional[torch.Tensor], None, None]:
+        if not ctx.needs_input_grad[0]:
+            return None, None, None
+        grad_x = torch.zeros_like(grad_output)
+        for lower, upper, chunk in ctx.adj.row_chunks(ctx.n_chunks, grad_output.device):
+            grad_x += chunk.t() @ grad_output[lower:upper]
+        return grad_x, None, None
+
+
+class MemmapCSR(object):
+    """Adjacency matrix whose CSR representation (`rowptr`, `col` and `value`) resides in memory-mapped numpy files in
+    the directory `path` (see `MemmapCSR.save`). Only the row chunks that are currently processed are loaded into
+    memory (see `row_chunks`), i.e. the resident memory does not scale with the number of edges.
+
+    Optionally, a (small) set of perturbations is kept in memory that is added to the clean edge weights (see
+    `perturb`). This way, the attacks never materialize the perturbed graph.
+
+    Parameters
+    ----------
+    path : str
+        Directory containing the files `rowptr.npy`, `col.npy` and `value.npy`.
+    perturbed_edge_index : torch.Tensor, optional
+        Edges whose weights are changed, by default None.
+    perturbed_edge_weight : torch.Tensor, optional
+        Differences of the edge weights that are added to the clean weights, by default None.
+    """
+
+    FILES = ('rowptr', 'col', 'value')
+
+    def __init__(self, path: str, perturbed_edge_index: Optional[torch.Tensor] = None,
+                 perturbed_edge_weight: Optional[torch.Tensor] = None, _cache: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.rowptr, self.col, self.value = (
+            np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in MemmapCSR.FILES
+        )
+        self.n = self.rowptr.shape[0] - 1
+        self.perturbed_edge_index = perturbed_edge_index
+        self.perturbed_edge_weight = perturbed_edge_weight
+        # Shared among the perturbed copies (the clean graph is identical)
+        self._cache = {} if _cache is None else _cache
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return all(os.path.isfile(os.path.join(path, f'{name}.npy')) for name in MemmapCSR.FILES)
+
+    @staticmethod
+    def save(adj: Union[SparseTensor, sp.spmatrix], path: str, compact_indices: bool = True) -> 'MemmapCSR':
+        """Writes the adjacency matrix to `path` (once, e.g. in `rgnn_at_scale.data.prep_graph`).
+
+        Parameters
+        ----------
+        adj : Union[SparseTensor, sp.spmatrix]
+            Adjacency matrix.
+        path : str
+            Directory for the memory-mapped files.
+        compact_indices : bool, optional
+            If true, `rowptr` and `col` are stored as int32 if the number of edges and nodes fit, by default True.
+
+        Returns
+        -------
+        MemmapCSR
+            The memory-mapped adjacency matrix.
+        """
+        if isinstance(adj, SparseTensor):
+            rowptr, col, value = adj.csr()
+            if value is None:
+                value = torch.ones_like(col, dtype=torch.float32)
+            rowptr, col, value = rowptr.cpu().numpy(), col.cpu().numpy(), value.float().cpu().numpy()
+        else:
+            adj = sp.csr_matrix(adj)
+            adj.sort_indices()
+            rowptr, col, value = adj.indptr, adj.indices, adj.data.astype(np.float32)
+        # The pointers must fit the number of edges and the columns the number of nodes (otherwise we keep int64)
+        rowptr_dtype = INDEX_NUMPY_DTYPES[utils.get_index_dtype(col.shape[0], compact_indices)]
+        col_dtype = INDEX_NUMPY_DTYPES[utils.get_index_dtype(rowptr.shape[0] - 2, compact_indices)]
+        rowptr, col = rowptr.astype(rowptr_dtype, copy=False), col.astype(col_dtype, copy=False)
+
+        os.makedirs(path, exist_ok=True)
+        for name, array in zip(MemmapCSR.FILES, (rowptr, col, value)):
+            # Write to a temporary file first such that an interrupted run does not leave a corrupted graph behind
+            tmp_file = os.path.join(path, f'{name}.tmp.npy')
+            np.save(tmp_file, array)
+            os.replace(tmp_file, os.path.join(path, f'{name}.npy'))
+        return MemmapCSR(path)
+
+    def size(self, dim: Optional[int] = None) -> Union[int, Tuple[int, int]]:
+        return self.n if dim is not None else (self.n, self.n)
+
+    def nnz(self) -> int:
+        """Number of clean edges (i.e. without the perturbations).
+        """
+        return self.col.shape[0]
+
+    def to(self, *args, **kwargs) -> 'MemmapCSR':
+        """The memory-mapped files stay where they are (chunks are moved to the device on the fly).
+        """
+        return self
+
+    def perturb(self, edge_index: torch.Tensor, edge_weight: torch.Tensor) -> 'MemmapCSR':
+        """Copy (sharing the memory-mapped files) where the differences `edge_weight` are added to the weights of the
+        edges `edge_index`.
+        """
+        return MemmapCSR(self.path, edge_index, edge_weight, self._cache)
+
+    def row_chunks(self, n_chunks: int,
+                   device: Union[str, int, torch.device] = 'cpu') -> Iterator[Tuple[int, int, SparseTensor]]:
+        """Splits the rows into `n_chunks` chunks with a similar number of edges.
+
+        Parameters
+        ----------
+        n_chunks : int
+            Number of chunks.
+        device : Union[str, int, torch.device], optional
+            Device the chunks are moved to, by default 'cpu'.
+
+        Yields
+        -------
+        Tuple[int, int, SparseTensor]
+            First and last row (exclusive) as well as the respective rows of the clean adjacency matrix.
+        """
+        bounds = np.searchsorted(self.rowptr, np.linspace(0, self.nnz(), n_chunks + 1)[1:-1])
+        bounds = np.unique(np.concatenate(([0], bounds, [self.n])))
+        for lower, upper in zip(bounds[:-1], bounds[1:]):
+            # `torch_sparse` requires int64 indices
+            rowptr = torch.from_numpy(self.rowptr[lower:upper + 1].astype(np.int64))
+            edge_lower, edge_upper = int(rowptr[0]), int(rowptr[-1])
+            col = torch.from_numpy(self.col[edge_lower:edge_upper].astype(np.int64))
+            value = torch.from_numpy(np.array(self.value[edge_lower:edge_upper]))
+            chunk = SparseTensor(rowptr=rowptr - edge_lower, col=col, value=value,
+                                 sparse_sizes=(upper - lower, self.n), is_sorted=True)
+            yield int(lower), int(upper), chunk.to(device)
+
+    def matmul(self, x: torch.Tensor, n_chunks: int = 8) -> torch.Tensor:
+        """Clean adjacency matrix times `x` (differentiable w.r.t. `x`, see `StreamedMatmul`).
+        """
+        return StreamedMatmul.apply(x, self, n_chunks)
+
+    def lookup(self, edge_index: torch.Tensor) -> torch.Tensor:
+        """Clean weights of the given edges (zero if the edge does not exist).
+        """
+        edge_index = edge_index.cpu().numpy()
+        weight = _lookup_csr(self.rowptr, self.col, self.value, edge_index[0], edge_index[1])
+        return torch.from_numpy(weight)
+
+    def clean_degree(self, n_chunks: int = 8) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Row sums, column sums and whether the nodes have a self-loop in the clean graph (calculated once).
+        """
+        if 'degree' not in self._cache:
+            row_sum = torch.zeros(self.n)
+            col_sum = torch.zeros(self.n)
+            has_self_loop = torch.zeros(self.n, dtype=torch.bool)
+            for lower, upper, chunk in self.row_chunks(n_chunks):
+                row, col, value = chunk.coo()
+                row = row + lower
+                row_sum.index_add_(0, row, value)
+                col_sum.index_add_(0, col, value)
+                has_self_loop[row[row == col]] = True
+            self._cache['degree'] = (row_sum, col_sum, has_self_loop)
+        return self._cache['degree']
+
+    def to_sparse_tensor(self) -> SparseTensor:
+        """Materializes the (perturbed) adjacency matrix in memory (only feasible for small graphs).
+        """
+        adj = SparseTensor(rowptr=torch.from_numpy(self.rowptr.astype(np.int64)),
+                           col=torch.from_numpy(self.col.astype(np.int64)),
+                           value=torch.from_numpy(np.array(self.value)), sparse_sizes=(self.n, self.n))
+        if self.perturbed_edge_index is None:
+            return adj
+        row, col, value = adj.coo()
+        adj = SparseTensor.from_edge_index(
+            torch.cat((torch.stack((row, col)), self.perturbed_edge_index.cpu()), dim=-1),
+            torch.cat((value, self.perturbed_edge_weight.detach().cpu())),
+            (self.n, self.n)
+        ).coalesce()
+        # Removed edges
+        return adj.masked_select_nnz(adj.storage.value() != 0, layout='coo')
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Only the path is stored (e.g. with `torch.save`) and not the content of the memory-mapped files
+        return dict(path=self.path, perturbed_edge_index=self.perturbed_edge_index,
+                    perturbed_edge_weight=self.perturbed_edge_weight)
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__init__(**state)
+
+    def __repr__(self) -> str:
+        n_perturbed = 0 if self.perturbed_edge_index is None else self.perturbed_edge_index.size(1)
+        return f'MemmapCSR(path={self.path}, n={self.n}, nnz={self.nnz()}, n_perturbed={n_perturbed})'
@@ -0,0 +1,314 @@
+"""Estimates the peak memory of (P)RBCD attacks to choose `block_size`, `n_chunks`, `do_synchronize` and PPRGo's
+`forward_batch_size` such that they fit into a given memory budget (GPU memory or CPU RAM).
+
+The planner is only used as a library (e.g. to fill the attack and model parameters of a config) and is not called
+by the experiments.
+"""
+
+import logging
+import math
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Sequence, Union
+
+import torch
+
+from rgnn_at_scale.helper import utils
+from rgnn_at_scale.models import BATCHED_PPR_MODELS, MODEL_TYPE, GCN, RGNN
+
+
+# Bytes of a float / long element
+FLOAT_BYTES = 4
+LONG_BYTES = 8
+# Edge index (two long) and edge weight (float)
+EDGE_BYTES = 2 * LONG_BYTES + FLOAT_BYTES
+# Copies of the perturbed edges (fused edges, self loops / normalization, `SparseTensor` conversion)
+EDGE_COPIES = 3
+# Per element of the block: search space, edge index, weight, gradient, best state and merge positions
+BLOCK_BYTES = 2 * (LONG_BYTES + 2 * LONG_BYTES + FLOAT_BYTES) + FLOAT_BYTES + 2 * LONG_BYTES
+# Relative headroom below which we empty the cache / synchronize in every epoch (fragmentation)
+SYNCHRONIZE_HEADROOM = 0.2
+
+
+def get_memory_budget(device: Union[str, int, torch.device]) -> int:
+    """Total memory of the GPU or the available CPU RAM in bytes.
+    """
+    device = torch.device(device) if not isinstance(device, int) else torch.device('cuda', device)
+    if device.type == 'cuda':
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def measure_peak_memory(probe: Callable[[], Any], device: Union[str, int, torch.device],
+                        sampling_interval: float = 0.001) -> int:
+    """Peak memory in bytes while executing `probe` (relative to the memory before). On the CPU, the resident memory
+    is sampled every `sampling_interval` seconds (and after the probe, while its result is still referenced). Without
+    `/proc` we can only use the increase of the process' peak resident memory (i.e. the probe should then be run
+    before larger allocations).
+    """
+    device = torch.device(device) if not isinstance(device, int) else torch.device('cuda', device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        memory_before = torch.cuda.memory_allocated(device)
+        probe()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - memory_before
+
+    max_memory_before = utils.get_max_memory_bytes()
+    memory_before = utils.get_current_memory_bytes()
+    if math.isnan(memory_before):
+        probe()
+        return _max_memory_increase(max_memory_before)
+
+    peak_memory = [memory_before]
+    is_done = threading.Event()
+
+    def sample():
+        while not is_done.wait(sampling_interval):
+            peak_memory[0] = max(peak_memory[0], utils.get_current_memory_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = probe()
+        peak_memory[0] = max(peak_memory[0], utils.get_current_memory_bytes())
+    finally:
+        is_done.set()
+        sampler.join()
+    del result
+    # A new peak of the process is also a lower bound (e.g. for allocations between two samples)
+    return max(int(peak_memory[0] - memory_before), _max_memory_increase(max_memory_before))
+
+
+def _max_memory_increase(max_memory_before: float) -> int:
+    increase = utils.get_max_memory_bytes() - max_memory_before
+    return 0 if math.isnan(increase) else max(int(increase), 0)
+
+
+class MemoryPlanner():
+    """Plans the parameters of a (P)RBCD attack given a memory budget. The estimate of the peak memory is a rough model
+    of the graph, the block and the activations (see `estimate_memory`) that can be calibrated with a probe run (see
+    `calibrate`).
+
+    Parameters
+    ----------
+    memory_budget : int
+        Memory budget in bytes (see `get_memory_budget`).
+    n : int
+        Number of nodes.
+    n_edges : int
+        Number of (directed) edges.
+    n_features : int
+        Number of features.
+    n_classes : int
+        Number of classes.
+    n_filters : Sequence[int], optional
+        Hidden dimensions, by default (64,).
+    model_type : str, optional
+        One of `GCN`, `RGNN` (robust aggregation on the edges) or `PPRGo`, by default 'GCN'.
+    make_undirected : bool, optional
+        If True the block is mirrored, by default True.
+    ppr_topk : int, optional
+        Top k of the PPR matrix (only for PPRGo), by default 64.
+    is_cuda : bool, optional
+        If True, we might synchronize to reduce fragmentation, by default True.
+    safety_factor : float, optional
+        Fraction of the budget that is planned with, by default 0.9.
+    """
+
+    def __init__(self,
+                 memory_budget: int,
+                 n: int,
+                 n_edges: int,
+                 n_features: int,
+                 n_classes: int,
+                 n_filters: Sequence[int] = (64,),
+                 model_type: str = 'GCN',
+                 make_undirected: bool = True,
+                 ppr_topk: int = 64,
+                 is_cuda: bool = True,
+                 safety_factor: float = 0.9):
+        assert model_type in ['GCN', 'RGNN', 'PPRGo'], f'Unknown model type {model_type}'
+        self.memory_budget = memory_budget
+        self.n = n
+        self.n_edges = n_edges
+        self.n_features = n_features
+        self.n_classes = n_classes
+        self.n_filters = list(n_filters)
+        self.model_type = model_type
+        self.make_undirected = make_undirected
+        self.ppr_topk = ppr_topk
+        self.is_cuda = is_cuda
+        self.safety_factor = safety_factor
+        # Ratio of measured and estimated memory (see `calibrate`)
+        self.calibration = 1.
+
+    @staticmethod
+    def from_model(model: MODEL_TYPE, n: int, n_edges: int, memory_budget: Optional[int] = None,
+                   device: Union[str, int, torch.device] = 0, make_undirected: bool = True,
+                   **kwargs) -> 'MemoryPlanner':
+        """Derives the dimensions and model type from `model` (and the budget from `device` if not given).
+        """
+        if memory_budget is None:
+            memory_budget = get_memory_budget(device)
+        if isinstance(model, BATCHED_PPR_MODELS.__args__):
+            model_type = 'PPRGo'
+            kwargs.setdefault('ppr_topk', model.topk)
+        elif isinstance(model, RGNN):
+            model_type = 'RGNN'
+        elif isinstance(model, GCN):
+            model_type = 'GCN'
+        else:
+            logging.warning(f'Memory planner treats {type(model).__name__} like a GCN')
+            model_type = 'GCN'
+        is_cuda = not (device == 'cpu' or (isinstance(device, torch.device) and device.type == 'cpu'))
+        return MemoryPlanner(memory_budget, n, n_edges, model.n_features, model.n_classes,
+                             n_filters=model.n_filters, model_type=model_type, make_undirected=make_undirected,
+                             is_cuda=is_cuda, **kwargs)
+
+    def estimate_memory(self, block_size: int, n_chunks: int = 1, forward_batch_size: Optional[int] = None) -> int:
+        """Estimated peak memory (in bytes) of an attack step, i.e. forward and backward pass on the perturbed graph.
+
+        Parameters
+        ----------
+        block_size : int
+            Size of the block.
+        n_chunks : int, optional
+            Number of chunks of the (robust) message passing, by default 1.
+        forward_batch_size : int, optional
+            Batch size of PPRGo's forward pass, by default None (i.e. all nodes).
+
+        Returns
+        -------
+        int
+            The estimated peak memory.
+        """
+        n_perturbed_edges = self.n_edges + (2 if self.make_undirected else 1) * block_size
+        dimensions = [self.n_features] + self.n_filters + [self.n_classes]
+
+        memory = EDGE_COPIES * EDGE_BYTES * n_perturbed_edges + BLOCK_BYTES * block_size
+        # Gradient towards the edge weights of every layer
+        memory += (len(dimensions) - 1) * FLOAT_BYTES * n_perturbed_edges
+
+        if self.model_type == 'PPRGo':
+            batch_size = self.n if forward_batch_size is None else min(forward_batch_size, self.n)
+            # The MLP is applied to the top k neighbors of each node in the batch
+            memory += FLOAT_BYTES * batch_size * self.ppr_topk * sum(dimensions)
+        else:
+            # Input, linear transformation and aggregation of each layer are kept for the backward pass
+            memory += FLOAT_BYTES * self.n * (self.n_features + 3 * sum(dimensions[1:]))
+
+        if self.model_type == 'RGNN':
+            # Robust aggregations (e.g. the soft median) materialize (and sort) the messages of a chunk of the edges
+            memory += 2 * FLOAT_BYTES * n_perturbed_edges * max(dimensions[1:]) // n_chunks
+
+        return int(self.calibration * memory)
+
+    def calibrate(self, probe: Callable[[Dict[str, Any]], Any], device: Union[str, int, torch.device],
+                  block_size: int = 10_000, n_chunks: int = 1, forward_batch_size: Optional[int] = None) -> float:
+        """Calibrates the estimate with the peak memory of a short run (e.g. a few epochs of the attack).
+
+        Parameters
+        ----------
+        probe : Callable[[Dict[str, Any]], Any]
+            Executes the short run with the given parameters (`block_size`, `n_chunks` and `forward_batch_size`).
+        device : Union[str, int, torch.device]
+            Device the probe is executed on.
+        block_size : int, optional
+            Block size of the probe, by default 10_000.
+        n_chunks : int, optional
+            Number of chunks of the probe, by default 1.
+        forward_batch_size : int, optional
+            PPRGo's batch size of the probe, by default None.
+
+        Returns
+        -------
+        float
+            The calibration, i.e. the ratio of the measured and estimated memory.
+        """
+        params = dict(block_size=block_size, n_chunks=n_chunks, forward_batch_size=forward_batch_size)
+        measured_memory = measure_peak_memory(lambda: probe(params), device)
+
+        self.calibration = 1.
+        estimated_memory = self.estimate_memory(**params)
+        if measured_memory > 0:
+            self.calibration = measured_memory / estimated_memory
+        logging.info(f'Memory planner: probe used {measured_memory / 1024 ** 3:.3f} GB (estimated '
+                     f'{estimated_memory / 1024 ** 3:.3f} GB), calibration {self.calibration:.3f}')
+        return self.calibration
+
+    def plan(self, max_block_size: Optional[int] = None, min_block_size: int = 1_000,
+             max_n_chunks: int = 256) -> Dict[str, Any]:
+        """Chooses the largest block (up to `max_block_size`) with as few chunks / as large PPRGo batches as necessary.
+
+        Parameters
+        ----------
+        max_block_size : int, optional
+            Upper limit of the block size, by default None (i.e. the number of possible edges).
+        min_block_size : int, optional
+            Smallest acceptable block size, by default 1_000.
+        max_n_chunks : int, optional
+            Upper limit of the number of chunks, by default 256.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The attack's `block_size` and `do_synchronize` as well as the model's `n_chunks` and `forward_batch_size`.
+
+        Raises
+        ------
+        RuntimeError
+            If even the smallest configuration does not fit into the budget.
+        """
+        budget = self.safety_factor * self.memory_budget
+        n_possible_edges = self.n * (self.n - 1) // 2 if self.make_undirected else self.n ** 2
+        max_block_size = n_possible_edges if max_block_size is None else min(max_block_size, n_possible_edges)
+        min_block_size = min(min_block_size, max_block_size)
+
+        forward_batch_size = None
+        n_chunks = 1
+        if self.model_type == 'PPRGo':
+            # Halve the batch size until the smallest block fits
+            forward_batch_size = self.n
+            while (forward_batch_size > 1
+                   and self.estimate_memory(min_block_size, n_chunks, forward_batch_size) > budget):
+                forward_batch_size //= 2
+        elif self.model_type == 'RGNN':
+            # Double the number of chunks until the smallest block fits
+            while n_chunks < max_n_chunks and self.estimate_memory(min_block_size, n_chunks) > budget:
+                n_chunks *= 2
+
+        if self.estimate_memory(min_block_size, n_chunks, forward_batch_size) > budget:
+            raise RuntimeError(f'The attack does not fit into {self.memory_budget / 1024 ** 3:.3f} GB even for '
+                               f'block size {min_block_size} (estimated '
+                               f'{self.estimate_memory(min_block_size, n_chunks, forward_batch_size) / 1024 ** 3:.3f} '
+                               'GB)')
+
+        # The estimate is linear in the block size
+        memory_without_block = self.estimate_memory(0, n_chunks, forward_batch_size)
+        memory_per_block_element = (self.estimate_memory(min_block_size, n_chunks, forward_batch_size)
+                                    - memory_without_block) / min_block_size
+        block_size = int(min(max_block_size, (budget - memory_without_block) / memory_per_block_element))
+        block_size = max(block_size, min_block_size)
+
+        estimated_memory = self.estimate_memory(block_size, n_chunks, forward_batch_size)
+        do_synchronize = self.is_cuda and 1 - estimated_memory / self.memory_budget < SYNCHRONIZE_HEADROOM
+
+        plan = dict(block_size=block_size, n_chunks=n_chunks, do_synchronize=do_synchronize)
+        if forward_batch_size is not None:
+            plan['forward_batch_size'] = forward_batch_size
+        logging.info(f'Memory planner: {plan} with estimated peak memory {estimated_memory / 1024 ** 3:.3f} GB of '
+                     f'{self.memory_budget / 1024 ** 3:.3f} GB')
+        return plan
+
+
+def plan_memory(model: MODEL_TYPE, n: int, n_edges: int, device: Union[str, int, torch.device],
+                memory_budget: Optional[int] = None, **kwargs) -> Dict[str, Any]:
+    """Shortcut for `MemoryPlanner.from_model(...).plan()`. The keyword arguments are passed to `plan` if they are one
+    of its arguments and otherwise to `MemoryPlanner`.
+    """
+    plan_kwargs = {key: kwargs.pop(key) for key in ['max_block_size', 'min_block_size', 'max_n_chunks']
+                   if key in kwargs}
+    planner = MemoryPlanner.from_model(model, n, n_edges, memory_budget=memory_budget, device=device, **kwargs)
+    return planner.plan(**plan_kwargs)
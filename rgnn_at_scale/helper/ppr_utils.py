@@ -46,7 +46,7 @@ def calc_ppr(indptr, indices, deg, alpha, epsilon, nodes):
     return js, vals
 
 
-@numba.njit(parallel=True)
+@numba.njit(parallel=True, cache=True)
 def calc_ppr_topk_parallel(indptr, indices, deg, alpha, epsilon, nodes, topk):
     js = [np.zeros(0, dtype=np.int64)] * len(nodes)
     vals = [np.zeros(0, dtype=np.float32)] * len(nodes)
@@ -72,8 +72,10 @@ def ppr_topk(adj_matrix, alpha, epsilon, nodes, topk):
 
 
 def construct_sparse(neighbors, weights, shape):
-    i = np.repeat(np.arange(len(neighbors)), np.fromiter(map(len, neighbors), dtype=np.int))
-    j = np.concatenate(neighbors)
+    # int32 indices if the nodes fit (halves the memory of the top k indices)
+    index_dtype = np.int32 if max(shape) <= np.iinfo(np.int32).max else np.int64
+    i = np.repeat(np.arange(len(neighbors), dtype=index_dtype), np.fromiter(map(len, neighbors), dtype=np.int64))
+    j = np.concatenate(neighbors).astype(index_dtype, copy=False)
     return sp.coo_matrix((np.concatenate(weights), (i, j)), shape)
 
 
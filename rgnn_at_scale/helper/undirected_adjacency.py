@@ -0,0 +1,135 @@
+"""Undirected adjacency matrices that only store the upper-triangular entries (i.e. every edge once).
+"""
+import math
+from typing import Iterator, Optional, Tuple, Union
+
+import torch
+from torch_sparse import SparseTensor, coalesce
+
+
+def _edge_chunks(n_edges: int, n_chunks: int) -> Iterator[slice]:
+    chunk_size = max(math.ceil(n_edges / max(n_chunks, 1)), 1)
+    for lower in range(0, n_edges, chunk_size):
+        yield slice(lower, lower + chunk_size)
+
+
+def _symmetric_spmm(edge_index: torch.Tensor, edge_weight: torch.Tensor, x: torch.Tensor,
+                    n_chunks: int) -> torch.Tensor:
+    """`A @ x` for the symmetric matrix `A` with the upper-triangular entries `edge_index` and `edge_weight`. Every
+    entry is read once and contributes to both directions (entries on the diagonal only once).
+    """
+    out = torch.zeros_like(x)
+    for chunk in _edge_chunks(edge_weight.size(0), n_chunks):
+        row, col, weight = edge_index[0, chunk], edge_index[1, chunk], edge_weight[chunk, None]
+        out.index_add_(0, row, weight * x[col])
+        out.index_add_(0, col, weight.masked_fill((row == col)[:, None], 0) * x[row])
+    return out
+
+
+class SymmetricSpMM(torch.autograd.Function):
+    """Differentiable `A @ x` (see `_symmetric_spmm`). Since `A` is symmetric, the gradient towards `x` is again
+    `A @ grad`, i.e. the backward pass uses the same kernel. The edges are processed in `n_chunks` chunks such that
+    the messages are never materialized for all edges at once.
+    """
+
+    @staticmethod
+    def forward(ctx, edge_weight: torch.Tensor, x: torch.Tensor, edge_index: torch.Tensor,
+                n_chunks: int) -> torch.Tensor:
+        ctx.save_for_backward(edge_index, edge_weight, x)
+        ctx.n_chunks = n_chunks
+        return _symmetric_spmm(edge_index, edge_weight, x, n_chunks)
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:
+        edge_index, edge_weight, x = ctx.saved_tensors
+        grad_edge_weight = grad_x = None
+        if ctx.needs_input_grad[0]:
+            grad_edge_weight = torch.empty_like(edge_weight)
+            for chunk in _edge_chunks(edge_weight.size(0), ctx.n_chunks):
+                row, col = edge_index[0, chunk], edge_index[1, chunk]
+                grad_mirrored = (grad_output[col] * x[row]).sum(-1)
+                grad_edge_weight[chunk] = (
+                    (grad_output[row] * x[col]).sum(-1) + grad_mirrored.masked_fill(row == col, 0)
+                )
+        if ctx.needs_input_grad[1]:
+            grad_x = _symmetric_spmm(edge_index, edge_weight, grad_output, ctx.n_chunks)
+        return grad_edge_weight, grad_x, None, None
+
+
+class UndirectedAdjacency(object):
+    """Symmetric adjacency matrix of an undirected graph that only stores the entries with `row <= col`. Compared to
+    storing both directions, this halves the memory of the edges and we never need to symmetrize (i.e. concatenate
+    and coalesce) the edges. The entries must be unique, but do not need to be sorted.
+
+    Parameters
+    ----------
+    edge_index : torch.Tensor
+        Upper-triangular edges (`edge_index[0] <= edge_index[1]`) of shape [2, nnz].
+    edge_weight : torch.Tensor
+        Weights of the edges of shape [nnz].
+    n : int
+        Number of nodes.
+    """
+
+    def __init__(self, edge_index: torch.Tensor, edge_weight: torch.Tensor, n: int):
+        self.edge_index = edge_index
+        self.edge_weight = edge_weight
+        self.n = n
+
+    @staticmethod
+    def from_edge_index(edge_index: torch.Tensor, edge_weight: Optional[torch.Tensor] = None,
+                        n: Optional[int] = None, op: str = 'mean') -> 'UndirectedAdjacency':
+        """Folds the edges of a (possibly directed) graph into the upper triangle. Edges that are given in both
+        directions are combined via `op` (same as `rgnn_at_scale.helper.utils.to_symmetric` but sorting the edges
+        only once).
+        """
+        if n is None:
+            n = int(edge_index.max()) + 1
+        if edge_weight is None:
+            edge_weight = torch.ones_like(edge_index[0], dtype=torch.float32)
+        edge_index = torch.stack((edge_index.min(0).values, edge_index.max(0).values)).long()
+        edge_index, edge_weight = coalesce(edge_index, edge_weight, m=n, n=n, op=op)
+        return UndirectedAdjacency(edge_index, edge_weight, n)
+
+    def size(self, dim: Optional[int] = None) -> Union[int, Tuple[int, int]]:
+        return self.n if dim is not None else (self.n, self.n)
+
+    def nnz(self) -> int:
+        """Number of stored (i.e. upper-triangular) entries.
+        """
+        return self.edge_weight.size(0)
+
+    def to(self, *args, **kwargs) -> 'UndirectedAdjacency':
+        return UndirectedAdjacency(self.edge_index.to(*args, **kwargs), self.edge_weight.to(*args, **kwargs), self.n)
+
+    def degree(self) -> torch.Tensor:
+        """Row sums (that equal the column sums) differentiable w.r.t. the edge weights.
+        """
+        row, col = self.edge_index.long()
+        deg = self.edge_weight.new_zeros(self.n).index_add(0, row, self.edge_weight)
+        return deg.index_add(0, col, self.edge_weight.masked_fill(row == col, 0))
+
+    def has_self_loop(self) -> torch.Tensor:
+        row, col = self.edge_index
+        has_self_loop = torch.zeros(self.n, dtype=torch.bool, device=row.device)
+        has_self_loop[row[row == col]] = True
+        return has_self_loop
+
+    def matmul(self, x: torch.Tensor, n_chunks: int = 1) -> torch.Tensor:
+        """`A @ x` differentiable w.r.t. the edge weights and `x` (see `SymmetricSpMM`).
+        """
+        return SymmetricSpMM.apply(self.edge_weight, x, self.edge_index.long(), n_chunks)
+
+    def to_edge_index(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Edges in both directions. No coalesce is required since the mirrored (off-diagonal) entries are disjoint.
+        """
+        is_mirrored = self.edge_index[0] != self.edge_index[1]
+        edge_index = torch.cat((self.edge_index, self.edge_index[:, is_mirrored].flip(0)), dim=-1)
+        return edge_index, torch.cat((self.edge_weight, self.edge_weight[is_mirrored]))
+
+    def to_sparse_tensor(self) -> SparseTensor:
+        edge_index, edge_weight = self.to_edge_index()
+        return SparseTensor.from_edge_index(edge_index.long(), edge_weight, (self.n, self.n))
+
+    def __repr__(self) -> str:
+        return f'UndirectedAdjacency(n={self.n}, nnz={self.nnz()})'
@@ -1,6 +1,8 @@
 """For the util methods such as conversions or adjacency preprocessings.
 """
-from typing import Sequence, Tuple, Union
+import gc
+import os
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
@@ -446,8 +448,10 @@ def get_ppr_matrix(adjacency_matrix: TensorType["n_nodes", "n_nodes"],
 
 
 def _construct_sparse(neighbors, weights, shape):
-    i = np.repeat(np.arange(len(neighbors)), np.fromiter(map(len, neighbors), dtype=np.int))
-    j = np.concatenate(neighbors)
+    # int32 indices if the nodes fit (halves the memory of the top k indices)
+    index_dtype = np.int32 if max(shape) <= np.iinfo(np.int32).max else np.int64
+    i = np.repeat(np.arange(len(neighbors), dtype=index_dtype), np.fromiter(map(len, neighbors), dtype=np.int64))
+    j = np.concatenate(neighbors).astype(index_dtype, copy=False)
     return sp.coo_matrix((np.concatenate(weights), (i, j)), shape)
 
 
@@ -590,6 +594,108 @@ def to_symmetric(edge_index: torch.Tensor, edge_weight: torch.Tensor,
     return symmetric_edge_index, symmetric_edge_weight
 
 
+def sorted_merge_positions(lin_idx: torch.Tensor,
+                           block_lin_idx: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Merges two sorted and unique linear indices (e.g. `row * n + col`) of sparse matrices in O(E + b log E), i.e.
+    without sorting all E + b entries.
+
+    Parameters
+    ----------
+    lin_idx : torch.Tensor
+        Sorted and unique linear indices of the E edges.
+    block_lin_idx : torch.Tensor
+        Sorted and unique linear indices of the b block edges.
+
+    Returns
+    -------
+    Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+        Sorted and unique merged linear indices, the positions of the E edges in the merged indices and the positions
+        of the b block edges in the merged indices.
+    """
+    n_edges = lin_idx.size(0)
+    block_pos = torch.searchsorted(lin_idx, block_lin_idx)
+    is_in_range = block_pos < n_edges
+    is_match = torch.zeros_like(is_in_range)
+    is_match[is_in_range] = lin_idx[block_pos[is_in_range]] == block_lin_idx[is_in_range]
+    is_new = ~is_match
+    new_pos = block_pos[is_new]
+    n_new = new_pos.size(0)
+
+    # Each new edge shifts all subsequent edges by one
+    n_new_before = torch.bincount(new_pos, minlength=n_edges + 1).cumsum(0)[:n_edges]
+    merged_pos = torch.arange(n_edges, device=lin_idx.device) + n_new_before
+    block_merged_pos = torch.empty_like(block_pos)
+    block_merged_pos[is_match] = merged_pos[block_pos[is_match]]
+    block_merged_pos[is_new] = new_pos + torch.arange(n_new, device=lin_idx.device)
+
+    merged_lin_idx = torch.empty(n_edges + n_new, dtype=lin_idx.dtype, device=lin_idx.device)
+    merged_lin_idx[merged_pos] = lin_idx
+    merged_lin_idx[block_merged_pos[is_new]] = block_lin_idx[is_new]
+    return merged_lin_idx, merged_pos, block_merged_pos
+
+
+def get_index_dtype(max_value: int, compact: bool = True) -> torch.dtype:
+    """Index dtype that can represent `max_value`, i.e. int32 if it fits (and `compact`) and otherwise int64.
+
+    Parameters
+    ----------
+    max_value : int
+        Largest index (e.g. the number of nodes minus one).
+    compact : bool, optional
+        If false, int64 is returned, by default True.
+
+    Returns
+    -------
+    torch.dtype
+        `torch.int32` or `torch.int64`.
+    """
+    if compact and max_value <= torch.iinfo(torch.int32).max:
+        return torch.int32
+    return torch.int64
+
+
+def compact_index(index: torch.Tensor, max_value: Optional[int] = None) -> torch.Tensor:
+    """Stores `index` as int32 if all its values fit (and as int64 otherwise). Note that e.g. `torch_sparse` and
+    `torch_scatter` require int64, i.e. compacted indices need to be cast (`.long()`) before they are passed on.
+
+    Parameters
+    ----------
+    index : torch.Tensor
+        Integer tensor.
+    max_value : int, optional
+        Upper bound of the values (e.g. the number of nodes minus one), by default the maximum of `index`.
+
+    Returns
+    -------
+    torch.Tensor
+        The index as int32 or int64.
+    """
+    if max_value is None:
+        max_value = int(index.max()) if index.numel() > 0 else 0
+    return index.to(get_index_dtype(max_value))
+
+
+def isin_sorted(values: torch.Tensor, sorted_values: torch.Tensor) -> torch.Tensor:
+    """Membership of `values` in the sorted `sorted_values` via binary search, i.e. in O(v log s).
+
+    Parameters
+    ----------
+    values : torch.Tensor
+        The v values to look up.
+    sorted_values : torch.Tensor
+        The s sorted values.
+
+    Returns
+    -------
+    torch.Tensor
+        Boolean mask that is True for the values that are contained in `sorted_values`.
+    """
+    if sorted_values.size(0) == 0:
+        return torch.zeros_like(values, dtype=torch.bool)
+    pos = torch.searchsorted(sorted_values, values).clamp_max(sorted_values.size(0) - 1)
+    return sorted_values[pos] == values
+
+
 def to_symmetric_scipy(adjacency: sp.csr_matrix):
     sym_adjacency = (adjacency + adjacency.T).astype(bool).astype(float)
 
@@ -661,6 +767,23 @@ def accuracy(logits: torch.Tensor, labels: torch.Tensor, split_idx: np.ndarray)
     return (logits.argmax(1)[split_idx] == labels[split_idx]).float().mean().item()
 
 
+def get_rng_state() -> Dict[str, Any]:
+    """Returns the state of PyTorch's random number generators (e.g. to resume an attack with identical results).
+    """
+    return dict(
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    )
+
+
+def set_rng_state(state: Dict[str, Any]):
+    """Restores the state of PyTorch's random number generators (see `get_rng_state`).
+    """
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
 # For the next four methods, credits to https://github.com/DSE-MSU/DeepRobust
 
 
@@ -725,6 +848,34 @@ def get_max_memory_bytes():
     return np.nan
 
 
+def get_current_memory_bytes():
+    """Current resident memory of the process (NaN if `/proc` is not available, e.g. on macOS).
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return np.nan
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """Whether `error` is due to a failed allocation (on the GPU or CPU).
+    """
+    if isinstance(error, MemoryError):
+        return True
+    return isinstance(error, RuntimeError) and any(
+        message in str(error) for message in ['out of memory', "can't allocate memory"]
+    )
+
+
+def free_memory():
+    """Releases unreferenced memory (e.g. after an allocation failed).
+    """
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
 def matrix_to_torch(X):
     if sp.issparse(X):
         return SparseTensor.from_scipy(X)
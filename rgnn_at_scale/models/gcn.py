@@ -1,4 +1,5 @@
 import collections
+import logging
 from typing import Callable, Dict, Optional, Sequence, Tuple, Union
 from torchtyping import TensorType, patch_typeguard
 from typeguard import typechecked
@@ -16,7 +17,9 @@ from torch_geometric.utils import add_remaining_self_loops
 from torch_scatter import scatter_add
 from torch_sparse import coalesce, SparseTensor
 
-from rgnn_at_scale.aggregation import chunked_message_and_aggregate
+from rgnn_at_scale.aggregation import chunked_message_and_aggregate, edge_restricted_matmul
+from rgnn_at_scale.helper.memmap_csr import MemmapCSR
+from rgnn_at_scale.helper.undirected_adjacency import UndirectedAdjacency
 from rgnn_at_scale.helper.utils import (get_approx_topk_ppr_matrix, get_ppr_matrix, get_truncated_svd, get_jaccard,
                                         sparse_tensor_to_tuple, tuple_to_sparse_tensor)
 
@@ -33,10 +36,12 @@ class ChainableGCNConv(GCNConv):
     See https://pytorch-geometric.readthedocs.io/en/latest/modules/nn.html#module-torch_geometric.nn.conv.gcn
     """
 
-    def __init__(self, do_chunk: bool = False, n_chunks: int = 8, *input, **kwargs):
+    def __init__(self, do_chunk: bool = False, n_chunks: int = 8, n_chunk_threads: int = 1, *input, **kwargs):
         super().__init__(*input, **kwargs)
         self.do_chunk = do_chunk
         self.n_chunks = n_chunks
+        self.n_chunk_threads = n_chunk_threads
+        self.edge_gradient_node_idx = None
 
     def forward(self, arguments: Tuple[TensorType["n_nodes", "n_features"],
                                        Union[TensorType[2, "nnz"], SparseTensor],
@@ -70,11 +75,38 @@ class ChainableGCNConv(GCNConv):
             embedding = super(ChainableGCNConv, self).update(embedding)
         return embedding
 
+    def forward_with_propagation(self, x: torch.Tensor,
+                                 propagate: Callable[[torch.Tensor], torch.Tensor]) -> torch.Tensor:
+        """Same as `forward` but the message passing (including the normalization) is given by `propagate` (e.g. to
+        stream a memory-mapped adjacency matrix, see `GCN.forward`).
+        """
+        x = self.lin(x) if hasattr(self, 'lin') else x @ self.weight
+        x = propagate(x)
+        if self.bias is not None:
+            x = x + self.bias
+        return x
+
+    def do_chunk_now(self) -> bool:
+        """Chunk if checkpointing is requested or if the chunks can be executed in parallel (no gradient required).
+        """
+        return self.do_chunk or (self.n_chunk_threads > 1 and not torch.is_grad_enabled())
+
     def message_and_aggregate(self, adj_t: Union[torch.Tensor, SparseTensor], x: torch.Tensor) -> torch.Tensor:
-        if not self.do_chunk or not isinstance(adj_t, SparseTensor):
+        if (
+            self.edge_gradient_node_idx is not None
+            and isinstance(adj_t, SparseTensor)
+            and not self.do_chunk_now()
+            and adj_t.has_value()
+            and adj_t.storage.value().requires_grad
+            and torch.is_grad_enabled()
+        ):
+            node_mask = torch.zeros(adj_t.size(1), dtype=torch.bool, device=x.device)
+            node_mask[self.edge_gradient_node_idx.to(x.device)] = True
+            return edge_restricted_matmul(adj_t, x, node_mask)
+        if not self.do_chunk_now() or not isinstance(adj_t, SparseTensor):
             return super(ChainableGCNConv, self).message_and_aggregate(adj_t, x)
         else:
-            return chunked_message_and_aggregate(adj_t, x, n_chunks=self.n_chunks)
+            return chunked_message_and_aggregate(adj_t, x, n_chunks=self.n_chunks, n_threads=self.n_chunk_threads)
 
 
 ACTIVATIONS = {
@@ -127,6 +159,9 @@ class GCN(nn.Module):
         by default False
     n_chunks : int, optional
         Number of chunks for checkpointing, by default 8
+    n_chunk_threads : int, optional
+        If larger than one, the chunks of the message passing are executed in parallel on a thread pool of this size
+        whenever no gradient is required (e.g. for evaluation), by default 1
     """
 
     def __init__(self,
@@ -147,6 +182,7 @@ class GCN(nn.Module):
                  do_checkpoint: bool = False,
                  row_norm: bool = False,
                  n_chunks: int = 8,
+                 n_chunk_threads: int = 1,
                  **kwargs):
         super().__init__()
         if not isinstance(n_filters, collections.Sequence):
@@ -176,12 +212,14 @@ class GCN(nn.Module):
         self.do_checkpoint = do_checkpoint
         self.row_norm = row_norm
         self.n_chunks = n_chunks
+        self.n_chunk_threads = n_chunk_threads
         self.adj_preped = None
+        self.is_input_normalized = False
         self.layers = self._build_layers()
 
     def _build_conv_layer(self, in_channels: int, out_channels: int):
-        return ChainableGCNConv(in_channels=in_channels, out_channels=out_channels,
-                                do_chunk=self.do_checkpoint, n_chunks=self.n_chunks, bias=self.bias)
+        return ChainableGCNConv(in_channels=in_channels, out_channels=out_channels, do_chunk=self.do_checkpoint,
+                                n_chunks=self.n_chunks, n_chunk_threads=self.n_chunk_threads, bias=self.bias)
 
     def _build_layers(self):
         filter_dimensions = [self.n_features] + self.n_filters
@@ -206,12 +244,19 @@ class GCN(nn.Module):
                 adj: Optional[Union[SparseTensor,
                                     torch.sparse.FloatTensor,
                                     Tuple[TensorType[2, "nnz"], TensorType["nnz"]],
-                                    TensorType["n_nodes", "n_nodes"]]] = None,
+                                    TensorType["n_nodes", "n_nodes"],
+                                    MemmapCSR,
+                                    UndirectedAdjacency]] = None,
                 attr_idx: Optional[TensorType["n_nodes", "n_features"]] = None,
                 edge_idx: Optional[TensorType[2, "nnz"]] = None,
                 edge_weight: Optional[TensorType["nnz"]] = None,
                 n: Optional[int] = None,
                 d: Optional[int] = None) -> TensorType["n_nodes", "n_classes"]:
+        if isinstance(adj, MemmapCSR):
+            return self._forward_streamed(data, adj)
+        if isinstance(adj, UndirectedAdjacency):
+            return self._forward_undirected(data, adj)
+
         x, edge_idx, edge_weight = GCN.parse_forward_input(data, adj, attr_idx, edge_idx, n, d)
 
         device = next(self.parameters()).device
@@ -234,6 +279,81 @@ class GCN(nn.Module):
 
         return x
 
+    def _forward_streamed(self, x: TensorType["n_nodes", "n_features"], adj: MemmapCSR,
+                          ) -> TensorType["n_nodes", "n_classes"]:
+        """Forward pass for a memory-mapped adjacency matrix whose rows are streamed in `n_chunks` chunks. The
+        normalization is the same as in `GCN.normalize`, but it is applied on the fly via the degrees (such that only
+        the perturbations of `adj` need to be in memory). The result is differentiable w.r.t. the perturbed edge
+        weights.
+        """
+        self._check_custom_propagation('A memory-mapped adjacency matrix')
+
+        device = next(self.parameters()).device
+        x = x.to(device)
+        row_sum, col_sum, has_self_loop = (value.to(device) for value in adj.clean_degree(self.n_chunks))
+        deg = row_sum if self.row_norm else col_sum
+        if adj.perturbed_edge_index is not None:
+            perturbed_edge_index = adj.perturbed_edge_index.to(device)
+            perturbed_edge_weight = adj.perturbed_edge_weight.to(device)
+            deg = deg.index_add(0, perturbed_edge_index[0 if self.row_norm else 1], perturbed_edge_weight)
+        self_loop_weight = (~has_self_loop).float() if self.add_self_loops else torch.zeros_like(deg)
+        scale_in, scale_out = self._get_normalization_scales(deg + self_loop_weight)
+
+        def propagate(x: torch.Tensor) -> torch.Tensor:
+            x = scale_in[:, None] * x
+            out = adj.matmul(x, self.n_chunks) + self_loop_weight[:, None] * x
+            if adj.perturbed_edge_index is not None:
+                out = out.index_add(0, perturbed_edge_index[0],
+                                    perturbed_edge_weight[:, None] * x[perturbed_edge_index[1]])
+            return scale_out[:, None] * out
+
+        return self._forward_with_propagation(x, propagate)
+
+    def _forward_undirected(self, x: TensorType["n_nodes", "n_features"], adj: UndirectedAdjacency,
+                            ) -> TensorType["n_nodes", "n_classes"]:
+        """Forward pass for an undirected adjacency matrix that only stores the upper-triangular entries (see
+        `UndirectedAdjacency.matmul`). The normalization is the same as in `GCN.normalize` and the result is
+        differentiable w.r.t. the edge weights.
+        """
+        self._check_custom_propagation('An undirected adjacency matrix')
+
+        device = next(self.parameters()).device
+        x, adj = x.to(device), adj.to(device)
+        # Row and column sums are identical
+        deg = adj.degree()
+        self_loop_weight = (~adj.has_self_loop()).float() if self.add_self_loops else torch.zeros_like(deg)
+        scale_in, scale_out = self._get_normalization_scales(deg + self_loop_weight)
+
+        def propagate(x: torch.Tensor) -> torch.Tensor:
+            x = scale_in[:, None] * x
+            out = adj.matmul(x, self.n_chunks) + self_loop_weight[:, None] * x
+            return scale_out[:, None] * out
+
+        return self._forward_with_propagation(x, propagate)
+
+    def _check_custom_propagation(self, adj_description: str):
+        if self.gdc_params is not None or self.svd_params is not None or self.jaccard_params is not None:
+            raise NotImplementedError(f'{adj_description} is not supported with GDC, SVD or Jaccard')
+        if any(type(layer[0]) is not ChainableGCNConv for layer in self.layers):
+            raise NotImplementedError(f'{adj_description} is only supported by the GCN convolution')
+
+    def _get_normalization_scales(self, deg: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Scales of the input and output of the propagation for the degrees `deg` (see `GCN.normalize`).
+        """
+        if self.row_norm:
+            return torch.ones_like(deg), 1 / deg.masked_fill(deg == 0, 1)
+        deg_inv_sqrt = deg.pow(-0.5)
+        deg_inv_sqrt = deg_inv_sqrt.masked_fill(deg_inv_sqrt == float('inf'), 0)
+        return deg_inv_sqrt, deg_inv_sqrt
+
+    def _forward_with_propagation(self, x: torch.Tensor,
+                                  propagate: Callable[[torch.Tensor], torch.Tensor]) -> torch.Tensor:
+        for layer in self.layers:
+            x = layer[0].forward_with_propagation(x, propagate)
+            for module in list(layer)[1:]:
+                x = module(x)
+        return x
+
     @ staticmethod
     def parse_forward_input(data: Optional[Union[Data, TensorType["n_nodes", "n_features"]]] = None,
                             adj: Optional[Union[SparseTensor,
@@ -282,6 +402,50 @@ class GCN(nn.Module):
     def release_cache(self):
         self.adj_preped = None
 
+    def supports_normalized_input(self) -> bool:
+        """Normalized input (see `use_normalized_input`) requires `do_normalize_adj_once` and is not supported with the
+        GDC, SVD or Jaccard preprocessing.
+        """
+        return (self.do_normalize_adj_once and self.gdc_params is None and self.svd_params is None
+                and self.jaccard_params is None)
+
+    def receptive_field_hops(self) -> Optional[int]:
+        """Number of hops around a node that determine its logits including the degrees of the outermost nodes
+        (e.g. to only propagate on a subgraph, see `DistributedPRBCD`). None if the model is not local (GDC or SVD).
+        """
+        if self.gdc_params is not None or self.svd_params is not None:
+            return None
+        return len(self.layers) + 1
+
+    def use_normalized_input(self, do_use: bool = True):
+        """If true the adjacency matrix passed to `forward` must already be normalized (e.g. via
+        `IncrementalNormalization`).
+
+        Parameters
+        ----------
+        do_use : bool, optional
+            Whether the input is normalized, by default True
+        """
+        if do_use and not self.supports_normalized_input():
+            raise NotImplementedError('Normalized input requires `do_normalize_adj_once` and no preprocessing')
+        self.is_input_normalized = do_use
+
+    def restrict_edge_weight_gradient(self, node_idx: Optional[torch.Tensor] = None):
+        """Only calculate the gradient towards the (normalized) edge weights of the edges incident to `node_idx` in the
+        message passing (e.g. to obtain the gradient towards a block of edges). This is exact for edges between these
+        nodes but not in combination with the GDC or SVD preprocessing. `None` deactivates the restriction.
+
+        Parameters
+        ----------
+        node_idx : torch.Tensor, optional
+            Indices of the nodes, by default None
+        """
+        if node_idx is not None and (self.gdc_params is not None or self.svd_params is not None):
+            logging.warning('The edge weight gradient cannot be restricted in combination with GDC or SVD')
+            node_idx = None
+        for layer in self.layers:
+            layer[0].edge_gradient_node_idx = node_idx
+
     def _ensure_contiguousness(self,
                                x: torch.Tensor,
                                edge_idx: Union[torch.Tensor, SparseTensor],
@@ -379,8 +543,9 @@ class GCN(nn.Module):
         if self.do_normalize_adj_once:
             self._deactivate_normalization()
 
-            n = x.shape[0]
-            edge_idx, edge_weight = GCN.normalize(edge_idx, n, edge_weight, self.add_self_loops, self.row_norm)
+            if not self.is_input_normalized:
+                n = x.shape[0]
+                edge_idx, edge_weight = GCN.normalize(edge_idx, n, edge_weight, self.add_self_loops, self.row_norm)
 
         if self.do_use_sparse_tensor:
             if hasattr(SparseTensor, 'from_edge_index'):
@@ -423,6 +588,148 @@ class GCN(nn.Module):
         return edge_idx, edge_weight
 
 
+class IncrementalNormalization(object):
+    """Normalization of the adjacency matrix (same as `GCN.normalize`) for a clean graph plus a (small) block of
+    changed edge weights. The degrees, edge indices and normalized weights of the clean graph are calculated once and
+    only the entries incident to nodes with a changed degree are renormalized. The result is differentiable w.r.t. the
+    block's weights.
+
+    Parameters
+    ----------
+    lin_idx : torch.Tensor
+        Sorted and unique linear indices (`row * n + col`) of the clean edges.
+    edge_weight : torch.Tensor
+        Weights of the clean edges.
+    n : int
+        Number of nodes.
+    add_self_loops : bool, optional
+        If true self-loops are added to nodes without self-loop (in the clean graph), by default True
+    row_norm : bool, optional
+        If true use row normalization otherwise symmetric, by default False
+    is_symmetric : bool, optional
+        If true the sparsity pattern of the merged graph is symmetric (e.g. the block is mirrored for an undirected
+        graph) and the entries of a column are found via the entries of the respective row (instead of scanning all
+        edges), by default False
+    """
+
+    def __init__(self, lin_idx: torch.Tensor, edge_weight: torch.Tensor, n: int, add_self_loops: bool = True,
+                 row_norm: bool = False, is_symmetric: bool = False):
+        self.n = n
+        self.row_norm = row_norm
+        self.is_symmetric = is_symmetric
+        self.lin_idx = lin_idx
+        self.edge_index = torch.stack((lin_idx // n, lin_idx % n))
+        row, col = self.edge_index
+
+        if add_self_loops:
+            has_self_loop = torch.zeros(n, dtype=torch.bool, device=lin_idx.device)
+            has_self_loop[row[row == col]] = True
+            self.self_loop_idx = (~has_self_loop).nonzero().flatten()
+        else:
+            self.self_loop_idx = lin_idx.new_zeros(0)
+        # Position of a node's self-loop in `self_loop_idx` (-1 if it has none)
+        self.self_loop_pos = torch.full((n,), -1, dtype=torch.long, device=lin_idx.device)
+        self.self_loop_pos[self.self_loop_idx] = torch.arange(self.self_loop_idx.size(0), device=lin_idx.device)
+
+        self.edge_weight = edge_weight.detach()
+        self.deg = scatter_add(self.edge_weight, row if row_norm else col, dim=0, dim_size=n)
+        self.deg[self.self_loop_idx] += 1
+        self.normalized_edge_weight = self._normalize(row, col, self.edge_weight, self.deg)
+        self.normalized_self_loop_weight = self._normalize(
+            self.self_loop_idx, self.self_loop_idx, torch.ones_like(self.self_loop_idx, dtype=self.deg.dtype), self.deg
+        )
+
+    def _normalize(self, row: torch.Tensor, col: torch.Tensor, edge_weight: torch.Tensor,
+                   deg: torch.Tensor) -> torch.Tensor:
+        if self.row_norm:
+            return edge_weight / deg.masked_fill(deg == 0, 1)[row]
+        deg_inv_sqrt = deg.pow(-0.5)
+        deg_inv_sqrt = deg_inv_sqrt.masked_fill(deg_inv_sqrt == float('inf'), 0)
+        return deg_inv_sqrt[row] * edge_weight * deg_inv_sqrt[col]
+
+    def _get_affected_pos(self, merged_lin_idx: torch.Tensor, merged_edge_index: torch.Tensor,
+                          node_idx: torch.Tensor) -> torch.Tensor:
+        """Positions of the merged entries incident to `node_idx` (only the rows for row normalization).
+        """
+        # The entries of a row are contiguous in the sorted linear indices
+        start = torch.searchsorted(merged_lin_idx, node_idx * self.n)
+        count = torch.searchsorted(merged_lin_idx, (node_idx + 1) * self.n) - start
+        offset = (torch.arange(int(count.sum()), device=start.device)
+                  - (count.cumsum(0) - count).repeat_interleave(count))
+        row_pos = start.repeat_interleave(count) + offset
+        if self.row_norm:
+            return row_pos
+
+        if self.is_symmetric:
+            # The entries of the columns are the transposed entries of the rows
+            col_pos = torch.searchsorted(merged_lin_idx,
+                                         merged_edge_index[1, row_pos] * self.n + merged_edge_index[0, row_pos])
+        else:
+            is_changed = torch.zeros(self.n, dtype=torch.bool, device=node_idx.device)
+            is_changed[node_idx] = True
+            col_pos = is_changed[merged_edge_index[1]].nonzero().flatten()
+        return torch.cat((row_pos, col_pos)).unique()
+
+    def normalize(self, merged_lin_idx: torch.Tensor, merged_edge_weight: torch.Tensor, merged_pos: torch.Tensor,
+                  block_merged_pos: torch.Tensor) -> Tuple[TensorType[2, "nnz_after"], TensorType["nnz_after"]]:
+        """Normalizes the clean graph merged with the block (see `rgnn_at_scale.helper.utils.sorted_merge_positions`).
+
+        Parameters
+        ----------
+        merged_lin_idx : torch.Tensor
+            Sorted and unique linear indices of the merged edges.
+        merged_edge_weight : torch.Tensor
+            Weights of the merged edges (that only differ from the clean weights at `block_merged_pos`).
+        merged_pos : torch.Tensor
+            Positions of the clean edges in the merged edges.
+        block_merged_pos : torch.Tensor
+            Positions of the block edges in the merged edges.
+
+        Returns
+        -------
+        Tuple[torch.Tensor, torch.Tensor]
+            Edge indices and normalized edge weights (including the self-loops).
+        """
+        n_merged = merged_lin_idx.size(0)
+        n_self_loops = self.self_loop_idx.size(0)
+        block_lin_idx = merged_lin_idx[block_merged_pos]
+        block_row, block_col = block_lin_idx // self.n, block_lin_idx % self.n
+
+        # Only the block's edges are decoded, the clean ones are copied
+        edge_index = self.edge_index.new_empty((2, n_merged + n_self_loops))
+        edge_index[:, merged_pos] = self.edge_index
+        edge_index[:, block_merged_pos] = torch.stack((block_row, block_col))
+        edge_index[:, n_merged:] = self.self_loop_idx
+
+        # Apply the changes of the block to the degrees
+        clean_pos = torch.searchsorted(self.lin_idx, block_lin_idx).clamp_max(self.lin_idx.size(0) - 1)
+        block_clean_edge_weight = torch.where(self.lin_idx[clean_pos] == block_lin_idx, self.edge_weight[clean_pos],
+                                              torch.zeros_like(self.edge_weight[clean_pos]))
+        block_deg_idx = block_row if self.row_norm else block_col
+        delta = merged_edge_weight[block_merged_pos] - block_clean_edge_weight
+        deg = self.deg.index_add(0, block_deg_idx, delta)
+
+        # Only renormalize the entries with a changed degree
+        node_idx = block_deg_idx.unique()
+        normalized_edge_weight = self.normalized_edge_weight.new_zeros(n_merged)
+        normalized_edge_weight[merged_pos] = self.normalized_edge_weight
+        affected_pos = self._get_affected_pos(merged_lin_idx, edge_index[:, :n_merged], node_idx)
+        normalized_edge_weight = normalized_edge_weight.index_put(
+            (affected_pos,),
+            self._normalize(edge_index[0, affected_pos], edge_index[1, affected_pos], merged_edge_weight[affected_pos],
+                            deg)
+        )
+
+        self_loop_pos = self.self_loop_pos[node_idx]
+        self_loop_pos = self_loop_pos[self_loop_pos >= 0]
+        self_loop_idx = self.self_loop_idx[self_loop_pos]
+        self_loop_weight = self.normalized_self_loop_weight.index_put(
+            (self_loop_pos,),
+            self._normalize(self_loop_idx, self_loop_idx, torch.ones_like(self_loop_idx, dtype=deg.dtype), deg)
+        )
+        return edge_index, torch.cat((normalized_edge_weight, self_loop_weight))
+
+
 class DenseGraphConvolution(nn.Module):
     """Dense GCN convolution layer for the FGSM attack that requires a gradient towards the adjacency matrix.
     """
@@ -254,6 +254,7 @@ class PPRGoWrapperBase(ABC):
                                                     temperature=1.0,
                                                     with_weight_correction=True),
                  ppr_cache_params: Dict[str, Any] = None,
+                 max_oom_backoffs: int = 0,
                  **kwargs):
         """
         Parameters
@@ -281,6 +282,9 @@ class PPRGoWrapperBase(ABC):
         forward_batch_size: int, optional
             In case the forward method does not recieve ppr_scores, this argument specifies how large the batches
             will be that are processed at once in a single forward pass.
+        max_oom_backoffs: int, optional
+            Number of times the `forward_batch_size` is halved if a batch runs out of memory, by default 0. The
+            adjusted `forward_batch_size` is kept in `adjusted_params`.
         alpha: int, optional
             The alpha value (restart probability) that is used to calculate the approximate topk ppr matrix
         eps: int, optional
@@ -325,6 +329,9 @@ class PPRGoWrapperBase(ABC):
         self.mean = mean
         self.mean_kwargs = mean_kwargs
         self.ppr_cache_params = ppr_cache_params
+        self.max_oom_backoffs = max_oom_backoffs
+        # Parameters adjusted as the batched inference ran out of memory
+        self.adjusted_params: Dict[str, Any] = {}
 
     @abstractmethod
     def model_forward(self, *args, **kwargs):
@@ -416,33 +423,45 @@ class PPRGoWrapperBase(ABC):
                 ppr_matrix=topk_ppr,
                 indices=ppr_idx,
                 allow_cache=False)
-            data_loader = torch.utils.data.DataLoader(
-                dataset=data_set,
-                sampler=torch.utils.data.BatchSampler(
-                    torch.utils.data.SequentialSampler(data_set),
-                    batch_size=self.forward_batch_size, drop_last=False
-                ),
-                batch_size=None,
-                num_workers=0,
-            )
             num_predictions = topk_ppr.shape[0]
 
             logits = torch.zeros(num_predictions, self.n_classes, device="cpu", dtype=torch.float32)
 
-            num_batches = len(data_loader)
-            display_step = max(int(num_batches / 10), 1)
-            for batch_id, (idx, xbs, _) in enumerate(data_loader):
-
+            batch_id = 0
+            start = 0
+            while start < num_predictions:
+                num_batches = batch_id + int(np.ceil((num_predictions - start) / self.forward_batch_size))
+                display_step = max(int(num_batches / 10), 1)
                 if batch_id % display_step == 0:
                     logging.info(f"Memory Usage before inference batch {batch_id}/{num_batches}:")
                     logging.info(utils.get_max_memory_bytes() / (1024 ** 3))
                     if device.type == "cuda":
                         logging.info(torch.cuda.max_memory_allocated() / (1024 ** 3))
 
-                xbs = [xb.to(device) for xb in xbs]
-                start = batch_id * self.forward_batch_size
-                end = start + xbs[1].size(0)  # batch_id * batch_size
-                logits[start:end] = self.model_forward(*xbs).cpu()
+                end = min(start + self.forward_batch_size, num_predictions)
+                try:
+                    _, xbs, _ = data_set[np.arange(start, end)]
+                    xbs = [xb.to(device) for xb in xbs]
+                    logits[start:end] = self.model_forward(*xbs).cpu()
+                except (RuntimeError, MemoryError) as error:
+                    if (
+                        not utils.is_out_of_memory(error)
+                        or self.adjusted_params.get('n_oom_backoffs', 0) >= self.max_oom_backoffs
+                        or self.forward_batch_size == 1
+                    ):
+                        raise
+                    logging.warning(f"Out of memory ({error})")
+                    xbs = None
+                else:
+                    batch_id += 1
+                    start = end
+                    continue
+                # The memory of the failed batch is only released after leaving the `except` clause
+                utils.free_memory()
+                self.forward_batch_size //= 2
+                self.adjusted_params['forward_batch_size'] = self.forward_batch_size
+                self.adjusted_params['n_oom_backoffs'] = self.adjusted_params.get('n_oom_backoffs', 0) + 1
+                logging.warning(f"Retrying with forward_batch_size={self.forward_batch_size}")
 
             return logits
 
@@ -1,11 +1,12 @@
-from typing import Any,  Dict,  Union
+from typing import Any,  Dict, Optional, Union
 
 
 import torch
 
 from torch_sparse import SparseTensor
 
-from rgnn_at_scale.aggregation import ROBUST_MEANS, chunked_message_and_aggregate
+from rgnn_at_scale.aggregation import (ROBUST_MEANS, TopKNeighborhoodCache, changed_rows,
+                                       chunked_message_and_aggregate, incremental_aggregation, neighborhood_rows)
 from rgnn_at_scale.models.gcn import ChainableGCNConv
 from rgnn_at_scale.models.gcn import GCN
 
@@ -24,14 +25,26 @@ class RGNNConv(ChainableGCNConv):
         The desired mean (see above for the options), by default 'soft_k_medoid'
     mean_kwargs : Dict[str, Any], optional
         Arguments for the mean, by default dict(k=64, temperature=1.0, with_weight_correction=True)
+    top_k_cache : TopKNeighborhoodCache, optional
+        Cache for the top k neighborhood of the adjacency matrix (e.g. shared among layers), by default None
     """
 
     def __init__(self, mean='soft_k_medoid',
                  mean_kwargs: Dict[str, Any] = dict(k=64, temperature=1.0, with_weight_correction=True),
+                 top_k_cache: Optional[TopKNeighborhoodCache] = None,
                  **kwargs):
         super().__init__(**kwargs)
         self._mean = ROBUST_MEANS[mean]
-        self._mean_kwargs = mean_kwargs
+        self._mean_kwargs = dict(mean_kwargs)
+        if top_k_cache is not None:
+            self._mean_kwargs['top_k_cache'] = top_k_cache
+        self.do_incremental = False
+        self._incremental_state = None
+        # Nodes with changed incident entries of the adjacency matrix (see `RGNN.set_changed_nodes`)
+        self.changed_node_idx: Optional[torch.Tensor] = None
+        self.is_adj_symmetric = False
+        # Depth of the layer, i.e. the changed rows are within this many hops of the changed nodes
+        self.changed_hops = 1
 
     def message_and_aggregate(self, adj_t) -> torch.Tensor:
         raise NotImplementedError
@@ -41,14 +54,53 @@ class RGNNConv(ChainableGCNConv):
         if not isinstance(edge_index, SparseTensor):
             edge_weights = kwargs['norm'] if 'norm' in kwargs else kwargs['edge_weight']
             A = SparseTensor.from_edge_index(edge_index, edge_weights, (x.size(0), x.size(0)))
+            if self.do_incremental and not torch.is_grad_enabled():
+                return self._incremental_aggregate(A, x)
             return self._mean(A, x, **self._mean_kwargs)
 
+        if self.do_incremental and not torch.is_grad_enabled():
+            return self._incremental_aggregate(edge_index, x)
+        return self._aggregate(edge_index, x)
+
+    def _aggregate(self, A: SparseTensor, x: torch.Tensor) -> torch.Tensor:
         def aggregate(edge_index: SparseTensor, x: torch.Tensor):
             return self._mean(edge_index, x, **self._mean_kwargs)
-        if self.do_chunk:
-            return chunked_message_and_aggregate(edge_index, x, n_chunks=self.n_chunks, aggregation_function=aggregate)
+        if self.do_chunk_now():
+            return chunked_message_and_aggregate(A, x, n_chunks=self.n_chunks, aggregation_function=aggregate,
+                                                 n_threads=self.n_chunk_threads)
+        else:
+            return aggregate(A, x)
+
+    def _incremental_aggregate(self, A: SparseTensor, x: torch.Tensor) -> torch.Tensor:
+        """Only recalculates the rows that changed w.r.t. the previous (no grad) forward pass."""
+        if (
+            self._incremental_state is not None
+            and self._incremental_state[0].sizes() == A.sizes()
+            and self._incremental_state[1].shape == x.shape
+        ):
+            previous_A, previous_x, previous_embeddings, previous_changed_node_idx = self._incremental_state
+            if self.changed_node_idx is not None and previous_changed_node_idx is not None:
+                # Both graphs only differ from the clean graph at the entries incident to the changed nodes
+                node_idx = torch.cat((previous_changed_node_idx, self.changed_node_idx)).unique()
+                is_changed = neighborhood_rows(A, node_idx, self.changed_hops, self.is_adj_symmetric)
+            else:
+                is_changed = changed_rows(A, x, previous_A, previous_x)
+            # The top k neighborhood of the changed rows must not evict the one of the full adjacency matrix
+            mean_kwargs = {key: value for key, value in self._mean_kwargs.items() if key != 'top_k_cache'}
+            embeddings = incremental_aggregation(A, x, previous_embeddings, is_changed,
+                                                 aggregation_function=self._mean, **mean_kwargs)
         else:
-            return aggregate(edge_index, x)
+            embeddings = self._aggregate(A, x)
+        self._incremental_state = (A, x, embeddings, self.changed_node_idx)
+        return embeddings
+
+    def activate_incremental_aggregation(self):
+        self.do_incremental = True
+
+    def deactivate_incremental_aggregation(self):
+        self.do_incremental = False
+        self._incremental_state = None
+        self.changed_node_idx = None
 
 
 class RGNN(GCN):
@@ -73,17 +125,78 @@ class RGNN(GCN):
         The desired mean (see above for the options), by default 'soft_k_medoid'
     mean_kwargs : Dict[str, Any], optional
         Arguments for the mean, by default dict(k=64, temperature=1.0, with_weight_correction=True)
+    do_cache_top_k : bool, optional
+        If true the top k neighborhood of the (normalized) adjacency matrix is memoized across layers and forward
+        passes (only relevant for the `soft_k_medoid`), by default False
+
+    Use `activate_incremental_aggregation` to only recalculate the rows of the robust aggregation that changed w.r.t.
+    the previous forward pass without gradient (e.g. for monitoring an attack where only a block of edges changes).
+    With `set_changed_nodes` these rows are the neighborhood of the block's endpoints (otherwise the adjacency matrices
+    and embeddings of both passes are compared).
     """
 
     def __init__(self,
                  mean: str = 'soft_k_medoid',
                  mean_kwargs: Dict[str, Any] = dict(k=64, temperature=1.0,
                                                     with_weight_correction=True),
+                 do_cache_top_k: bool = False,
                  **kwargs):
         self._mean_kwargs = dict(mean_kwargs)
         self._mean = mean
+        self._top_k_cache = None
+        if do_cache_top_k:
+            # With checkpointing the aggregation is executed for each chunk of the adjacency matrix
+            n_cached_adj = kwargs.get('n_chunks', 8) if kwargs.get('do_checkpoint', False) else 1
+            self._top_k_cache = TopKNeighborhoodCache(max_size=n_cached_adj)
         super().__init__(**kwargs)
 
     def _build_conv_layer(self, in_channels: int, out_channels: int):
-        return RGNNConv(mean=self._mean, mean_kwargs=self._mean_kwargs, in_channels=in_channels,
-                        out_channels=out_channels, do_chunk=self.do_checkpoint, n_chunks=self.n_chunks)
+        return RGNNConv(mean=self._mean, mean_kwargs=self._mean_kwargs, top_k_cache=self._top_k_cache,
+                        in_channels=in_channels, out_channels=out_channels, do_chunk=self.do_checkpoint,
+                        n_chunks=self.n_chunks, n_chunk_threads=self.n_chunk_threads)
+
+    def release_cache(self):
+        super().release_cache()
+        if self._top_k_cache is not None:
+            self._top_k_cache.invalidate()
+        for module in self.modules():
+            if isinstance(module, RGNNConv):
+                module._incremental_state = None
+
+    def receptive_field_hops(self) -> Optional[int]:
+        # The memoized top k neighborhood refers to the full adjacency matrix
+        if self._top_k_cache is not None:
+            return None
+        return super().receptive_field_hops()
+
+    def activate_incremental_aggregation(self):
+        for module in self.modules():
+            if isinstance(module, RGNNConv):
+                module.activate_incremental_aggregation()
+
+    def deactivate_incremental_aggregation(self):
+        for module in self.modules():
+            if isinstance(module, RGNNConv):
+                module.deactivate_incremental_aggregation()
+
+    def set_changed_nodes(self, node_idx: Optional[torch.Tensor] = None, is_symmetric: bool = False):
+        """Declares that the adjacency matrix of the next forward passes only differs from the clean one at the entries
+        incident to `node_idx` (e.g. the endpoints of a block of edges, an empty tensor for the clean graph). The
+        incremental aggregation then recalculates the rows within as many hops of `node_idx` as the layer's depth.
+        This is not supported in combination with the GDC or SVD preprocessing. `None` falls back to comparing the
+        forward passes (see `activate_incremental_aggregation`).
+
+        Parameters
+        ----------
+        node_idx : torch.Tensor, optional
+            Indices of the nodes, by default None
+        is_symmetric : bool, optional
+            If true the sparsity pattern of the adjacency matrix is symmetric (e.g. for an undirected graph), by default
+            False
+        """
+        if self.gdc_params is not None or self.svd_params is not None:
+            node_idx = None
+        for depth, layer in enumerate(self.layers):
+            layer[0].changed_node_idx = node_idx
+            layer[0].is_adj_symmetric = is_symmetric
+            layer[0].changed_hops = depth + 1
@@ -1,11 +1,21 @@
 import os
+import subprocess
+import sys
 
 import torch
+import torch_scatter
+import torch_sparse
 from torch_sparse import SparseTensor
 
-from rgnn_at_scale.aggregation import (_sparse_top_k, soft_weighted_medoid, soft_weighted_medoid_k_neighborhood,
-                                       weighted_dimwise_median, weighted_medoid, weighted_medoid_k_neighborhood,
-                                       soft_median)
+from rgnn_at_scale.aggregation import (TopKNeighborhoodCache, _sparse_top_k, _sparse_top_k_csr,
+                                       blocked_dense_cpu_soft_weighted_medoid_k_neighborhood,
+                                       changed_rows, chunked_message_and_aggregate,
+                                       dense_cpu_soft_weighted_medoid_k_neighborhood, edge_restricted_matmul,
+                                       incremental_aggregation, neighborhood_rows,
+                                       partial_distance_matrix, partial_weighted_distances, soft_median,
+                                       soft_weighted_medoid, soft_weighted_medoid_k_neighborhood,
+                                       weighted_dimwise_median, weighted_dimwise_median_cpu, weighted_medoid,
+                                       weighted_medoid_k_neighborhood)
 
 
 device = 0 if torch.cuda.is_available() else 'cpu'
@@ -15,6 +25,130 @@ adj_bug_path = "tests/data_/adj_bug.tensor"
 x_bug_path = "tests/data_/x_bug.tensor"
 
 
+class TestChunker():
+
+    def test_threaded_matches_sequential(self):
+        torch.manual_seed(42)
+        n, d = 100, 8
+        A = SparseTensor.from_dense(torch.rand(n, n) * (torch.rand(n, n) < 0.1)).to(device)
+        x = torch.randn(n, d, device=device)
+
+        with torch.no_grad():
+            for aggregation_function in [None, soft_weighted_medoid]:
+                expected = chunked_message_and_aggregate(A, x, n_chunks=7, aggregation_function=aggregation_function)
+                result = chunked_message_and_aggregate(A, x, n_chunks=7, aggregation_function=aggregation_function,
+                                                       n_threads=4)
+                assert torch.allclose(expected, result)
+
+    def test_threaded_with_workqueue_threading_layer(self):
+        # Numba's workqueue layer aborts the process if parallel kernels are called concurrently
+        script = '''
+import torch
+from torch_sparse import SparseTensor
+from rgnn_at_scale.aggregation import chunked_message_and_aggregate, weighted_dimwise_median
+
+torch.manual_seed(42)
+A = SparseTensor.from_dense(torch.rand(500, 500) * (torch.rand(500, 500) < 0.1))
+x = torch.randn(500, 16)
+with torch.no_grad():
+    for _ in range(5):
+        chunked_message_and_aggregate(A, x, n_chunks=16, aggregation_function=weighted_dimwise_median, n_threads=8)
+'''
+        env = dict(os.environ, NUMBA_THREADING_LAYER='workqueue')
+        result = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
+
+class TestEdgeRestrictedMatmul():
+
+    def test_block_gradient_matches_matmul(self):
+        torch.manual_seed(42)
+        n, d = 50, 8
+        edge_index = torch_sparse.coalesce(torch.randint(n, (2, 300)), torch.ones(300), n, n)[0].to(device)
+        x = torch.randn(n, d, device=device)
+        block_size = 20
+        block_edge_weight = torch.rand(block_size, device=device, requires_grad=True)
+        node_mask = torch.zeros(n, dtype=torch.bool, device=device)
+        node_mask[edge_index[:, :block_size].flatten()] = True
+
+        def block_gradient(matmul):
+            edge_weight = torch.cat((block_edge_weight, torch.ones(edge_index.size(1) - block_size, device=device)))
+            row, col = edge_index
+            deg_inv_sqrt = torch_scatter.scatter_add(edge_weight, col, dim_size=n).pow(-0.5)
+            deg_inv_sqrt = deg_inv_sqrt.masked_fill(torch.isinf(deg_inv_sqrt), 0)
+            A = SparseTensor(row=row, col=col, value=deg_inv_sqrt[row] * edge_weight * deg_inv_sqrt[col],
+                             sparse_sizes=(n, n))
+            loss = matmul(A, matmul(A, x)).pow(2).sum()
+            return torch.autograd.grad(loss, block_edge_weight)[0]
+
+        expected = block_gradient(lambda A, x: torch_sparse.matmul(A, x, reduce='sum'))
+        result = block_gradient(lambda A, x: edge_restricted_matmul(A, x, node_mask))
+        assert torch.allclose(expected, result, atol=1e-6)
+
+
+class TestIncrementalAggregation():
+
+    def test_matches_full_aggregation(self):
+        torch.manual_seed(42)
+        n, d = 100, 8
+        A_dense = torch.rand(n, n) * (torch.rand(n, n) < 0.1)
+        x = torch.randn(n, d)
+        previous_A = SparseTensor.from_dense(A_dense).to(device)
+        previous_x = x.clone().to(device)
+        previous_embeddings = soft_median(previous_A, previous_x)
+
+        A_dense[:3] = torch.rand(3, n) * (torch.rand(3, n) < 0.1)
+        x[5] += 1
+        A = SparseTensor.from_dense(A_dense).to(device)
+        x = x.to(device)
+
+        is_changed = changed_rows(A, x, previous_A, previous_x)
+        expected_is_changed = (A_dense[:, 5] != 0).to(device)
+        expected_is_changed[:3] = True
+        assert torch.equal(is_changed, expected_is_changed)
+
+        embeddings = incremental_aggregation(A, x, previous_embeddings, is_changed, aggregation_function=soft_median)
+        assert torch.allclose(embeddings, soft_median(A, x))
+
+
+class TestNeighborhoodRows():
+
+    def test_matches_changed_rows(self):
+        torch.manual_seed(42)
+        n, d = 100, 8
+        A_dense = torch.rand(n, n) * (torch.rand(n, n) < 0.05)
+        A_dense = A_dense + A_dense.T
+        x = torch.randn(n, d)
+        previous_A = SparseTensor.from_dense(A_dense).to(device)
+
+        # Change the edges between a few nodes and renormalize (i.e. also the entries incident to these nodes change)
+        node_idx = torch.tensor([3, 17, 42])
+        A_dense[node_idx[:, None], node_idx] = 1 - A_dense[node_idx[:, None], node_idx]
+        deg = A_dense.sum(-1)
+        previous_deg = previous_A.to_dense().cpu().sum(-1)
+        A = SparseTensor.from_dense(A_dense / deg.sqrt()[:, None] / deg.sqrt()).to(device)
+        previous_A = SparseTensor.from_dense(
+            previous_A.to_dense().cpu() / previous_deg.sqrt()[:, None] / previous_deg.sqrt()
+        ).to(device)
+        x = x.to(device)
+        node_idx = node_idx.to(device)
+
+        expected_is_changed = changed_rows(A, x, previous_A, x)
+        for is_symmetric in [False, True]:
+            assert torch.equal(neighborhood_rows(A, node_idx, is_symmetric=is_symmetric), expected_is_changed)
+
+    def test_hops(self):
+        # Path graph 0 - 1 - 2 - 3 - 4
+        row = torch.tensor([0, 1, 1, 2, 2, 3, 3, 4])
+        col = torch.tensor([1, 0, 2, 1, 3, 2, 4, 3])
+        A = SparseTensor(row=row, col=col, sparse_sizes=(5, 5)).to(device)
+        node_idx = torch.tensor([0], device=device)
+        for is_symmetric in [False, True]:
+            assert neighborhood_rows(A, node_idx, 2, is_symmetric).tolist() == [True, True, True, False, False]
+            assert neighborhood_rows(A, node_idx, 10, is_symmetric).all()
+            assert neighborhood_rows(A, node_idx[:0], 2, is_symmetric).sum() == 0
+
+
 class TestTopK():
 
     def test_simple_example_cpu(self):
@@ -31,6 +165,19 @@ class TestTopK():
         )
         assert torch.all(topk_indices[:-1] == torch.tensor([[0, 3, 1], [0, 1, -1], [2, 3, -1]]))
 
+    def test_csr_matches_dense_cpu(self):
+        torch.manual_seed(42)
+        n, k = 100, 8
+        A = torch.rand(n, n) * (torch.rand(n, n) < 0.1)
+        rowptr, col, value = SparseTensor.from_dense(A).csr()
+
+        topk_values, topk_indices = _sparse_top_k_csr(rowptr, col, value, k)
+        topk_values_dense, _ = torch.topk(A, k, dim=1)
+
+        assert torch.all(topk_values == topk_values_dense)
+        mask = topk_indices != -1
+        assert torch.all(A[torch.arange(n)[:, None].expand(n, k)[mask], topk_indices[mask]] == topk_values[mask])
+
     if torch.cuda.is_available():
         def test_simple_example_cuda(self):
             A = torch.tensor([[0.5, 0.3, 0, 0.4], [0.3, 0.2, 0, 0], [0, 0, 0.9, 0.3],
@@ -45,6 +192,27 @@ class TestTopK():
             assert torch.all(topk_indices[:-1] == torch.tensor([[0, 3, 1], [0, 1, -1], [2, 3, -1]]).cuda())
 
 
+class TestPartialWeightedDistances():
+
+    def test_matches_partial_distance_matrix(self):
+        torch.manual_seed(42)
+        n, d, batch_size, k = 50, 8, 20, 6
+        x = torch.randn(n, d, device=device, requires_grad=True)
+        partial_idx = torch.stack([torch.randperm(n)[:k] for _ in range(batch_size)]).to(device)
+        partial_idx[0, 2:] = -1
+        partial_weights = (torch.rand(batch_size, k, device=device) * (partial_idx != -1)).requires_grad_()
+
+        distances = partial_weighted_distances(x, partial_idx, partial_weights, block_size=3)
+        grad_x, grad_weights = torch.autograd.grad(distances.sum(), (x, partial_weights))
+
+        expected_distances = (partial_weights[:, None, :] * partial_distance_matrix(x, partial_idx)).sum(-1)
+        expected_grad_x, expected_grad_weights = torch.autograd.grad(expected_distances.sum(), (x, partial_weights))
+
+        assert torch.allclose(distances, expected_distances, atol=1e-5)
+        assert torch.allclose(grad_x, expected_grad_x, atol=1e-5)
+        assert torch.allclose(grad_weights, expected_grad_weights, atol=1e-5)
+
+
 class TestWeightedMedoid():
 
     def test_simple_example_weighted(self):
@@ -86,6 +254,20 @@ class TestWeightedMedoid():
         layer_idx = 3
         assert torch.all(medoids[layer_idx] == row_sum[layer_idx] * x[2])
 
+    def test_matches_dense_reference(self):
+        torch.manual_seed(42)
+        n, d = 60, 8
+        A = torch.rand(n, n) * (torch.rand(n, n) < 0.1)
+        A[0] = 0
+        x = torch.randn(n, d)
+        medoids = weighted_medoid(SparseTensor.from_dense(A), x)
+
+        distances = A @ torch.cdist(x, x)
+        distances[A == 0] = float('inf')
+        expected_medoids = A.sum(-1)[:, None] * x[distances.argmin(-1)]
+
+        assert torch.allclose(medoids, expected_medoids, atol=1e-5)
+
 
 class TestSoftWeightedMedoid():
 
@@ -126,6 +308,25 @@ class TestSoftWeightedMedoid():
         layer_idx = 3
         assert torch.all(medoids[layer_idx] == row_sum[layer_idx] * x[2])
 
+    def test_matches_dense_k_neighborhood(self):
+        torch.manual_seed(42)
+        n, d = 60, 8
+        A = torch.rand(n, n) * (torch.rand(n, n) < 0.1)
+        A[0] = 0
+        x = torch.randn(n, d, requires_grad=True)
+
+        for with_weight_correction in [False, True]:
+            medoids = soft_weighted_medoid(SparseTensor.from_dense(A), x,
+                                           with_weight_correction=with_weight_correction)
+            # With k=n the top k neighborhood is the whole neighborhood
+            expected_medoids = blocked_dense_cpu_soft_weighted_medoid_k_neighborhood(
+                SparseTensor.from_dense(A), x, k=n, with_weight_correction=with_weight_correction)
+            # The (float32) distances via matrix multiplications suffer from cancellation on the diagonal
+            assert torch.allclose(medoids, expected_medoids, atol=1e-3)
+
+            medoids.sum().backward()
+            assert torch.all(torch.isfinite(x.grad))
+
 
 class TestWeightedMedoidKNeighborhood():
 
@@ -507,6 +708,50 @@ class TestSoftWeightedMedoidKNeighborhood():
                                                 # forcing sparse implementation
                                                 threshold_for_dense_if_cpu=0)
 
+    def test_blocked_dense_matches_dense_cpu(self):
+        torch.manual_seed(42)
+        n, d, k = 60, 8, 4
+        A = torch.rand(n, n) * (torch.rand(n, n) < 0.1)
+        A[0] = 0
+        x = torch.randn(n, d, requires_grad=True)
+
+        for with_weight_correction in [False, True]:
+            medoids = dense_cpu_soft_weighted_medoid_k_neighborhood(
+                SparseTensor.from_dense(A), x, k=k, with_weight_correction=with_weight_correction)
+            # A small memory budget to force multiple blocks
+            medoids_blocked = blocked_dense_cpu_soft_weighted_medoid_k_neighborhood(
+                SparseTensor.from_dense(A), x, k=k, with_weight_correction=with_weight_correction,
+                max_memory_bytes=10 * n * 4)
+            # The (float32) distances via matrix multiplications suffer from cancellation on the diagonal
+            assert torch.allclose(medoids, medoids_blocked, atol=1e-3)
+
+            medoids_blocked.sum().backward()
+            assert torch.all(torch.isfinite(x.grad))
+
+    def test_top_k_cache(self):
+        torch.manual_seed(42)
+        n, d, k = 100, 8, 4
+        A = SparseTensor.from_dense(torch.rand(n, n) * (torch.rand(n, n) < 0.1)).to(device)
+        x = torch.randn(n, d, device=device)
+        top_k_cache = TopKNeighborhoodCache()
+
+        medoids = soft_weighted_medoid_k_neighborhood(A, x, k=k, threshold_for_dense_if_cpu=0)
+        for _ in range(2):
+            medoids_cached = soft_weighted_medoid_k_neighborhood(A, x, k=k, threshold_for_dense_if_cpu=0,
+                                                                 top_k_cache=top_k_cache)
+            assert len(top_k_cache._entries) == 1
+            assert torch.allclose(medoids, medoids_cached)
+
+        # In-place modifications must invalidate the entry
+        A.storage.value().mul_(2)
+        medoids = soft_weighted_medoid_k_neighborhood(A, x, k=k, threshold_for_dense_if_cpu=0)
+        medoids_cached = soft_weighted_medoid_k_neighborhood(A, x, k=k, threshold_for_dense_if_cpu=0,
+                                                             top_k_cache=top_k_cache)
+        assert torch.allclose(medoids, medoids_cached)
+
+        top_k_cache.invalidate()
+        assert len(top_k_cache._entries) == 0
+
 
 class TestWeightedDimwiseMedian():
 
@@ -555,65 +800,91 @@ class TestWeightedDimwiseMedian():
         assert median[layer_idx][1] == row_sum[layer_idx] * x[2][1]
         assert median[layer_idx][2] == row_sum[layer_idx] * x[1][2]
 
+    def test_sparse_matches_dense(self):
+        torch.manual_seed(42)
+        n, d = 50, 8
+        A = torch.rand(n, n) * (torch.rand(n, n) < 0.2)
+        x = torch.randn(n, d)
+
+        median_sparse = weighted_dimwise_median(SparseTensor.from_dense(A), x)
+        median_dense = weighted_dimwise_median_cpu(A, x)
+
+        assert torch.allclose(median_sparse, median_dense)
+
+    def test_approximate_high_degree_rows(self):
+        torch.manual_seed(42)
+        n, d = 20_000, 4
+        x = torch.rand(n, d, device=device)
+        A_dense = torch.zeros(2, n)
+        A_dense[0] = torch.rand(n)
+        A_dense[1, :10] = torch.rand(10)
+        A = SparseTensor.from_dense(A_dense).to(device)
+
+        exact = weighted_dimwise_median(A, x)
+        approx = weighted_dimwise_median(A, x, approx_degree_threshold=100, approx_eps=0.05, approx_delta=1e-3)
+
+        # The low degree row is not approximated
+        assert torch.allclose(exact[1], approx[1])
+        # Each dimension is uniformly distributed in [0, 1] and therefore the quantile error bounds the value error
+        assert ((exact[0] - approx[0]).abs() / A_dense[0].sum() < 0.1).all()
+
 
 class TestSoftMedian():
 
-    if torch.cuda.is_available():
-        def test_simple_example_weighted(self):
-            A = torch.tensor([[0.5, 0.3, 0, 0.4],
-                              [0.3, 0.2, 0, 0],
-                              [0, 0, 0.9, 0.3],
-                              [0.4, 0, 0.4, 0.4]], dtype=torch.float32).to(device)
-            x = torch.tensor([[-10, 10, 10],
-                              [-1, 1, 1],
-                              [0, 0, 0],
-                              [10, -10, -10]], dtype=torch.float32).to(device)
+    def test_simple_example_weighted(self):
+        A = torch.tensor([[0.5, 0.3, 0, 0.4],
+                          [0.3, 0.2, 0, 0],
+                          [0, 0, 0.9, 0.3],
+                          [0.4, 0, 0.4, 0.4]], dtype=torch.float32).to(device)
+        x = torch.tensor([[-10, 10, 10],
+                          [-1, 1, 1],
+                          [0, 0, 0],
+                          [10, -10, -10]], dtype=torch.float32).to(device)
 
-            A_sparse_tensor = SparseTensor.from_dense(A)
-            median = soft_median(A_sparse_tensor, x, temperature=temperature)
+        A_sparse_tensor = SparseTensor.from_dense(A)
+        median = soft_median(A_sparse_tensor, x, temperature=temperature)
 
-            row_sum = A.sum(-1)
-            layer_idx = 0
-            assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[1])
+        row_sum = A.sum(-1)
+        layer_idx = 0
+        assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[1])
 
-            layer_idx = 1
-            assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[0])
+        layer_idx = 1
+        assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[0])
 
-            layer_idx = 2
-            assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[2])
+        layer_idx = 2
+        assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[2])
 
-            layer_idx = 3
-            assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[2])
+        layer_idx = 3
+        assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[2])
 
-    if torch.cuda.is_available():
-        def test_simple_example_unweighted(self):
-            A = torch.tensor([[1, 1, 0, 1],
-                              [1, 1, 0, 0],
-                              [0, 0, 1, 1],
-                              [0, 1, 1, 1]], dtype=torch.float32).to(device)
-            x = torch.tensor([[-10, 10, 10],
-                              [-1, 1, 0],
-                              [0, 0, 1],
-                              [10, -10, -10]], dtype=torch.float32).to(device)
+    def test_simple_example_unweighted(self):
+        A = torch.tensor([[1, 1, 0, 1],
+                          [1, 1, 0, 0],
+                          [0, 0, 1, 1],
+                          [0, 1, 1, 1]], dtype=torch.float32).to(device)
+        x = torch.tensor([[-10, 10, 10],
+                          [-1, 1, 0],
+                          [0, 0, 1],
+                          [10, -10, -10]], dtype=torch.float32).to(device)
 
-            A_sparse_tensor = SparseTensor.from_dense(A)
-            median = soft_median(A_sparse_tensor, x, temperature=temperature)
+        A_sparse_tensor = SparseTensor.from_dense(A)
+        median = soft_median(A_sparse_tensor, x, temperature=temperature)
 
-            row_sum = A.sum(-1)
-            layer_idx = 0
-            assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[1])
+        row_sum = A.sum(-1)
+        layer_idx = 0
+        assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[1])
 
-            layer_idx = 1
-            assert torch.all(
-                (median[layer_idx] == row_sum[layer_idx] * x[0])
-                | (median[layer_idx] == row_sum[layer_idx] * x[1])
-            )
+        layer_idx = 1
+        assert torch.all(
+            (median[layer_idx] == row_sum[layer_idx] * x[0])
+            | (median[layer_idx] == row_sum[layer_idx] * x[1])
+        )
 
-            layer_idx = 2
-            assert torch.all(
-                (median[layer_idx] == row_sum[layer_idx] * x[2])
-                | (median[layer_idx] == row_sum[layer_idx] * x[3])
-            )
+        layer_idx = 2
+        assert torch.all(
+            (median[layer_idx] == row_sum[layer_idx] * x[2])
+            | (median[layer_idx] == row_sum[layer_idx] * x[3])
+        )
 
-            layer_idx = 3
-            assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[2])
+        layer_idx = 3
+        assert torch.all(median[layer_idx] == row_sum[layer_idx] * x[2])
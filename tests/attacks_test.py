@@ -0,0 +1,716 @@
+import logging
+import math
+import os
+import tempfile
+
+import numpy as np
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch_sparse
+
+from rgnn_at_scale.aggregation import TopKNeighborhoodCache
+from rgnn_at_scale.attacks.base_attack import Attack
+from rgnn_at_scale.attacks.dice import DICE
+from rgnn_at_scale.attacks.distributed_prbcd import DistributedPRBCD
+from rgnn_at_scale.attacks.greedy_rbcd import GreedyRBCD
+from rgnn_at_scale.attacks.local_prbcd import LocalPRBCD
+from rgnn_at_scale.attacks.prbcd import PRBCD, FuseEdges
+from rgnn_at_scale.helper.memmap_csr import MemmapCSR
+from rgnn_at_scale.helper.utils import isin_sorted, sorted_merge_positions, to_symmetric
+from rgnn_at_scale.models.gcn import GCN, IncrementalNormalization
+from rgnn_at_scale.models.pprgo import PPRGoWrapper
+from rgnn_at_scale.models.rgnn import RGNN
+from random_graphs import create_random_graph
+
+device = 0 if torch.cuda.is_available() else 'cpu'
+
+
+class TestFuseEdges():
+
+    def test_matches_coalesce(self):
+        torch.manual_seed(42)
+        n = 100
+        edge_index = torch_sparse.coalesce(torch.randint(n, (2, 500)), torch.ones(500), n, n)[0].to(device)
+        edge_weight = torch.ones(edge_index.size(1), device=device)
+        block_lin_idx = torch.unique(torch.cat((
+            edge_index[0, :50] * n + edge_index[1, :50],
+            torch.randint(n * n, (200,), device=device)
+        )))
+        block_edge_weight = torch.rand(block_lin_idx.size(0), device=device, requires_grad=True)
+
+        lin_idx, merged_pos, block_merged_pos = sorted_merge_positions(edge_index[0] * n + edge_index[1],
+                                                                       block_lin_idx)
+        merged_edge_weight = FuseEdges.apply(block_edge_weight, edge_weight, merged_pos, block_merged_pos,
+                                             lin_idx.size(0))
+        grad = torch.autograd.grad((merged_edge_weight ** 2).sum(), block_edge_weight)[0]
+
+        expected_edge_index, expected_edge_weight = torch_sparse.coalesce(
+            torch.cat((edge_index, torch.stack((block_lin_idx // n, block_lin_idx % n))), dim=-1),
+            torch.cat((edge_weight, block_edge_weight)),
+            m=n, n=n, op='sum'
+        )
+        expected_edge_weight = torch.where(expected_edge_weight > 1, 2 - expected_edge_weight, expected_edge_weight)
+        expected_grad = torch.autograd.grad((expected_edge_weight ** 2).sum(), block_edge_weight)[0]
+
+        assert torch.equal(lin_idx, expected_edge_index[0] * n + expected_edge_index[1])
+        assert torch.allclose(merged_edge_weight, expected_edge_weight)
+        assert torch.allclose(grad, expected_grad)
+
+
+class TestIncrementalNormalization():
+
+    def test_matches_normalize(self):
+        torch.manual_seed(42)
+        n = 100
+        edge_index = torch_sparse.coalesce(torch.randint(n, (2, 500)), torch.ones(500), n, n)[0].to(device)
+        edge_weight = torch.ones(edge_index.size(1), device=device)
+        lin_idx = edge_index[0] * n + edge_index[1]
+        block_lin_idx = torch.unique(torch.cat((lin_idx[:50], torch.randint(n * n, (200,), device=device))))
+        block_lin_idx = block_lin_idx[block_lin_idx // n != block_lin_idx % n]
+        block_edge_weight = torch.rand(block_lin_idx.size(0), device=device, requires_grad=True)
+
+        merged_lin_idx, merged_pos, block_merged_pos = sorted_merge_positions(lin_idx, block_lin_idx)
+        merged_edge_weight = FuseEdges.apply(block_edge_weight, edge_weight, merged_pos, block_merged_pos,
+                                             merged_lin_idx.size(0))
+        merged_edge_index = torch.stack((merged_lin_idx // n, merged_lin_idx % n))
+
+        for row_norm in [False, True]:
+            expected_edge_index, expected_edge_weight = GCN.normalize(merged_edge_index, n, merged_edge_weight.clone(),
+                                                                      row_norm=row_norm)
+            expected = torch.sparse.FloatTensor(expected_edge_index, expected_edge_weight, (n, n)).to_dense()
+            expected_grad = torch.autograd.grad(expected.pow(2).sum(), block_edge_weight, retain_graph=True)[0]
+
+            normalization = IncrementalNormalization(lin_idx, edge_weight, n, row_norm=row_norm)
+            result_edge_index, result_edge_weight = normalization.normalize(merged_lin_idx, merged_edge_weight,
+                                                                            merged_pos, block_merged_pos)
+            result = torch.sparse.FloatTensor(result_edge_index, result_edge_weight, (n, n)).to_dense()
+            result_grad = torch.autograd.grad(result.pow(2).sum(), block_edge_weight, retain_graph=True)[0]
+
+            assert torch.allclose(expected, result, atol=1e-6)
+            assert torch.allclose(expected_grad, result_grad, atol=1e-5)
+
+    @pytest.mark.parametrize('is_symmetric', [False, True])
+    def test_undirected_matches_normalize(self, is_symmetric):
+        torch.manual_seed(42)
+        n = 100
+        edge_index = torch_sparse.coalesce(torch.randint(n, (2, 500)), torch.ones(500), n, n)[0]
+        edge_index = torch_sparse.coalesce(torch.cat((edge_index, edge_index.flip(0)), dim=-1), None, n, n)[0]
+        edge_index = edge_index.to(device)
+        edge_weight = torch.ones(edge_index.size(1), device=device)
+        lin_idx = edge_index[0] * n + edge_index[1]
+        block_edge_index = torch.randint(n, (2, 100), device=device)
+        block_edge_index = block_edge_index[:, block_edge_index[0] < block_edge_index[1]]
+        block_lin_idx = torch.unique(block_edge_index[0] * n + block_edge_index[1])
+        block_edge_weight = torch.rand(block_lin_idx.size(0), device=device, requires_grad=True)
+        # Mirror the block
+        block_lin_idx, sort_idx = torch.sort(torch.cat((block_lin_idx, block_lin_idx % n * n + block_lin_idx // n)))
+
+        merged_lin_idx, merged_pos, block_merged_pos = sorted_merge_positions(lin_idx, block_lin_idx)
+        merged_edge_weight = FuseEdges.apply(block_edge_weight.repeat(2)[sort_idx], edge_weight, merged_pos,
+                                             block_merged_pos, merged_lin_idx.size(0))
+        merged_edge_index = torch.stack((merged_lin_idx // n, merged_lin_idx % n))
+
+        for row_norm in [False, True]:
+            expected_edge_index, expected_edge_weight = GCN.normalize(merged_edge_index, n, merged_edge_weight.clone(),
+                                                                      row_norm=row_norm)
+            expected = torch.sparse.FloatTensor(expected_edge_index, expected_edge_weight, (n, n)).to_dense()
+
+            normalization = IncrementalNormalization(lin_idx, edge_weight, n, row_norm=row_norm,
+                                                     is_symmetric=is_symmetric)
+            result_edge_index, result_edge_weight = normalization.normalize(merged_lin_idx, merged_edge_weight,
+                                                                            merged_pos, block_merged_pos)
+            result = torch.sparse.FloatTensor(result_edge_index, result_edge_weight, (n, n)).to_dense()
+            assert torch.allclose(expected, result, atol=1e-6)
+
+            # Only the entries incident to the block's endpoints are renormalized
+            node_idx = block_lin_idx.unique() // n
+            is_incident = torch.zeros(n, dtype=torch.bool, device=device)
+            is_incident[node_idx] = True
+            expected_affected_pos = is_incident[merged_edge_index[0]]
+            if not row_norm:
+                expected_affected_pos |= is_incident[merged_edge_index[1]]
+            affected_pos = normalization._get_affected_pos(merged_lin_idx, merged_edge_index, node_idx.unique())
+            assert torch.equal(affected_pos.sort().values, expected_affected_pos.nonzero().flatten())
+
+
+class TestProject():
+
+    def test_matches_bisection(self):
+        torch.manual_seed(42)
+        for n_perturbations in [1, 25, 250]:
+            for scale in [0.1, 1, 3]:
+                values = 0.3 + scale * torch.randn(1_000, device=device)
+
+                projected = Attack.project(n_perturbations, values)
+
+                miu = Attack.bisection(values, (values - 1).min(), values.max(), n_perturbations)
+                expected = torch.clamp(values - miu, 0, 1)
+                assert torch.allclose(projected, expected, atol=1e-4)
+                assert torch.isclose(projected.sum(), torch.tensor(float(n_perturbations), device=device), atol=1e-2)
+
+    def test_within_budget(self):
+        values = torch.tensor([-0.5, 0.2, 0.5, 1.5], device=device)
+
+        projected = Attack.project(5, values, eps=1e-7)
+
+        assert torch.allclose(projected, torch.clamp(values, 1e-7, 1 - 1e-7))
+
+
+class TestBatchedFinalSampling():
+
+    def test_matches_sequential(self):
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, **create_random_graph())
+        attack.sample_random_block(10)
+        sampled_edges = torch.bernoulli(torch.full((4, attack.current_search_space.size(0)), 0.01, device=device))
+
+        accuracy = attack._get_batched_accuracy(sampled_edges)
+
+        for i in range(sampled_edges.size(0)):
+            attack.perturbed_edge_weight = sampled_edges[i]
+            logits = attack._get_modified_logits()
+            expected_accuracy = (logits.argmax(-1) == attack.labels).float().mean()
+            assert torch.isclose(accuracy[i], expected_accuracy)
+
+    def test_samples_per_pass(self):
+        adj = torch_sparse.SparseTensor.from_edge_index(torch.tensor([[0, 1], [1, 0]]), torch.ones(2), (10, 10))
+        model = GCN(n_features=4, n_classes=2)
+        attack = PRBCD(adj=adj, attr=torch.rand(10, 4), labels=torch.zeros(10), idx_attack=np.arange(10),
+                       model=model, device=device, data_device=device, make_undirected=True, binary_attr=False,
+                       block_size=20, max_final_samples=20)
+        assert attack._get_final_samples_per_pass() == 1
+
+        # Features, edges as well as the activations of the hidden layer (64) and output (2)
+        bytes_per_sample = 4 * 10 * (4 + 64 + 2) + 20 * (2 + 2 * 20)
+        attack.final_samples_memory_budget = 3 * bytes_per_sample
+        assert attack._get_final_samples_per_pass() == 3
+        attack.final_samples_memory_budget = 100 * bytes_per_sample
+        assert attack._get_final_samples_per_pass() == 20
+
+        # The SVD of the block-diagonal copies is not the SVD of the individual copies
+        attack.attacked_model.svd_params = dict(rank=2)
+        assert attack._get_final_samples_per_pass() == 1
+
+
+class TestCheckpoint():
+
+    def _create_attack(self, attack: str = 'PRBCD', **kwargs):
+        attack_class = GreedyRBCD if attack == 'GreedyRBCD' else PRBCD
+        return attack_class(device=device, data_device=device, block_size=1_000, **create_random_graph(), **kwargs)
+
+    def _assert_resume_matches(self, attack: str, **kwargs):
+        n_perturbations = 10
+        attack_uninterrupted = self._create_attack(attack, **kwargs)
+        torch.manual_seed(0)
+        checkpoints = []
+        attack_uninterrupted.attack(n_perturbations, checkpoint_step=3, save_checkpoint=checkpoints.append)
+        assert len(checkpoints) > 0
+
+        attack_resumed = self._create_attack(attack, **kwargs)
+        torch.manual_seed(1)
+        attack_resumed.attack(n_perturbations, checkpoint=checkpoints[0])
+
+        adj_uninterrupted = attack_uninterrupted.adj_adversary.to_dense()
+        adj_resumed = attack_resumed.adj_adversary.to_dense()
+        assert torch.equal(adj_uninterrupted, adj_resumed)
+
+    def test_resume_prbcd(self):
+        self._assert_resume_matches('PRBCD', epochs=10, fine_tune_epochs=4, display_step=100)
+
+    def test_resume_greedy_rbcd(self):
+        self._assert_resume_matches('GreedyRBCD', epochs=5)
+
+
+def _run_distributed_prbcd(rank: int, world_size: int, tmp_dir: str):
+    dist.init_process_group('gloo', init_method=f'file://{os.path.join(tmp_dir, "init")}', rank=rank,
+                            world_size=world_size)
+    attack = DistributedPRBCD(device='cpu', data_device='cpu', block_size=1_000, epochs=6, fine_tune_epochs=2,
+                              max_oom_backoffs=2, **create_random_graph())
+    # A rank must not back off on its own (the collectives of the other ranks would remain unmatched)
+    assert attack.max_oom_backoffs == 0
+    torch.manual_seed(rank)
+    attack.sample_random_block(10)
+    torch.manual_seed(0)
+    attack.perturbed_edge_weight.data.uniform_(0, 0.1)
+    gradient = attack._get_loss_and_gradient()[1]
+    torch.save(dict(search_space=attack.current_search_space, edge_weight=attack.perturbed_edge_weight.detach(),
+                    gradient=gradient), os.path.join(tmp_dir, f'gradient_{rank}.pt'))
+
+    attack.attack(10)
+    torch.save(attack.adj_adversary.to_dense(), os.path.join(tmp_dir, f'adj_{rank}.pt'))
+    dist.destroy_process_group()
+
+
+class TestDistributedPRBCD():
+
+    def test_matches_prbcd_gradient(self):
+        world_size = 2
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mp.spawn(_run_distributed_prbcd, args=(world_size, tmp_dir), nprocs=world_size)
+            results = [torch.load(os.path.join(tmp_dir, f'gradient_{rank}.pt')) for rank in range(world_size)]
+            adjs = [torch.load(os.path.join(tmp_dir, f'adj_{rank}.pt')) for rank in range(world_size)]
+
+        attack = PRBCD(device='cpu', data_device='cpu', block_size=1_000, **create_random_graph())
+        attack.current_search_space = results[0]['search_space']
+        attack.modified_edge_index = PRBCD.linear_to_triu_idx(attack.n, attack.current_search_space)
+        attack.perturbed_edge_weight = results[0]['edge_weight'].clone().requires_grad_()
+        expected_gradient = attack._get_loss_and_gradient()[1]
+
+        for rank in range(world_size):
+            assert torch.equal(results[rank]['search_space'], results[0]['search_space'])
+            assert torch.allclose(results[rank]['gradient'], expected_gradient, atol=1e-6)
+            assert torch.equal(adjs[rank], adjs[0])
+
+    def test_receptive_field_matches_full_graph(self):
+        n, d = 500, 16
+        torch.manual_seed(0)
+        edge_index = torch.randint(n, (2, 300))
+        edge_index = torch.cat((edge_index, edge_index.flip(0)), dim=-1)
+        edge_weight = torch.rand(edge_index.size(1))
+        attr = torch.rand(n, d)
+        model = GCN(n_features=d, n_classes=3, n_filters=8).eval()
+        node_idx = torch.arange(5)
+
+        subset, subgraph_edge_index, local_idx, edge_mask = DistributedPRBCD.receptive_field(
+            node_idx, model.receptive_field_hops(), edge_index, n)
+        assert subset.size(0) < n
+
+        logits = model(attr[subset], (subgraph_edge_index, edge_weight[edge_mask]))[local_idx]
+        expected_logits = model(attr, (edge_index, edge_weight))[node_idx]
+        assert torch.allclose(logits, expected_logits, atol=1e-6)
+
+
+class TestOutOfMemoryBackoff():
+
+    def _create_attack(self, **kwargs):
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, epochs=4, fine_tune_epochs=1,
+                       **create_random_graph(), **kwargs)
+        get_loss_and_gradient = attack._get_loss_and_gradient
+
+        def get_loss_and_gradient_with_oom():
+            # Simulate that only blocks of at most 500 elements fit into memory
+            if attack.current_search_space.size(0) > 500:
+                raise RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')
+            return get_loss_and_gradient()
+        attack._get_loss_and_gradient = get_loss_and_gradient_with_oom
+        return attack
+
+    def test_block_is_halved(self):
+        attack = self._create_attack(max_oom_backoffs=2)
+        attack.attack(10)
+
+        assert attack.adjusted_params == dict(block_size=500, n_oom_backoffs=1)
+        assert attack.current_search_space.size(0) <= 500
+        assert attack.lr_factor == 100 * math.log2(attack.n_possible_edges / 500)
+
+    def test_checkpoint_keeps_adjusted_params(self):
+        attack_uninterrupted = self._create_attack(max_oom_backoffs=2)
+        checkpoints = []
+        torch.manual_seed(0)
+        attack_uninterrupted.attack(10, checkpoint_step=2, save_checkpoint=checkpoints.append)
+        assert checkpoints[0]['block_size'] == 500
+        assert checkpoints[0]['adjusted_params'] == dict(block_size=500, n_oom_backoffs=1)
+
+        # Would run out of memory without restoring the halved block size
+        attack_resumed = self._create_attack()
+        torch.manual_seed(1)
+        attack_resumed.attack(10, checkpoint=checkpoints[0])
+
+        assert attack_resumed.block_size == 500
+        assert attack_resumed.lr_factor == attack_uninterrupted.lr_factor
+        assert attack_resumed.adjusted_params == attack_uninterrupted.adjusted_params
+        assert torch.equal(attack_uninterrupted.adj_adversary.to_dense(), attack_resumed.adj_adversary.to_dense())
+
+    def test_without_backoff(self):
+        attack = self._create_attack()
+        with pytest.raises(RuntimeError, match='out of memory'):
+            attack.attack(10)
+
+    def test_other_errors_are_raised(self):
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, max_oom_backoffs=2, **create_random_graph())
+
+        def fail():
+            raise RuntimeError('Something else')
+        with pytest.raises(RuntimeError, match='Something else'):
+            attack._with_oom_backoff(fail, 10)
+        assert attack.adjusted_params == {}
+
+    def test_pprgo_forward_batch_size_is_halved(self):
+        graph = create_random_graph()
+        adj = graph['adj'].to_scipy(layout='csr')
+        torch.manual_seed(0)
+        model = PPRGoWrapper(n_features=graph['attr'].size(1), n_classes=2, n_filters=8, forward_batch_size=64,
+                             max_oom_backoffs=2).eval()
+        expected_logits = model(graph['attr'], adj)
+
+        model_forward = model.model_forward
+
+        def model_forward_with_oom(attr, ppr_matrix):
+            # Simulate that only batches of at most 20 nodes fit into memory
+            if ppr_matrix.size(0) > 20:
+                raise RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')
+            return model_forward(attr, ppr_matrix)
+        model.model_forward = model_forward_with_oom
+
+        with torch.no_grad():
+            logits = model(graph['attr'], adj)
+        assert torch.allclose(logits, expected_logits, atol=1e-6)
+        assert model.adjusted_params == dict(forward_batch_size=16, n_oom_backoffs=2)
+
+
+class TestBlockRestrictedGradient():
+
+    def test_only_restricted_for_small_blocks(self):
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, with_block_restricted_gradient=True,
+                       **create_random_graph())
+        attack.sample_random_block(10)
+        # The block covers (almost) all nodes
+        assert attack._get_gradient_node_idx() is None
+
+        attack.modified_edge_index = attack.modified_edge_index[:, :5]
+        node_idx = attack._get_gradient_node_idx()
+        assert torch.equal(node_idx, attack.modified_edge_index.flatten().unique())
+
+
+class TestSampleRandomBlock():
+
+    def _create_attack(self, make_undirected: bool, block_size: int = 1_000):
+        kwargs = create_random_graph()
+        kwargs['make_undirected'] = make_undirected
+        return PRBCD(device=device, data_device=device, block_size=block_size, **kwargs)
+
+    @pytest.mark.parametrize('make_undirected', [True, False])
+    def test_block_is_filled(self, make_undirected):
+        attack = self._create_attack(make_undirected)
+        attack.sample_random_block(10)
+
+        search_space = attack.current_search_space
+        assert search_space.size(0) == attack.block_size
+        assert torch.equal(search_space, torch.unique(search_space, sorted=True))
+        assert attack.perturbed_edge_weight.size(0) == attack.block_size
+        if not make_undirected:
+            assert torch.all(attack.modified_edge_index[0] != attack.modified_edge_index[1])
+
+        attack.perturbed_edge_weight = torch.rand_like(attack.perturbed_edge_weight)
+        edge_weight = dict(zip(search_space.tolist(), attack.perturbed_edge_weight.tolist()))
+        attack.resample_random_block(10)
+
+        search_space = attack.current_search_space
+        assert search_space.size(0) == attack.block_size
+        assert torch.equal(search_space, torch.unique(search_space, sorted=True))
+        # The half with the largest weights is kept
+        is_kept = attack.perturbed_edge_weight > attack.eps
+        assert is_kept.sum() == attack.block_size // 2
+        for lin_idx, weight in zip(search_space[is_kept].tolist(), attack.perturbed_edge_weight[is_kept].tolist()):
+            assert edge_weight[lin_idx] == weight
+        assert torch.equal(attack.modified_edge_index, attack._lin_idx_to_edge_index(search_space))
+
+    @pytest.mark.parametrize('make_undirected', [True, False])
+    def test_block_is_filled_after_max_sampling_rounds(self, make_undirected, caplog):
+        attack = self._create_attack(make_undirected)
+        attack.sample_random_block(10)
+        search_space = attack.current_search_space[:500]
+
+        # Simulates that the rejection sampling does not fill the block
+        attack.MAX_SAMPLING_ROUNDS = 0
+        with caplog.at_level(logging.WARNING):
+            new_search_space = attack._sample_new_edges(search_space, 500)
+        assert 'bitmap' in caplog.text
+
+        assert new_search_space.size(0) == 500
+        assert torch.equal(new_search_space, torch.unique(new_search_space, sorted=True))
+        assert not isin_sorted(new_search_space, search_space).any()
+        if not make_undirected:
+            assert torch.all(new_search_space // attack.n != new_search_space % attack.n)
+
+    def test_block_larger_than_possible_edges(self):
+        attack = self._create_attack(True, block_size=10_000)
+        attack.sample_random_block(10)
+        assert attack.current_search_space.size(0) == attack.n_possible_edges
+
+
+class TestOutOfCorePRBCD():
+
+    def test_matches_in_memory(self, tmp_path):
+        kwargs = create_random_graph()
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, **kwargs)
+        kwargs['adj'] = MemmapCSR.save(kwargs['adj'], str(tmp_path))
+        attack_out_of_core = PRBCD(device=device, data_device=device, block_size=1_000, **kwargs)
+
+        torch.manual_seed(0)
+        attack.sample_random_block(10)
+        attack_out_of_core.current_search_space = attack.current_search_space
+        attack_out_of_core.modified_edge_index = attack.modified_edge_index
+        attack.perturbed_edge_weight = torch.rand_like(attack.perturbed_edge_weight).requires_grad_()
+        attack_out_of_core.perturbed_edge_weight = attack.perturbed_edge_weight.detach().clone().requires_grad_()
+
+        loss, gradient = attack._get_loss_and_gradient()
+        loss_out_of_core, gradient_out_of_core = attack_out_of_core._get_loss_and_gradient()
+        assert torch.allclose(loss, loss_out_of_core, atol=1e-6)
+        assert torch.allclose(gradient, gradient_out_of_core, atol=1e-6)
+
+    def test_attack(self, tmp_path):
+        n_perturbations = 10
+        kwargs = create_random_graph()
+        kwargs['adj'] = MemmapCSR.save(kwargs['adj'], str(tmp_path))
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, epochs=6, fine_tune_epochs=2,
+                       display_step=100, **kwargs)
+        attack.attack(n_perturbations)
+
+        adj_adversary = attack.adj_adversary
+        assert isinstance(adj_adversary, MemmapCSR)
+        assert 0 < adj_adversary.perturbed_edge_index.size(1) <= 2 * n_perturbations
+        # Edges are either inserted or removed
+        assert torch.all(adj_adversary.perturbed_edge_weight.abs() == 1)
+        assert torch.all(adj_adversary.lookup(adj_adversary.perturbed_edge_index)
+                         == (adj_adversary.perturbed_edge_weight < 0).float())
+
+
+class TestCompactIndices():
+
+    @pytest.mark.parametrize('attack', ['PRBCD', 'GreedyRBCD'])
+    def test_matches_int64(self, attack):
+        n_perturbations = 10
+        attack_class = GreedyRBCD if attack == 'GreedyRBCD' else PRBCD
+        adj_adversary = []
+        for compact_indices in [False, True]:
+            kwargs = create_random_graph()
+            current_attack = attack_class(device=device, data_device=device, block_size=1_000, epochs=6,
+                                          compact_indices=compact_indices, **kwargs)
+            if compact_indices:
+                assert current_attack.edge_index.dtype == torch.int32
+            torch.manual_seed(0)
+            current_attack.attack(n_perturbations)
+            if compact_indices:
+                assert current_attack.modified_edge_index.dtype == torch.int32
+            adj_adversary.append(current_attack.adj_adversary.to_dense())
+        assert torch.equal(*adj_adversary)
+
+    def test_block_is_cast_once_per_block(self):
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, compact_indices=True,
+                       **create_random_graph())
+        attack.sample_random_block(10)
+        block_lin_idx = attack._get_block_indices()[0]
+        assert block_lin_idx.dtype == torch.int32
+        assert attack._get_block_indices()[0] is block_lin_idx
+
+        attack.resample_random_block(10)
+        assert attack._get_block_indices()[0] is not block_lin_idx
+
+    def test_cached_indices_are_halved(self):
+        cached_bytes, fused_edges = [], []
+        for compact_indices in [False, True]:
+            attack = PRBCD(device=device, data_device=device, block_size=1_000, compact_indices=compact_indices,
+                           **create_random_graph())
+            torch.manual_seed(0)
+            attack.sample_random_block(10)
+            fused_edges.append(attack._get_fused_edges())
+
+            cached_idx = [attack.edge_index, attack.modified_edge_index, attack._sorted_clean_edges[2],
+                          *attack._block_indices[1:]]
+            cached_bytes.append(sum(idx.numel() * idx.element_size() for idx in cached_idx if idx is not None))
+
+        assert 2 * cached_bytes[1] == cached_bytes[0]
+        assert fused_edges[1][0].dtype == torch.int64
+        assert torch.equal(fused_edges[0][0], fused_edges[1][0])
+        assert torch.equal(fused_edges[0][1], fused_edges[1][1])
+
+
+class TestUndirectedAdjacencyPRBCD():
+
+    def test_matches_symmetric(self):
+        kwargs = create_random_graph()
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, **kwargs)
+        attack_triu = PRBCD(device=device, data_device=device, block_size=1_000, with_undirected_adjacency=True,
+                            **kwargs)
+        assert attack_triu.edge_index.size(1) < attack.edge_index.size(1)
+
+        torch.manual_seed(0)
+        attack.sample_random_block(10)
+        attack_triu.current_search_space = attack.current_search_space
+        attack_triu.modified_edge_index = attack.modified_edge_index
+        attack.perturbed_edge_weight = torch.rand_like(attack.perturbed_edge_weight).requires_grad_()
+        attack_triu.perturbed_edge_weight = attack.perturbed_edge_weight.detach().clone().requires_grad_()
+
+        loss, gradient = attack._get_loss_and_gradient()
+        loss_triu, gradient_triu = attack_triu._get_loss_and_gradient()
+        assert torch.allclose(loss, loss_triu, atol=1e-6)
+        assert torch.allclose(gradient, gradient_triu, atol=1e-6)
+
+        edge_index, edge_weight = attack.get_modified_adj()
+        edge_index_triu, edge_weight_triu = attack_triu.get_modified_adj()
+        assert torch.equal(torch.sparse_coo_tensor(edge_index, edge_weight).to_dense(),
+                           torch.sparse_coo_tensor(edge_index_triu, edge_weight_triu).to_dense())
+
+    @pytest.mark.parametrize('attack', ['PRBCD', 'GreedyRBCD'])
+    def test_attack(self, attack):
+        n_perturbations = 10
+        attack_class = GreedyRBCD if attack == 'GreedyRBCD' else PRBCD
+        adj_adversary = []
+        for with_undirected_adjacency in [False, True]:
+            kwargs = create_random_graph()
+            current_attack = attack_class(device=device, data_device=device, block_size=1_000, epochs=6,
+                                          with_undirected_adjacency=with_undirected_adjacency, **kwargs)
+            torch.manual_seed(0)
+            current_attack.attack(n_perturbations)
+            adj_adversary.append(current_attack.adj_adversary.to_dense().cpu())
+        assert torch.equal(*adj_adversary)
+        assert torch.equal(adj_adversary[1], adj_adversary[1].T)
+        assert 0 < (adj_adversary[1] != kwargs['adj'].to_dense()).sum() <= 2 * n_perturbations
+
+
+class TestIncrementalMonitoring():
+
+    def test_matches_full_aggregation(self, monkeypatch):
+        statistics, adj_adversary = [], []
+        for with_incremental_monitoring in [False, True]:
+            kwargs = create_random_graph()
+            torch.manual_seed(0)
+            kwargs['model'] = RGNN(mean='soft_median', n_features=16, n_classes=3, n_filters=8)
+            attack = PRBCD(device=device, data_device=device, block_size=1_000, epochs=6, fine_tune_epochs=2,
+                           with_incremental_monitoring=with_incremental_monitoring, **kwargs)
+            if with_incremental_monitoring:
+                # The changed rows are obtained from the block's endpoints
+                monkeypatch.setattr('rgnn_at_scale.models.rgnn.changed_rows', None)
+            torch.manual_seed(0)
+            attack.attack(10)
+            statistics.append(attack.attack_statistics)
+            adj_adversary.append(attack.adj_adversary.to_dense())
+
+        assert np.allclose(statistics[0]['accuracy'], statistics[1]['accuracy'])
+        assert torch.equal(*adj_adversary)
+
+    def test_top_k_cache_is_kept(self, monkeypatch):
+        cached_sizes = []
+        get = TopKNeighborhoodCache.get
+
+        def _get(cache, A, k):
+            cached_sizes.append(tuple(A.sizes()))
+            return get(cache, A, k)
+
+        monkeypatch.setattr(TopKNeighborhoodCache, 'get', _get)
+
+        kwargs = create_random_graph()
+        n = kwargs['adj'].size(0)
+        # The sparse top k neighborhood is also used on the CPU for small graphs
+        model = RGNN(mean='soft_k_medoid', mean_kwargs=dict(k=8, temperature=1.0, threshold_for_dense_if_cpu=0),
+                     do_cache_top_k=True, n_features=16, n_classes=3, n_filters=8).to(device).eval()
+        edge_index = torch.stack(kwargs['adj'].coo()[:2]).to(device)
+        perturbed_edge_index = torch.cat((edge_index, torch.tensor([[3, 42], [42, 3]], device=device)), dim=-1)
+        attr = kwargs['attr'].to(device)
+
+        with torch.no_grad():
+            expected = model(attr, (perturbed_edge_index, torch.ones(perturbed_edge_index.size(1), device=device)))
+            model.activate_incremental_aggregation()
+            model.set_changed_nodes(torch.zeros(0, dtype=torch.long, device=device), True)
+            model(attr, (edge_index, torch.ones(edge_index.size(1), device=device)))
+            model.set_changed_nodes(torch.tensor([3, 42], device=device), True)
+            logits = model(attr, (perturbed_edge_index, torch.ones(perturbed_edge_index.size(1), device=device)))
+
+        assert torch.allclose(logits, expected, atol=1e-5)
+        # The changed rows are aggregated without the cache of the full adjacency matrix
+        assert set(cached_sizes) == {(n, n)}
+
+
+def _record_loaded_epochs(attack: PRBCD):
+    loaded_epochs = []
+    load_best_state = attack._load_best_state
+
+    def _load_best_state():
+        loaded_epochs.append(int(attack._best_state['epoch']))
+        return load_best_state()
+
+    attack._load_best_state = _load_best_state
+    return loaded_epochs
+
+
+class TestEvaluationCadence():
+
+    def _attack(self, **kwargs):
+        attack = PRBCD(device=device, data_device=device, block_size=1_000, epochs=10, fine_tune_epochs=4,
+                       display_step=100, **create_random_graph(), **kwargs)
+        loaded_epochs = _record_loaded_epochs(attack)
+        torch.manual_seed(0)
+        attack.attack(10)
+        return attack.attack_statistics, loaded_epochs
+
+    def test_every_epoch(self):
+        statistics, loaded_epochs = self._attack(eval_step=1)
+
+        assert statistics['epoch'] == list(range(-1, 10))
+        assert not np.isnan(np.array([statistics[name] for name in PRBCD.STATISTICS])).any()
+        # The first minimal accuracy before the resampling ends and then over all epochs
+        accuracy = np.array(statistics['accuracy'][1:])
+        assert loaded_epochs == [int(np.argmin(accuracy[:6])), int(np.argmin(accuracy))]
+
+    def test_every_other_epoch(self):
+        statistics, loaded_epochs = self._attack(eval_step=2, eval_from_epoch=1)
+
+        # The last epoch is always evaluated
+        evaluated_epochs = [1, 3, 5, 7, 9]
+        assert statistics['epoch'] == [-1] + evaluated_epochs
+        assert not np.isnan(np.array([statistics[name] for name in PRBCD.STATISTICS])).any()
+        accuracy = np.array(statistics['accuracy'][1:])
+        assert loaded_epochs == [evaluated_epochs[int(np.argmin(accuracy[:3]))],
+                                 evaluated_epochs[int(np.argmin(accuracy))]]
+
+    def test_no_evaluation_before_resampling_ends(self):
+        statistics, loaded_epochs = self._attack(eval_from_epoch=8)
+
+        assert statistics['epoch'] == [-1, 8, 9]
+        assert not np.isnan(np.array([statistics[name] for name in PRBCD.STATISTICS])).any()
+        # Nothing to load after the resampling
+        accuracy = np.array(statistics['accuracy'][1:])
+        assert loaded_epochs == [-1, [8, 9][int(np.argmin(accuracy))]]
+
+
+class TestLocalPRBCD():
+
+    def test_only_evaluated_statistics_are_logged(self, caplog):
+        attack = LocalPRBCD(device=device, data_device=device, block_size=50, epochs=4, fine_tune_epochs=1,
+                            display_step=1, eval_step=2, **create_random_graph())
+        with caplog.at_level(logging.INFO):
+            attack.attack(2, node_idx=0)
+
+        epoch_messages = [record.getMessage().strip() for record in caplog.records
+                          if record.getMessage().strip().startswith('Epoch:')]
+        assert len(epoch_messages) == 4
+        # Epoch 1 is not evaluated and epoch 3 is the last one
+        assert ['Statstics' in message for message in epoch_messages] == [True, False, True, True]
+
+        statistics = attack.attack_statistics
+        assert statistics['epoch'] == [0, 2, 3]
+        assert all(len(statistics[name]) == 3 for name in LocalPRBCD.STATISTICS)
+        assert not np.isnan(np.array([statistics[name] for name in LocalPRBCD.STATISTICS])).any()
+
+
+class TestSymmetricRowUpdate():
+
+    def test_local_prbcd_matches_to_symmetric(self):
+        n, node_idx = 100, 3
+        adj = create_random_graph(n)['adj']
+        torch.manual_seed(0)
+        search_space = torch.cat((torch.tensor([node_idx]), torch.randperm(n)[:20])).unique()
+        modified = torch_sparse.SparseTensor(row=torch.zeros_like(search_space), col=search_space,
+                                             value=torch.rand(search_space.size(0)), sparse_sizes=(1, n))
+
+        adj_updated = LocalPRBCD.mod_row(modified.clone(), adj, node_idx, make_undirected=True)
+
+        expected = LocalPRBCD.mod_row(modified.clone(), adj, node_idx, make_undirected=False)
+        row, col, value = expected.coo()
+        expected_edge_index, expected_edge_weight = to_symmetric(torch.stack((row, col)), value, n, op='max')
+        expected = torch_sparse.SparseTensor.from_edge_index(expected_edge_index, expected_edge_weight, (n, n))
+        assert torch.equal(adj_updated.to_dense(), expected.to_dense())
+
+    def test_dice_is_symmetric(self):
+        n_perturbations = 10
+        kwargs = create_random_graph()
+        attack = DICE(device=device, data_device=device, **kwargs)
+        attack.attack(n_perturbations)
+
+        adj = kwargs['adj'].to_dense()
+        adj_adversary = attack.adj_adversary.to_dense().cpu()
+        assert torch.equal(adj_adversary, adj_adversary.T)
+        # DICE only considers the edges above the diagonal (i.e. drops self-loops)
+        assert (adj_adversary != adj).triu(1).sum() == n_perturbations
@@ -4,7 +4,14 @@ import pandas as pd
 from rgnn_at_scale.helper.local import setup_logging, build_configs_and_run
 from itertools import groupby
 from shutil import rmtree
+import tempfile
 import torch
+
+from experiments.common import run_global_attack
+from rgnn_at_scale.attacks.fgsm import FGSM
+from rgnn_at_scale.helper.io import Storage
+from rgnn_at_scale.models.gcn import DenseGCN
+from random_graphs import create_random_adj
 # clean cache
 
 if os.path.isdir('cache_test'):
@@ -307,3 +314,20 @@ class TestExperimentTrain():
 #     #testsuit.test_cora_attack_direct_prbcd()
 #     #testsuit.test_cora_attack_transfer_prbcd()
 #     testsuit.test_cora_attack_direct_localprbcd()
+
+
+class TestRunGlobalAttack():
+
+    def test_checkpoints_are_ignored_if_not_supported(self):
+        n, d = 20, 8
+        adj = create_random_adj(n, 40)
+        adversary = FGSM(adj=adj, attr=torch.rand(n, d), labels=torch.randint(2, (n,)), idx_attack=np.arange(n),
+                         model=DenseGCN(n_features=d, n_classes=2, n_filters=8), device='cpu', data_device='cpu',
+                         make_undirected=True, binary_attr=False)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            storage = Storage(tmp_dir)
+            # `FGSM._attack` does not accept the checkpoint arguments
+            run_global_attack(0.1, adj.nnz() // 2, storage, 'pert_adj', 'pert_attr', {}, adversary, 'label',
+                              checkpoint_step=1, resume=True)
+            assert storage.load_artifact('pert_adj', {'epsilon': 0.1}) is not None
@@ -120,3 +120,33 @@ class TestStorage():
 
         for params, artifact in zip(params_list, artifact_list):
             storage.load_artifact(table, params) == artifact
+
+    def test_overwrite_and_remove_artifact(self):
+        table = 'test'
+        params = {'a': 1}
+        storage = Storage(os.path.join(cache_base, self.test_overwrite_and_remove_artifact.__name__))
+
+        path = storage.save_artifact(table, params, {'b': 1})
+        assert storage.save_artifact(table, params, {'b': 2}) == path
+        assert storage.load_artifact(table, params) == {'b': 2}
+        assert not os.path.exists(f'{path}.tmp')
+
+        assert storage.remove_artifact(table, params)
+        assert storage.load_artifact(table, params) is None
+        assert not os.path.exists(path)
+        assert not storage.remove_artifact(table, params)
+
+    def test_failed_save_keeps_previous_artifact(self):
+        table = 'test'
+        params = {'a': 1}
+        storage = Storage(os.path.join(cache_base, self.test_failed_save_keeps_previous_artifact.__name__))
+
+        # Lambdas cannot be pickled
+        with pytest.raises(Exception):
+            storage.save_artifact(table, params, {'b': lambda: None})
+        assert storage.load_artifact(table, params) is None
+
+        storage.save_artifact(table, params, {'b': 1})
+        with pytest.raises(Exception):
+            storage.save_artifact(table, params, {'b': lambda: None})
+        assert storage.load_artifact(table, params) == {'b': 1}
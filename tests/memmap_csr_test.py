@@ -0,0 +1,99 @@
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pytest
+import torch
+
+from rgnn_at_scale.data import _save_node_data, prep_graph
+from rgnn_at_scale.helper.memmap_csr import MemmapCSR
+from rgnn_at_scale.models.gcn import GCN
+from random_graphs import create_random_adj
+
+device = 0 if torch.cuda.is_available() else 'cpu'
+
+
+class TestMemmapCSR():
+
+    def test_save_and_lookup(self):
+        adj = create_random_adj()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            adj_memmap = MemmapCSR.save(adj, tmp_dir)
+            assert MemmapCSR.exists(tmp_dir)
+            assert adj_memmap.nnz() == adj.nnz()
+            assert adj_memmap.rowptr.dtype == np.int32 and adj_memmap.col.dtype == np.int32
+            assert torch.equal(adj_memmap.to_sparse_tensor().to_dense(), adj.to_dense())
+
+            rows = torch.randint(adj.size(0), (2, 200))
+            assert torch.equal(adj_memmap.lookup(rows), adj.to_dense()[rows[0], rows[1]])
+
+            row_sum, col_sum, has_self_loop = adj_memmap.clean_degree(n_chunks=3)
+            assert torch.allclose(row_sum, adj.sum(1))
+            assert torch.allclose(col_sum, adj.sum(0))
+            assert torch.equal(has_self_loop, adj.get_diag() > 0)
+
+    def test_without_compact_indices(self):
+        adj = create_random_adj()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            adj_memmap = MemmapCSR.save(adj, tmp_dir, compact_indices=False)
+            assert adj_memmap.rowptr.dtype == np.int64 and adj_memmap.col.dtype == np.int64
+            assert torch.equal(adj_memmap.to_sparse_tensor().to_dense(), adj.to_dense())
+
+    def test_prep_graph_does_not_load_the_edges(self):
+        adj = create_random_adj()
+        n, d = adj.size(0), 8
+        attr, labels = np.random.rand(n, d).astype(np.float32), np.random.randint(3, size=n)
+        split = dict(train=np.arange(10), valid=np.arange(10, 20), test=np.arange(20, n))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            memmap_path = os.path.join(tmp_dir, 'ogbn-arxiv_undirected')
+            MemmapCSR.save(adj, memmap_path)
+            _save_node_data(memmap_path, attr, labels, split)
+
+            # The (non-existent) dataset root is never accessed
+            attr_loaded, adj_loaded, labels_loaded, split_loaded = prep_graph(
+                'ogbn-arxiv', device='cpu', dataset_root=os.path.join(tmp_dir, 'missing'),
+                return_original_split=True, memmap_dir=tmp_dir)
+            assert not os.path.exists(os.path.join(tmp_dir, 'missing'))
+            assert isinstance(adj_loaded, MemmapCSR) and adj_loaded.nnz() == adj.nnz()
+        assert np.array_equal(attr_loaded.numpy(), attr)
+        assert np.array_equal(labels_loaded.numpy(), labels)
+        assert all(np.array_equal(split_loaded[key], split[key]) for key in split)
+
+    def test_pickle_keeps_only_the_path(self):
+        adj = create_random_adj()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            adj_memmap = MemmapCSR.save(adj, tmp_dir).perturb(torch.tensor([[0], [1]]), torch.tensor([1.]))
+            serialized = pickle.dumps(adj_memmap)
+            assert len(serialized) < 2_000
+
+            adj_loaded = pickle.loads(serialized)
+            assert torch.equal(adj_loaded.to_sparse_tensor().to_dense(), adj_memmap.to_sparse_tensor().to_dense())
+
+    @pytest.mark.parametrize('row_norm', [False, True])
+    def test_gcn_matches_in_memory(self, row_norm):
+        adj = create_random_adj()
+        n, d = adj.size(0), 16
+        attr = torch.rand(n, d)
+        model = GCN(n_features=d, n_classes=3, n_filters=8, row_norm=row_norm, n_chunks=3).to(device).eval()
+
+        row, col, _ = adj.coo()
+        perturbed_edge_index = torch.cat((torch.tensor([[0, 1, 2], [5, 6, 7]]), torch.stack((row[:2], col[:2]))), -1)
+        perturbed_edge_weight = torch.tensor([.3, .5, .7, -.4, -.2], requires_grad=True)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            adj_memmap = MemmapCSR.save(adj, tmp_dir)
+            assert torch.allclose(model(attr, adj_memmap), model(attr, adj), atol=1e-6)
+
+            logits = model(attr, adj_memmap.perturb(perturbed_edge_index, perturbed_edge_weight))
+            grad = torch.autograd.grad(logits.sum(), perturbed_edge_weight)[0]
+
+        expected_edge_weight = perturbed_edge_weight.detach().clone().requires_grad_()
+        adj_dense = adj.to_dense().index_put((perturbed_edge_index[0], perturbed_edge_index[1]),
+                                             expected_edge_weight, accumulate=True)
+        edge_index = adj_dense.nonzero().T
+        expected_logits = model(attr, (edge_index, adj_dense[edge_index[0], edge_index[1]]))
+        expected_grad = torch.autograd.grad(expected_logits.sum(), expected_edge_weight)[0]
+
+        assert torch.allclose(logits, expected_logits, atol=1e-6)
+        assert torch.allclose(grad, expected_grad, atol=1e-6)
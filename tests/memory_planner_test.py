@@ -0,0 +1,79 @@
+import time
+
+import pytest
+import torch
+
+from rgnn_at_scale.helper.memory_planner import MemoryPlanner, measure_peak_memory
+from rgnn_at_scale.models import GCN
+
+GB = 1024 ** 3
+
+
+class TestMemoryPlanner():
+
+    def test_plan_fits_budget(self):
+        planner = MemoryPlanner(32 * GB, n=2_000_000, n_edges=100_000_000, n_features=128, n_classes=40,
+                                n_filters=[256])
+        plan = planner.plan()
+
+        assert planner.estimate_memory(plan['block_size']) <= planner.safety_factor * planner.memory_budget
+        assert planner.estimate_memory(plan['block_size'] + 1_000) > planner.safety_factor * planner.memory_budget
+        assert plan['n_chunks'] == 1
+        assert 'forward_batch_size' not in plan
+
+    def test_plan_is_capped(self):
+        planner = MemoryPlanner(8 * GB, n=1_000, n_edges=10_000, n_features=16, n_classes=4, is_cuda=False)
+        plan = planner.plan(max_block_size=50_000)
+
+        assert plan['block_size'] == 50_000
+        assert not plan['do_synchronize']
+
+    def test_robust_aggregation_is_chunked(self):
+        kwargs = dict(n=2_000_000, n_edges=100_000_000, n_features=128, n_classes=40, n_filters=[256])
+        plan = MemoryPlanner(32 * GB, model_type='GCN', **kwargs).plan()
+        plan_robust = MemoryPlanner(32 * GB, model_type='RGNN', **kwargs).plan()
+
+        assert plan_robust['n_chunks'] > 1
+        assert plan_robust['block_size'] <= plan['block_size']
+
+    def test_pprgo_batch_size(self):
+        planner = MemoryPlanner(2 * GB, n=2_000_000, n_edges=10_000_000, n_features=128, n_classes=40,
+                                n_filters=[512, 512], model_type='PPRGo')
+        plan = planner.plan()
+
+        assert plan['forward_batch_size'] < planner.n
+        assert planner.estimate_memory(**plan_estimate_kwargs(plan)) <= planner.safety_factor * planner.memory_budget
+
+    def test_too_small_budget(self):
+        planner = MemoryPlanner(GB // 1024, n=2_000_000, n_edges=100_000_000, n_features=128, n_classes=40)
+        with pytest.raises(RuntimeError):
+            planner.plan()
+
+    def test_calibrate_and_from_model(self):
+        model = GCN(n_features=16, n_classes=4, n_filters=8)
+        planner = MemoryPlanner.from_model(model, n=1_000, n_edges=10_000, memory_budget=GB, device='cpu')
+        assert planner.model_type == 'GCN'
+        assert planner.n_filters == [8]
+        assert not planner.is_cuda
+
+        estimate = planner.estimate_memory(10_000)
+        # Allocate less than the peak memory of the process so far (e.g. of the previous tests)
+        calibration = planner.calibrate(lambda params: torch.ones(16 * 1024 ** 2), 'cpu')
+        assert calibration == planner.calibration
+        assert calibration > 0 and calibration != 1.
+        assert abs(planner.estimate_memory(10_000) - calibration * estimate) <= 1
+
+    def test_measure_peak_memory(self):
+        assert measure_peak_memory(lambda: None, 'cpu') >= 0
+
+        def probe():
+            # Released before the probe returns
+            x = torch.ones(32 * 1024 ** 2)
+            time.sleep(0.05)
+            del x
+        assert measure_peak_memory(probe, 'cpu') >= 100 * 1024 ** 2
+
+
+def plan_estimate_kwargs(plan):
+    return dict(block_size=plan['block_size'], n_chunks=plan['n_chunks'],
+                forward_batch_size=plan['forward_batch_size'])
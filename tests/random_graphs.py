@@ -0,0 +1,29 @@
+"""Random graphs shared by the tests.
+"""
+from typing import Any, Dict
+
+import numpy as np
+import torch
+import torch_sparse
+
+from rgnn_at_scale.models.gcn import GCN
+
+
+def create_random_adj(n: int = 100, n_edges: int = 500, weighted: bool = False) -> torch_sparse.SparseTensor:
+    """Symmetric adjacency matrix with `n_edges` random edges (in one direction) and unit or random weights.
+    """
+    torch.manual_seed(42)
+    edge_index = torch.randint(n, (2, n_edges))
+    edge_weight = torch.rand(n_edges) if weighted else torch.ones(n_edges)
+    adj = torch_sparse.SparseTensor.from_edge_index(edge_index, edge_weight, (n, n))
+    adj = (adj + adj.t()).coalesce()
+    return adj if weighted else adj.fill_value(1.)
+
+
+def create_random_graph(n: int = 100, d: int = 16, n_classes: int = 3) -> Dict[str, Any]:
+    """Random undirected graph, features, labels and a GCN as the keyword arguments of an attack.
+    """
+    adj = create_random_adj(n)
+    model = GCN(n_features=d, n_classes=n_classes, n_filters=8)
+    return dict(adj=adj, attr=torch.rand(n, d), labels=torch.randint(n_classes, (n,)), idx_attack=np.arange(n),
+                model=model, make_undirected=True, binary_attr=False)
@@ -0,0 +1,74 @@
+import pytest
+import torch
+import torch_sparse
+
+from rgnn_at_scale.helper.undirected_adjacency import UndirectedAdjacency
+from rgnn_at_scale.helper.utils import to_symmetric
+from rgnn_at_scale.models.gcn import GCN
+from random_graphs import create_random_adj
+
+device = 0 if torch.cuda.is_available() else 'cpu'
+
+
+class TestUndirectedAdjacency():
+
+    def test_from_edge_index_matches_to_symmetric(self):
+        n = 100
+        edge_index, edge_weight = torch.randint(n, (2, 500), device=device), torch.rand(500, device=device)
+        edge_index, edge_weight = torch_sparse.coalesce(edge_index, edge_weight, m=n, n=n)
+
+        adj = UndirectedAdjacency.from_edge_index(edge_index, edge_weight, n)
+        assert torch.all(adj.edge_index[0] <= adj.edge_index[1])
+
+        expected_edge_index, expected_edge_weight = to_symmetric(edge_index, edge_weight, n)
+        expected = torch.sparse_coo_tensor(expected_edge_index, expected_edge_weight, (n, n)).to_dense()
+        assert torch.allclose(adj.to_sparse_tensor().to_dense(), expected)
+
+    def test_matmul_and_degree_match_dense(self):
+        adj = create_random_adj(weighted=True)
+        row, col, value = adj.coo()
+        is_triu = row <= col
+        edge_weight = value[is_triu].clone().to(device).requires_grad_()
+        adj_triu = UndirectedAdjacency(torch.stack((row, col))[:, is_triu].to(device), edge_weight, adj.size(0))
+        assert adj_triu.nnz() < adj.nnz()
+        x = torch.rand(adj.size(0), 8, device=device, requires_grad=True)
+
+        out = adj_triu.matmul(x, n_chunks=3)
+        grad_edge_weight, grad_x = torch.autograd.grad((out ** 2).sum(), (edge_weight, x))
+
+        expected_edge_weight = edge_weight.detach().clone().requires_grad_()
+        expected_x = x.detach().clone().requires_grad_()
+        adj_dense = torch.zeros(adj.sizes(), device=device).index_put(
+            tuple(adj_triu.edge_index), expected_edge_weight)
+        adj_dense = adj_dense + adj_dense.triu(1).T
+        expected_out = adj_dense @ expected_x
+        expected_grad_edge_weight, expected_grad_x = torch.autograd.grad((expected_out ** 2).sum(),
+                                                                         (expected_edge_weight, expected_x))
+
+        assert torch.allclose(out, expected_out, atol=1e-5)
+        assert torch.allclose(grad_edge_weight, expected_grad_edge_weight, atol=1e-4)
+        assert torch.allclose(grad_x, expected_grad_x, atol=1e-4)
+        assert torch.allclose(adj_triu.degree(), adj_dense.sum(0), atol=1e-5)
+        assert torch.equal(adj_triu.has_self_loop(), adj_dense.diag() != 0)
+
+    @pytest.mark.parametrize('row_norm', [False, True])
+    def test_gcn_matches_symmetric(self, row_norm):
+        adj = create_random_adj(weighted=True).to(device)
+        n, d = adj.size(0), 16
+        attr = torch.rand(n, d, device=device)
+        model = GCN(n_features=d, n_classes=3, n_filters=8, row_norm=row_norm).to(device).eval()
+
+        row, col, value = adj.coo()
+        is_triu = row <= col
+        edge_weight = value[is_triu].clone().requires_grad_()
+        logits = model(attr, UndirectedAdjacency(torch.stack((row, col))[:, is_triu], edge_weight, n))
+        grad = torch.autograd.grad(logits.sum(), edge_weight)[0]
+
+        expected_edge_weight = edge_weight.detach().clone().requires_grad_()
+        edge_index, symmetric_edge_weight = UndirectedAdjacency(
+            torch.stack((row, col))[:, is_triu], expected_edge_weight, n).to_edge_index()
+        expected_logits = model(attr, (edge_index, symmetric_edge_weight))
+        expected_grad = torch.autograd.grad(expected_logits.sum(), expected_edge_weight)[0]
+
+        assert torch.allclose(logits, expected_logits, atol=1e-5)
+        assert torch.allclose(grad, expected_grad, atol=1e-5)
@@ -0,0 +1,23 @@
+import torch
+
+from rgnn_at_scale.helper.utils import compact_index, get_index_dtype
+
+device = 0 if torch.cuda.is_available() else 'cpu'
+
+
+class TestCompactIndex():
+
+    def test_int32_if_it_fits(self):
+        index = torch.randint(100, (2, 50), device=device)
+        compacted = compact_index(index)
+        assert compacted.dtype == torch.int32
+        assert torch.equal(compacted.long(), index)
+
+    def test_int64_fallback(self):
+        assert get_index_dtype(torch.iinfo(torch.int32).max) == torch.int32
+        assert get_index_dtype(torch.iinfo(torch.int32).max + 1) == torch.int64
+        assert get_index_dtype(100, compact=False) == torch.int64
+
+        index = torch.tensor([0, 2 ** 31], device=device)
+        assert compact_index(index).dtype == torch.int64
+        assert compact_index(index[:1], max_value=2 ** 31).dtype == torch.int64